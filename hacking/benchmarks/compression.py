@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Compare compression time against tarball size for every format tito can
+create source tarballs in, single and multi-threaded. Also checks the
+output doesn't depend on the number of threads.
+
+Usage:
+
+    hacking/benchmarks/compression.py [--repo DIR --commit SHA --dir RELDIR]
+        [--threads N]
+
+Without --repo the tito repository itself is archived. Formats whose tool
+isn't installed are skipped.
+"""
+from __future__ import print_function
+
+import hashlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from tito.common import get_commit_timestamp, run_command  # NOQA
+from tito.compress import TARBALL_EXTENSIONS, open_compressed  # NOQA
+from tito.tar import TarFixer  # NOQA
+
+
+def fixed_tar(repo, commit, relative_dir, dest):
+    """ The uncompressed tarball create_tgz would produce. """
+    os.chdir(repo)
+    if relative_dir in ['/', './']:
+        relative_dir = ""
+    initial_tar = dest + ".initial"
+    run_command("git archive --format=tar --prefix=bench-1.0/ %s:%s --output=%s" % (
+        commit, relative_dir, initial_tar))
+    dest_fh = open(dest, 'wb')
+    try:
+        TarFixer(open(initial_tar, 'rb'), dest_fh, get_commit_timestamp(commit), commit).fix()
+    finally:
+        dest_fh.close()
+    os.unlink(initial_tar)
+
+
+def compress(tar, compression, threads, dest):
+    """ Returns wall time and sha256 of the compressed tarball. """
+    start = time.time()
+    dest_fh = open(dest, 'wb')
+    try:
+        compressed_fh = open_compressed(dest_fh, compression, threads)
+        src = open(tar, 'rb')
+        try:
+            shutil.copyfileobj(src, compressed_fh, 1024 * 1024)
+        finally:
+            src.close()
+            compressed_fh.close()
+    finally:
+        dest_fh.close()
+    if compressed_fh.status != 0:
+        raise OSError("%s exited with %s" % (compressed_fh.command, compressed_fh.status))
+    elapsed = time.time() - start
+    return elapsed, hashlib.sha256(open(dest, 'rb').read()).hexdigest()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--repo", default=os.path.join(SRC_DIR, ".."),
+        help="git repository to archive")
+    parser.add_option("--commit", default="HEAD")
+    parser.add_option("--dir", default="./", help="directory relative to the git root")
+    parser.add_option("--threads", type="int", default=multiprocessing.cpu_count(),
+        help="threads for the multi-threaded runs")
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="tito-bench-")
+    try:
+        repo = os.path.abspath(options.repo)
+        os.chdir(repo)
+        commit = run_command("git rev-parse %s" % options.commit)
+        tar = os.path.join(work_dir, "bench-1.0.tar")
+        fixed_tar(repo, commit, options.dir, tar)
+        tar_size = os.path.getsize(tar)
+        print("Uncompressed: %.1f MiB" % (tar_size / 1048576.0))
+
+        print("%-6s %8s %10s %12s %8s" % ("format", "threads", "wall (s)", "size (MiB)", "ratio"))
+        failed = False
+        for compression in sorted(TARBALL_EXTENSIONS):
+            digests = {}
+            for threads in sorted(set([0, 1, options.threads])):
+                dest = os.path.join(work_dir, "bench-1.0" + TARBALL_EXTENSIONS[compression])
+                try:
+                    elapsed, digests[threads] = compress(tar, compression, threads, dest)
+                except OSError:
+                    print("%-6s %8d %10s" % (compression, threads, "skipped: %s" % sys.exc_info()[1]))
+                    break
+                size = os.path.getsize(dest)
+                print("%-6s %8d %10.2f %12.2f %8.3f" % (compression, threads, elapsed,
+                    size / 1048576.0, float(size) / tar_size))
+            # With 0 threads gzip(1) is used, everything else must match.
+            threaded = set(v for k, v in digests.items() if k or compression != "gz")
+            if len(threaded) > 1:
+                print("ERROR: %s output depends on the number of threads!" % compression)
+                failed = True
+        return int(failed)
+    finally:
+        os.chdir("/")
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Compare wall time and peak disk usage of the streaming create_tgz against
+the old pipeline which wrote git archive, TarFixer and gzip output to disk
+one after the other, and against create_tgz compressing in threads.
+
+Usage:
+
+    hacking/benchmarks/create_tgz.py [--repo DIR --commit SHA --dir RELDIR]
+        [--threads N]
+
+Without --repo a throwaway git repository full of random data is generated.
+"""
+from __future__ import print_function
+
+import functools
+import gzip
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from tito.common import create_tgz, get_commit_timestamp, run_command  # NOQA
+from tito.tar import TarFixer  # NOQA
+
+
+def legacy_create_tgz(git_root, prefix, commit, relative_dir, dest_tgz):
+    """ The three copies on disk pipeline create_tgz used to run. """
+    os.chdir(os.path.abspath(git_root))
+    timestamp = get_commit_timestamp(commit)
+    relative_git_dir = relative_dir
+    if relative_git_dir in ['/', './']:
+        relative_git_dir = ""
+    basename = os.path.splitext(dest_tgz)[0]
+    initial_tar = "%s.initial" % basename
+    run_command('git archive --format=tar --prefix=%s/ %s:%s --output=%s' % (
+        prefix, commit, relative_git_dir, initial_tar))
+    fixed_tar = "%s.tar" % basename
+    fixed_tar_fh = open(fixed_tar, 'wb')
+    try:
+        TarFixer(open(initial_tar, 'rb'), fixed_tar_fh, timestamp, commit).fix()
+    finally:
+        fixed_tar_fh.close()
+    run_command("gzip -n -c < %s > %s" % (fixed_tar, dest_tgz))
+
+
+class DiskUsageSampler(threading.Thread):
+    """ Polls the size of everything in a directory, remembering the peak. """
+
+    def __init__(self, path, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def _usage(self):
+        total = 0
+        for f in os.listdir(self.path):
+            try:
+                total += os.path.getsize(os.path.join(self.path, f))
+            except OSError:
+                pass
+        return total
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self._usage())
+            time.sleep(self.interval)
+        self.peak = max(self.peak, self._usage())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def make_repo(path, files, size):
+    os.makedirs(os.path.join(path, "pkg"))
+    for i in range(files):
+        f = open(os.path.join(path, "pkg", "file-%05d" % i), 'wb')
+        f.write(os.urandom(size // 2) + b"\0" * (size - size // 2))
+        f.close()
+    env = dict(os.environ, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@example.com",
+        GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@example.com")
+    for cmd in (["git", "init", "-q"], ["git", "add", "."], ["git", "commit", "-q", "-m", "bench"]):
+        subprocess.check_call(cmd, cwd=path, env=env)
+
+
+def measure(func, repo, commit, relative_dir, out_dir):
+    dest = os.path.join(out_dir, "bench-1.0.tar.gz")
+    sampler = DiskUsageSampler(out_dir)
+    sampler.start()
+    start = time.time()
+    func(repo, "bench-1.0", commit, relative_dir, dest)
+    elapsed = time.time() - start
+    sampler.stop()
+    digest = hashlib.sha256(open(dest, 'rb').read()).hexdigest()
+    tar_digest = hashlib.sha256(gzip.open(dest, 'rb').read()).hexdigest()
+    return elapsed, sampler.peak, digest, tar_digest
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--repo", help="existing git repository to archive")
+    parser.add_option("--commit", default="HEAD")
+    parser.add_option("--dir", default="./", help="directory relative to the git root")
+    parser.add_option("--files", type="int", default=200)
+    parser.add_option("--size", type="int", default=256 * 1024, help="bytes per generated file")
+    parser.add_option("--threads", type="int", default=multiprocessing.cpu_count(),
+        help="compression threads for the parallel pipeline")
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="tito-bench-")
+    try:
+        repo = options.repo
+        relative_dir = options.dir
+        if repo is None:
+            repo = os.path.join(work_dir, "repo")
+            make_repo(repo, options.files, options.size)
+            relative_dir = "pkg/"
+        repo = os.path.abspath(repo)
+        os.chdir(repo)
+        commit = run_command("git rev-parse %s" % options.commit)
+
+        pipelines = [
+            ("legacy", legacy_create_tgz),
+            ("streaming", create_tgz),
+            ("parallel", functools.partial(create_tgz, compression_threads=options.threads)),
+        ]
+        results = {}
+        for name, func in pipelines:
+            out_dir = os.path.join(work_dir, name)
+            os.mkdir(out_dir)
+            results[name] = measure(func, repo, commit, relative_dir, out_dir)
+
+        print("%-10s %10s %16s" % ("pipeline", "wall (s)", "peak disk (MiB)"))
+        for name, func in pipelines:
+            elapsed, peak, digest, tar_digest = results[name]
+            print("%-10s %10.2f %16.1f" % (name, elapsed, peak / 1048576.0))
+        if results["legacy"][2] != results["streaming"][2]:
+            print("ERROR: tarballs differ!")
+            return 1
+        if results["legacy"][3] != results["parallel"][3]:
+            print("ERROR: parallel tarball has different contents!")
+            return 1
+        print("Tarballs are byte-identical, parallel tarball has the same contents.")
+        return 0
+    finally:
+        os.chdir("/")
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Measure how long importing tito.cli takes with "python -X importtime",
+which is what every tito command, even "tito build --help", pays before
+doing anything.
+
+Usage:
+
+    hacking/benchmarks/startup.py [--runs N] [--max-ms MS] [--top N]
+
+Prints the slowest imports of the fastest run. Exits with 1 if that run
+took longer than --max-ms, or if a module only some commands need (see
+LAZY_MODULES) was imported at startup.
+
+The import takes about 70-110 ms on a typical machine, the default
+--max-ms of 200 leaves room for a busy one. It catches imports creeping
+back in; LAZY_MODULES catches the ones that matter most exactly.
+
+Needs Python 3.7 or later.
+"""
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+from optparse import OptionParser
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "..", "..", "src"))
+
+# Imported on first use, never at startup
+LAZY_MODULES = ["blessings", "bugzilla", "rpm", "pkg_resources", "distutils",
+    "xmlrpc", "xmlrpclib", "multiprocessing", "tito.builder", "tito.tagger",
+    "tito.release", "tito.scheduler", "tito.cache", "tito.compress", "tito.tar"]
+
+
+def import_times():
+    """
+    Import tito.cli in a new interpreter, return [(module, self us,
+    cumulative us)] as reported by -X importtime.
+    """
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import tito.cli"],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (unused, err) = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err.decode('utf8'))
+    times = []
+    for line in err.decode('utf8').splitlines():
+        # "import time: <self> | <cumulative> | <indented module name>"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        (self_us, cumulative_us, module) = line[len("import time:"):].split("|")
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--runs", type="int", default=5,
+        help="imports to run, the fastest counts")
+    parser.add_option("--max-ms", type="float", default=200,
+        help="fail if importing tito.cli takes longer")
+    parser.add_option("--top", type="int", default=15,
+        help="number of slowest imports to show")
+    (options, args) = parser.parse_args()
+
+    best = None
+    for i in range(options.runs):
+        times = import_times()
+        total = dict((module, cumulative) for (module, unused, cumulative) in times)["tito.cli"]
+        if best is None or total < best[0]:
+            best = (total, times)
+    (total, times) = best
+
+    print("%-40s %10s %10s" % ("module", "self (ms)", "cum. (ms)"))
+    for (module, self_us, cumulative_us) in sorted(times, key=lambda t: -t[2])[:options.top]:
+        print("%-40s %10.1f %10.1f" % (module, self_us / 1000.0, cumulative_us / 1000.0))
+    print("")
+    print("import tito.cli: %.1f ms (limit %.1f ms)" % (total / 1000.0, options.max_ms))
+
+    failed = False
+    imported = [module for (module, unused, unused2) in times
+        if [lazy for lazy in LAZY_MODULES if module == lazy or module.startswith(lazy + ".")]]
+    if imported:
+        print("ERROR: imported at startup: %s" % ", ".join(imported))
+        failed = True
+    if total / 1000.0 > options.max_ms:
+        print("ERROR: startup is slower than %.1f ms" % options.max_ms)
+        failed = True
+    return int(failed)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,29 +15,41 @@
 and rpms.
 """
 
+import copy
+import glob
 import gzip
+import hashlib
 import os
 import sys
 import re
+import shlex
 import shutil
-from pkg_resources import require
-from distutils.version import LooseVersion as loose_version
+import time
 from tempfile import mkdtemp
 
 from tito.common import scl_to_rpm_option, get_latest_tagged_version, \
-    find_wrote_in_rpmbuild_output, debug, error_out, run_command_print, \
+    RpmbuildOutput, debug, error_out, run_command_print, \
     find_spec_file, run_command, get_build_commit, get_relative_project_dir, \
     get_relative_project_dir_cwd, get_spec_version_and_release, \
     check_tag_exists, create_tgz, get_latest_commit, \
     get_commit_count, find_gemspec_file, create_builder, compare_version,\
     find_cheetah_template_file, render_cheetah, replace_spec_release, \
     find_spec_like_file, warn_out, get_commit_timestamp, chdir, mkdir_p, \
-    find_git_root, info_out, munge_specfile, package_manager
-from tito.compat import getstatusoutput
+    find_git_root, info_out, munge_specfile, package_manager, \
+    BUILDCONFIG_SECTION, get_spec_lines_from_git, get_source0, list_git_dir, \
+    export_git_file, get_spec_file_references, run_argv, scl_macros
+from tito.cache import DEFAULT_ARTIFACT_CACHE_SIZE, DEFAULT_MOCK_ROOT_TTL, \
+    DEFAULT_TARBALL_CACHE_SIZE, ArtifactCache, MockRootCache, TarballCache
+from tito.compat import create_pool, getstatusoutput
+from tito.compress import DEFAULT_FORMAT, compressor_id, format_from_filename, \
+    open_compressed, parse_compression_format, parse_compression_threads, \
+    tarball_extension
 from tito.exception import RunCommandException
 from tito.exception import TitoException
 from tito.config_object import ConfigObject
+from tito.specfile import eval_macro, macro_files_fingerprint, query_spec
 from tito.tar import TarFixer
+from tito.trace import trace_phase
 
 
 class BuilderBase(object):
@@ -88,6 +100,11 @@ def __init__(self, name=None, build_dir=None,
 
         # Location where we do all tito work and store resulting rpms:
         self.rpmbuild_basedir = build_dir
+
+        # Tarballs we created before, for any project:
+        self.tarball_cache = self._get_tarball_cache()
+        # What earlier builds wrote to the build directory:
+        self.artifact_cache = self._get_artifact_cache()
         # Location where we do actual rpmbuilds
         self.rpmbuild_dir = mkdtemp(dir=self.rpmbuild_basedir,
             prefix="rpmbuild-%s" % self.project_name)
@@ -117,6 +134,72 @@ def _get_optional_arg(self, kwargs, arg, default):
             return kwargs[arg]
         return default
 
+    def _get_compression_threads(self, compression):
+        """
+        Return the number of threads to compress tarballs of a format with.
+
+        Whether .tar.gz files are compressed by gzip(1), with 0 threads, or
+        by our parallel gzip is up to compression_threads in tito.props, as
+        the two write different bytes. COMPRESSION_THREADS in ~/.titorc only
+        changes how many threads are used, which never changes the output.
+        """
+        project_threads = 0
+        if self.config and self.config.has_option(BUILDCONFIG_SECTION,
+                "compression_threads"):
+            project_threads = parse_compression_threads(self.config.get(
+                BUILDCONFIG_SECTION, "compression_threads"))
+        if compression == 'gz' and not project_threads:
+            return 0
+        threads = project_threads
+        if self.user_config and 'COMPRESSION_THREADS' in self.user_config:
+            threads = parse_compression_threads(self.user_config['COMPRESSION_THREADS'])
+        if compression == 'gz':
+            return max(1, threads)
+        return threads
+
+    def _get_tarball_cache(self):
+        """
+        Return the tarball cache in the build directory, or None if it was
+        disabled by setting TARBALL_CACHE_SIZE to 0 in ~/.titorc.
+        """
+        max_size = DEFAULT_TARBALL_CACHE_SIZE
+        if self.user_config and 'TARBALL_CACHE_SIZE' in self.user_config:
+            try:
+                max_size = int(self.user_config['TARBALL_CACHE_SIZE'])
+            except ValueError:
+                raise TitoException("Invalid TARBALL_CACHE_SIZE: %s" %
+                    self.user_config['TARBALL_CACHE_SIZE'])
+        if max_size <= 0 or not self.rpmbuild_basedir:
+            return None
+        return TarballCache(os.path.join(self.rpmbuild_basedir, ".cache", "tarballs"),
+            max_size * 1024 * 1024)
+
+    def _get_artifact_cache(self):
+        """
+        Return the artifact cache in the build directory, or None if it was
+        disabled by setting ARTIFACT_CACHE_SIZE to 0 in ~/.titorc.
+        """
+        max_size = DEFAULT_ARTIFACT_CACHE_SIZE
+        if self.user_config and 'ARTIFACT_CACHE_SIZE' in self.user_config:
+            try:
+                max_size = int(self.user_config['ARTIFACT_CACHE_SIZE'])
+            except ValueError:
+                raise TitoException("Invalid ARTIFACT_CACHE_SIZE: %s" %
+                    self.user_config['ARTIFACT_CACHE_SIZE'])
+        if max_size <= 0 or not self.rpmbuild_basedir:
+            return None
+        return ArtifactCache(os.path.join(self.rpmbuild_basedir, ".cache", "artifacts"),
+            max_size * 1024 * 1024)
+
+    def artifact_cache_inputs(self, options):
+        """
+        Return a dictionary of everything the artifacts of run(options)
+        depend on, or None if they can't be reused. Builders which depend
+        on more, such as files outside of git, add it to the dictionary
+        of their parent class.
+        """
+        return None
+
     def _check_required_args(self):
         for arg in self.REQUIRED_ARGS:
             if arg not in self.args:
@@ -136,21 +219,54 @@ def run(self, options):
         # Reset list of artifacts on each call to run().
         self.artifacts = []
 
+        inputs = None
+        if self.artifact_cache is not None:
+            inputs = self.artifact_cache_inputs(options)
+        key = None
+        if inputs is not None:
+            key = self.artifact_cache.key(inputs)
+        # --force-rebuild still replaces the manifest once built:
+        artifacts = None
+        if key is not None and not getattr(options, 'force_rebuild', False):
+            artifacts = self.artifact_cache.get(key)
+            if artifacts is not None:
+                info_out("Reusing the artifacts of a build with the same inputs "
+                    "(--force-rebuild to build again):")
+                for artifact in artifacts:
+                    print("  %s" % artifact)
+                srpms = [a for a in artifacts if a.endswith(".src.rpm")]
+                if srpms:
+                    self.srpm_location = srpms[0]
+                self.artifacts = artifacts
+                try:
+                    if options.rpm:
+                        self._auto_install()
+                finally:
+                    self.cleanup()
+                return self.artifacts
+
+        interrupted = False
         try:
             try:
                 if options.tgz:
-                    self.tgz()
+                    with trace_phase("tgz"):
+                        self.tgz()
                 if options.srpm:
-                    self.srpm()
+                    with trace_phase("srpm"):
+                        self.srpm()
                 if options.rpm:
                     # TODO: not protected anymore
-                    self.rpm()
+                    with trace_phase("rpm"):
+                        self.rpm()
                     self._auto_install()
             except KeyboardInterrupt:
                 print("Interrupted, cleaning up...")
+                interrupted = True
         finally:
             self.cleanup()
 
+        if key is not None and self.artifacts and not interrupted:
+            self.artifact_cache.put(key, inputs, self.artifacts)
         return self.artifacts
 
     def cleanup(self):
@@ -188,9 +304,11 @@ def _create_build_dirs(self):
             mkdir_p(d)
         self._check_build_dirs_access(build_dirs)
 
-    def srpm(self, dist=None):
+    def prepare_srpm(self):
         """
-        Build a source RPM.
+        Create what every srpm() shares: the build directories, the sources
+        and the spec file. Done by srpm() itself when needed, call it first
+        to then build several srpms at once in srpm_copy() builders.
         """
         self._create_build_dirs()
         if not self.ran_tgz:
@@ -199,11 +317,34 @@ def srpm(self, dist=None):
         if self.test:
             self._setup_test_specfile()
 
+        # Expanded by every srpm(), do it before they run in threads:
+        eval_macro("%scl")
+
+    def srpm_copy(self):
+        """
+        Return a copy of this builder which builds srpms in an rpmbuild tree
+        of its own, from our sources and spec file. Removed by our cleanup().
+        """
+        builder = copy.copy(self)
+        # What the copy builds is its own, not ours:
+        builder.artifacts = []
+        builder.sources = list(self.sources)
+        builder.rpmbuild_dir = mkdtemp(dir=self.rpmbuild_dir, prefix="srpm-")
+        builder.rpmbuild_builddir = os.path.join(builder.rpmbuild_dir, "BUILD")
+        return builder
+
+    def srpm(self, dist=None):
+        """
+        Build a source RPM.
+        """
+        self.prepare_srpm()
+
         debug("Creating srpm from spec file: %s" % self.spec_file)
         define_dist = ""
         if self.dist:
             debug("using self.dist: %s" % self.dist)
             define_dist = "--define 'dist %s'" % self.dist
+            dist = self.dist
         elif dist:
             debug("using dist: %s" % dist)
             define_dist = "--define 'dist %s'" % dist
@@ -216,8 +357,16 @@ def srpm(self, dist=None):
             ' "_binary_filedigest_algorithm md5" %s %s %s --nodeps -bs %s' % (
                 rpmbuild_options, self._get_rpmbuild_dir_options(),
                 define_dist, self.spec_file))
-        output = run_command_print(cmd)
-        self.srpm_location = find_wrote_in_rpmbuild_output(output)[0]
+        # Several srpms may be built at once, one log each:
+        stage = "srpm"
+        if self.scl:
+            stage = "%s-%s" % (stage, self.scl)
+        if dist:
+            stage = "%s%s" % (stage, dist)
+        rpmbuild_output = RpmbuildOutput()
+        output = run_command_print(cmd, line_callbacks=[rpmbuild_output],
+            log_file=self._rpmbuild_log_file(stage))
+        self.srpm_location = rpmbuild_output.wrote(output)[0]
         self.artifacts.append(self.srpm_location)
 
     def rpm(self):
@@ -237,15 +386,17 @@ def rpm(self):
             '-ba %s' % (rpmbuild_options,
                 self._get_rpmbuild_dir_options(), define_dist, self.spec_file))
         debug(cmd)
+        rpmbuild_output = RpmbuildOutput()
         try:
-            output = run_command_print(cmd)
+            output = run_command_print(cmd, line_callbacks=[rpmbuild_output],
+                log_file=self._rpmbuild_log_file("rpm"))
         except (KeyboardInterrupt, SystemExit):
             print("")
             exit(1)
         except RunCommandException:
             err = sys.exc_info()[1]
             msg = str(err)
-            if re.search('Failed build dependencies', err.output):
+            if rpmbuild_output.failed_build_dependencies:
                 cmd = "dnf builddep %s" if package_manager() == "dnf" else "yum-builddep %s"
                 msg = "Please run '%s' as root." % \
                     cmd % find_spec_file(self.relative_project_dir)
@@ -253,7 +404,7 @@ def rpm(self):
         except Exception:
             err = sys.exc_info()[1]
             error_out('%s' % str(err))
-        files_written = find_wrote_in_rpmbuild_output(output)
+        files_written = rpmbuild_output.wrote(output)
         if len(files_written) < 2:
             error_out("Error parsing rpmbuild output")
         self.srpm_location = files_written[0]
@@ -262,6 +413,17 @@ def rpm(self):
         print
         info_out("Successfully built: %s" % ' '.join(files_written))
 
+    def _rpmbuild_log_file(self, stage):
+        """
+        Return where to keep a compressed copy of rpmbuild's output, if
+        RPMBUILD_LOG_DIR is set in ~/.titorc.
+        """
+        if not self.user_config or not self.user_config.get('RPMBUILD_LOG_DIR'):
+            return None
+        log_dir = os.path.expanduser(self.user_config['RPMBUILD_LOG_DIR'])
+        mkdir_p(log_dir)
+        return os.path.join(log_dir, "%s-%s.log.gz" % (self.project_name, stage))
+
     def _scl_to_rpmbuild_option(self):
         """ Returns rpmbuild option which disable or enable SC and print warning if needed """
         return scl_to_rpm_option(self.scl)
@@ -351,6 +513,9 @@ def __init__(self, name=None, tag=None, build_dir=None,
 
         if self.config.has_section("requirements"):
             if self.config.has_option("requirements", "tito"):
+                # Slow to import and rarely needed
+                from pkg_resources import require
+                from distutils.version import LooseVersion as loose_version
                 if loose_version(self.config.get("requirements", "tito")) > \
                         loose_version(require('tito')[0].version):
                     error_out([
@@ -373,8 +538,11 @@ def __init__(self, name=None, tag=None, build_dir=None,
             self.relative_project_dir = get_relative_project_dir_cwd(
                 self.git_root)
 
+        self.tarball_compression = self._get_tarball_compression()
+        self.compression_threads = self._get_compression_threads(
+            self.tarball_compression)
         tgz_base = self._get_tgz_name_and_ver()
-        self.tgz_filename = tgz_base + ".tar.gz"
+        self.tgz_filename = tgz_base + tarball_extension(self.tarball_compression)
         self.tgz_dir = tgz_base
         self.artifacts = []
 
@@ -394,9 +562,32 @@ def __init__(self, name=None, tag=None, build_dir=None,
         self.spec_file_name = None
         self.spec_file = None
 
+        # Whether the full source tree is in rpmbuild_gitcopy, see
+        # _setup_spec_only:
+        self.exported_sources = False
+
         # Set to path to srpm once we build one.
         self.srpm_location = None
 
+    def artifact_cache_inputs(self, options):
+        return {
+            'builder': "%s.%s" % (self.__class__.__module__, self.__class__.__name__),
+            'project': self.project_name,
+            'commit': self.git_commit_id,
+            'project_dir': self.relative_project_dir,
+            'build': [options.tgz, options.srpm, options.rpm],
+            'test': self.test,
+            'dist': self.dist,
+            'scl': self.scl,
+            'rpmbuild_options': self.rpmbuild_options,
+            'tarball_compression': compressor_id(self.tarball_compression,
+                self.compression_threads),
+            'args': sorted((self.args or {}).items()),
+            'config': sorted((section, sorted(self.config.items(section)))
+                for section in self.config.sections()),
+            'macros': macro_files_fingerprint(),
+        }
+
     def _create_build_dirs(self):
         """
         Create the build directories. Can safely be called multiple times.
@@ -435,6 +626,27 @@ def _get_build_version(self):
             check_tag_exists(self.build_tag, offline=self.offline)
         return build_version
 
+    def _get_tarball_compression(self):
+        """
+        Return the compression format of the tarball we build, as set in
+        tito.props or implied by the Source0 of the spec file we're building.
+        """
+        if self.config.has_option(BUILDCONFIG_SECTION, "tarball_compression"):
+            return parse_compression_format(self.config.get(
+                BUILDCONFIG_SECTION, "tarball_compression"))
+
+        compression = None
+        if self.relative_project_dir is not None:
+            with chdir(self.git_root):
+                spec_lines = get_spec_lines_from_git(self.git_commit_id,
+                    self.relative_project_dir)
+            if spec_lines:
+                source0 = get_source0(spec_lines)
+                compression = source0 and format_from_filename(source0)
+        if compression:
+            debug("Using %s compression based on Source0" % compression)
+        return compression or DEFAULT_FORMAT
+
     def tgz(self):
         """
         Create the .tar.gz required to build this package.
@@ -471,17 +683,7 @@ def _setup_sources(self):
         Created in the temporary rpmbuild SOURCES directory.
         """
         self._create_build_dirs()
-
-        debug("Creating %s from git tag: %s..." % (self.tgz_filename,
-            self.git_commit_id))
-        create_tgz(self.git_root, self.tgz_dir, self.git_commit_id,
-                self.relative_project_dir,
-                os.path.join(self.rpmbuild_sourcedir, self.tgz_filename))
-
-        # Extract the source so we can get at the spec file, etc.
-        debug("Copying git source to: %s" % self.rpmbuild_gitcopy)
-        run_command("cd %s/ && tar xzf %s" % (self.rpmbuild_sourcedir,
-            self.tgz_filename))
+        top_level_files = self._create_and_extract_tgz()
 
         # Show contents of the directory structure we just extracted.
         debug('', 'ls -lR %s/' % self.rpmbuild_gitcopy)
@@ -490,10 +692,118 @@ def _setup_sources(self):
         # archive into the temp build directory. This is done so we can
         # modify the version/release on the fly when building test rpms
         # that use a git SHA1 for their version.
-        self.spec_file_name = os.path.basename(find_spec_like_file(self.rpmbuild_gitcopy))
+        self.spec_file_name = os.path.basename(find_spec_like_file(self.rpmbuild_gitcopy,
+            top_level_files))
         self.spec_file = os.path.join(
             self.rpmbuild_gitcopy, self.spec_file_name)
 
+    def _create_and_extract_tgz(self):
+        """
+        Create the tarball in the temporary rpmbuild SOURCES directory and
+        extract it there as it is written, so we can get at the spec file,
+        etc.
+
+        Returns the names of the files at the top of the tarball, or None if
+        it came from the cache and they weren't seen.
+        """
+        top_level_files = []
+        top_prefix = self.tgz_dir + "/"
+
+        def note_member(path):
+            if path.startswith(top_prefix):
+                name = path[len(top_prefix):].rstrip("/")
+                if name and "/" not in name:
+                    top_level_files.append(name)
+
+        debug("Creating %s from git tag: %s..." % (self.tgz_filename,
+            self.git_commit_id))
+        debug("Copying git source to: %s" % self.rpmbuild_gitcopy)
+        create_tgz(self.git_root, self.tgz_dir, self.git_commit_id,
+                self.relative_project_dir,
+                os.path.join(self.rpmbuild_sourcedir, self.tgz_filename),
+                self.compression_threads, self.tarball_compression,
+                self.tarball_cache, extract_dir=self.rpmbuild_sourcedir,
+                member_callback=note_member)
+        self.exported_sources = True
+        return top_level_files or None
+
+    def _setup_spec_only(self):
+        """
+        Lazy alternative to _setup_sources for builders which only need the
+        spec file. The spec, the sources and patches it references which
+        live next to it, and tito.props are read straight from git into
+        rpmbuild_gitcopy, no tarball is created. If rpm can't tell the names
+        of all of those, the whole tree is exported instead.
+        """
+        self._create_build_dirs()
+
+        with chdir(self.git_root):
+            names = list_git_dir(self.git_commit_id, self.relative_project_dir)
+            if names is None:
+                error_out("Unable to list %s at %s" % (self.relative_project_dir,
+                    self.git_commit_id))
+            self.spec_file_name = os.path.basename(find_spec_like_file(
+                self.rpmbuild_gitcopy, names))
+            self.spec_file = os.path.join(self.rpmbuild_gitcopy,
+                self.spec_file_name)
+
+            debug("Exporting %s from git: %s..." % (self.spec_file_name,
+                self.git_commit_id))
+            export_git_file(self.git_commit_id, self.relative_project_dir,
+                self.spec_file_name, self.spec_file)
+
+            wanted = self._spec_file_references()
+            if wanted is not None:
+                for name in wanted + ["tito.props"]:
+                    if name in names and name != self.spec_file_name:
+                        debug("Exporting %s from git" % name)
+                        export_git_file(self.git_commit_id, self.relative_project_dir,
+                            name, os.path.join(self.rpmbuild_gitcopy, name))
+                return
+
+        debug("Unable to expand the Source and Patch names of %s, exporting "
+            "every file" % self.spec_file_name)
+        self._export_sources()
+
+    def _spec_file_references(self):
+        """
+        Return the names of the Source and Patch files of the spec file,
+        macros expanded, or None if rpm can't expand all of them.
+        """
+        defines = scl_macros(self.scl)
+        info = query_spec(self.spec_file, defines)
+        if info is not None and info.sources is not None:
+            return [os.path.basename(name) for name in info.sources + info.patches]
+
+        # No rpm bindings, only the name, version and release are known:
+        if info is not None:
+            defines = defines + [("name", info.name), ("version", info.version),
+                ("release", info.release)]
+        f = open(self.spec_file, 'r')
+        try:
+            references = get_spec_file_references(f.readlines())
+        finally:
+            f.close()
+        result = []
+        for name in references:
+            if "%" in name:
+                name = eval_macro(name, defines)
+                if "%" in name:
+                    return None
+            result.append(name)
+        return result
+
+    def _export_sources(self):
+        """
+        Export the whole source tree into rpmbuild_gitcopy after
+        _setup_spec_only, unless it's already there.
+        """
+        if self.exported_sources:
+            return
+        spec_file = self.spec_file
+        Builder._setup_sources(self)
+        self.spec_file = spec_file
+
     def _setup_test_specfile(self):
         if self.test and not self.ran_setup_test_specfile:
             # If making a test rpm we need to get a little crazy with the spec
@@ -560,9 +870,10 @@ def tgz(self):
         self.ran_tgz = True
 
         debug("Scanning for sources.")
-        cmd = "/usr/bin/spectool --list-files '%s' | awk '{print $2}' |xargs -l1 --no-run-if-empty basename " % self.spec_file
-        result = run_command(cmd)
-        self.sources = map(lambda x: os.path.join(self.rpmbuild_gitcopy, x), result.split("\n"))
+        result = run_command(["/usr/bin/spectool", "--list-files", self.spec_file])
+        # "Source0: http://example.com/foo-1.0.tar.gz"
+        self.sources = [os.path.join(self.rpmbuild_gitcopy, os.path.basename(line.split()[1]))
+            for line in result.split("\n") if len(line.split()) > 1]
         debug("  Sources: %s" % self.sources)
 
     def _get_rpmbuild_dir_options(self):
@@ -581,7 +892,7 @@ def _get_rpmbuild_dir_options(self):
 
     def _setup_test_specfile(self):
         """ Override parent behavior. """
-        if self.test:
+        if self.test and not self.ran_setup_test_specfile:
             # If making a test rpm we need to get a little crazy with the spec
             # file we're building off. (note that this is a temp copy of the
             # spec) Swap out the actual release for one that includes the git
@@ -592,6 +903,7 @@ def _setup_test_specfile(self):
                 self.git_commit_id[:7],
                 self.commit_count
             )
+            self.ran_setup_test_specfile = True
 
 
 class GemBuilder(NoTgzBuilder):
@@ -610,29 +922,22 @@ def _setup_sources(self):
         Created in the temporary rpmbuild SOURCES directory.
         """
         self._create_build_dirs()
-
-        debug("Creating %s from git tag: %s..." % (self.tgz_filename,
-            self.git_commit_id))
-        create_tgz(self.git_root, self.tgz_dir, self.git_commit_id,
-                self.relative_project_dir,
-                os.path.join(self.rpmbuild_sourcedir, self.tgz_filename))
-
-        # Extract the source so we can get at the spec file, etc.
-        debug("Copying git source to: %s" % self.rpmbuild_gitcopy)
-        run_command("cd %s/ && tar xzf %s" % (self.rpmbuild_sourcedir,
-            self.tgz_filename))
+        self._create_and_extract_tgz()
 
         # Find the gemspec
         gemspec_filename = find_gemspec_file(self.rpmbuild_gitcopy)
 
         debug("Building gem: %s in %s" % (gemspec_filename,
             self.rpmbuild_gitcopy))
-        # FIXME - this is ugly and should probably be handled better
-        cmd = "gem_name=$(cd %s/ && gem build %s | awk '/File/ {print $2}'); \
-            cp %s/$gem_name %s/" % (self.rpmbuild_gitcopy, gemspec_filename,
-            self.rpmbuild_gitcopy, self.rpmbuild_sourcedir)
-
-        run_command(cmd)
+        result = run_argv(["gem", "build", gemspec_filename],
+            cwd=self.rpmbuild_gitcopy).check()
+        # "  File: foo-1.0.gem"
+        gem_names = [line.split()[1] for line in result.lines()
+            if line.split()[0] == "File:" and len(line.split()) > 1]
+        if not gem_names:
+            error_out("Unable to find the gem built from %s" % gemspec_filename)
+        shutil.copy(os.path.join(self.rpmbuild_gitcopy, gem_names[0]),
+            self.rpmbuild_sourcedir)
 
         # NOTE: The spec file we actually use is the one exported by git
         # archive into the temp build directory. This is done so we can
@@ -679,16 +984,9 @@ def tgz(self):
         Override parent behavior, we need a tgz from the upstream spacewalk
         project we're based on.
         """
-        # TODO: Wasteful step here, all we really need is a way to look for a
-        # spec file at the point in time this release was tagged.
-        NoTgzBuilder._setup_sources(self)
-        # If we knew what it was named at that point in time we could just do:
-        # Export a copy of our spec file at the revision to be built:
-#        cmd = "git show %s:%s%s > %s" % (self.git_commit_id,
-#                self.relative_project_dir, self.spec_file_name,
-#                self.spec_file)
-#        debug(cmd)
-        self._create_build_dirs()
+        # All we need of our own sources is the spec file at the point in
+        # time this release was tagged.
+        self._setup_spec_only()
 
         self.upstream_version = self._get_upstream_version()
         self.upstream_tag = "%s-%s-1" % (self.upstream_name,
@@ -706,14 +1004,15 @@ def tgz(self):
 
         # Create the upstream tgz:
         prefix = "%s-%s" % (self.upstream_name, self.upstream_version)
-        tgz_filename = "%s.tar.gz" % prefix
+        tgz_filename = prefix + tarball_extension(self.tarball_compression)
         commit = get_build_commit(tag=self.upstream_tag)
         relative_dir = get_relative_project_dir(
             project_name=self.upstream_name, commit=commit)
         tgz_fullpath = os.path.join(self.rpmbuild_sourcedir, tgz_filename)
         print("Creating %s from git tag: %s..." % (tgz_filename, commit))
         create_tgz(self.git_root, prefix, commit, relative_dir,
-                tgz_fullpath)
+                tgz_fullpath, self.compression_threads, self.tarball_compression,
+                self.tarball_cache)
         self.ran_tgz = True
         self.sources.append(tgz_fullpath)
 
@@ -790,9 +1089,13 @@ def patch_upstream(self):
         debug("Generating patch with: %s" % patch_command)
         output = run_command(patch_command)
         print(output)
-        (status, output) = getstatusoutput(
-            "grep 'Binary files .* differ' %s " % patch_file)
-        if status == 0 and output != "":
+        binary_diff = re.compile(r'Binary files .* differ')
+        patch = open(patch_file, 'r')
+        try:
+            has_binary_files = any(binary_diff.search(line) for line in patch)
+        finally:
+            patch.close()
+        if has_binary_files:
             error_out("You are doomed. Diff contains binary files. You can not use this builder")
 
         # Creating two copies of the patch here in the temp build directories
@@ -827,11 +1130,16 @@ def _get_upstream_version(self):
         with just the package release being incremented on rebuilds.
         """
         # Use upstreamversion if defined in the spec file:
-        (status, output) = getstatusoutput(
-            "cat %s | grep 'define upstreamversion' | "
-            "awk '{ print $3 ; exit }'" % self.spec_file)
-        if status == 0 and output != "":
-            return output
+        spec = open(self.spec_file, 'r')
+        try:
+            for line in spec:
+                if 'define upstreamversion' in line:
+                    fields = line.split()
+                    if len(fields) > 2:
+                        return fields[2]
+                    break
+        finally:
+            spec.close()
 
         if self.test:
             return self.build_version.split("-")[0]
@@ -929,23 +1237,27 @@ def tgz(self):
         full_path = self._find_tarball()
         if full_path:
             fh = gzip.open(full_path, 'rb')
-            fixed_tar = os.path.join(os.path.splitext(full_path)[0])
-            fixed_tar_fh = open(fixed_tar, 'wb')
             timestamp = get_commit_timestamp(self.git_commit_id)
+            destination_fh = open(destination_file, 'wb')
             try:
-                tarfixer = TarFixer(fh, fixed_tar_fh, timestamp, self.git_commit_id, maven_built=True)
-                tarfixer.fix()
+                compressed_fh = open_compressed(destination_fh, self.tarball_compression,
+                    self.compression_threads)
+                try:
+                    tarfixer = TarFixer(fh, compressed_fh, timestamp, self.git_commit_id, maven_built=True)
+                    tarfixer.fix()
+                finally:
+                    compressed_fh.close()
             finally:
-                fixed_tar_fh.close()
-
-            # It's a pity we can't use Python's gzip, but it doesn't offer an equivalent of -n
-            run_command("gzip -n -c < %s > %s" % (fixed_tar, destination_file))
+                destination_fh.close()
+            if compressed_fh.status != 0:
+                error_out("Error running command: %s (status %s)" % (compressed_fh.command, compressed_fh.status))
         else:
             warn_out([
                 "No Maven generated tarball found.",
                 "Please set up the assembly plugin in your pom.xml to generate a .tar.gz"])
             full_path = os.path.join(self.rpmbuild_sourcedir, self.tgz_filename)
-            create_tgz(self.git_root, self.tgz_dir, self.git_commit_id, self.relative_project_dir, full_path)
+            create_tgz(self.git_root, self.tgz_dir, self.git_commit_id, self.relative_project_dir, full_path,
+                self.compression_threads, self.tarball_compression)
             print("Creating %s from git tag: %s..." % (self.tgz_filename, self.build_tag))
             shutil.copy(full_path, destination_file)
 
@@ -1032,8 +1344,17 @@ def __init__(self, name=None, tag=None, build_dir=None,
                 user_config=user_config,
                 args=args, **kwargs)
 
-        self.mock_tag = args['mock'][0]
+        # Chroots to build in, given as several mock args or in one
+        # separated by commas or spaces:
+        self.mock_tags = []
+        for mock in args['mock']:
+            self.mock_tags.extend(mock.replace(",", " ").split())
+        if not self.mock_tags:
+            raise TitoException("No mock chroot given")
+        self.mock_tag = self.mock_tags[0]
+        self.mock_jobs = self._get_mock_jobs(args)
         self.mock_cmd_args = ""
+        self.mock_config_dir = "/etc/mock"
         if 'mock_config_dir' in args:
             mock_config_dir = args['mock_config_dir'][0]
             if not mock_config_dir.startswith("/"):
@@ -1042,6 +1363,7 @@ def __init__(self, name=None, tag=None, build_dir=None,
             if not os.path.exists(mock_config_dir):
                 raise TitoException("No such mock config dir: %s" % mock_config_dir)
             self.mock_cmd_args = "%s --configdir=%s" % (self.mock_cmd_args, mock_config_dir)
+            self.mock_config_dir = mock_config_dir
 
         # Optional argument which will skip mock --init and add --no-clean
         # and --no-cleanup-after:
@@ -1051,6 +1373,21 @@ def __init__(self, name=None, tag=None, build_dir=None,
             self.mock_cmd_args = "%s --no-clean --no-cleanup-after" % \
                     (self.mock_cmd_args)
 
+        # Optional argument to keep the buildroots and only initialize them
+        # again when the mock config or build dependencies change, "warm" or
+        # "warm=snapshot" to roll back to a snapshot of the initialized
+        # root before every build:
+        self.warm = None
+        if 'warm' in args:
+            self.warm = args['warm'][0] or "root"
+            if self.warm not in ("root", "snapshot"):
+                raise TitoException("Invalid warm mock argument: %s" % self.warm)
+            if self.speedup:
+                raise TitoException("Cannot combine the speedup and warm mock arguments")
+        self.mock_roots = MockRootCache(os.path.join(self.rpmbuild_basedir,
+            ".cache", "mock-roots.json"))
+        self.mock_root_ttl = self._get_mock_root_ttl()
+
         if 'mock_args' in args:
             self.mock_cmd_args = "%s %s" % (self.mock_cmd_args, args['mock_args'][0])
 
@@ -1058,6 +1395,44 @@ def __init__(self, name=None, tag=None, build_dir=None,
 
         # TODO: error out if user does not have mock group
 
+    def _get_mock_jobs(self, args):
+        """
+        Return how many chroots to build in at once, from the mock_jobs
+        builder arg or MOCK_JOBS in ~/.titorc, all of them by default.
+        """
+        if 'mock_jobs' in args:
+            jobs = args['mock_jobs'][0]
+        elif self.user_config and 'MOCK_JOBS' in self.user_config:
+            jobs = self.user_config['MOCK_JOBS']
+        else:
+            return len(self.mock_tags)
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            raise TitoException("Invalid number of mock jobs: %s" % jobs)
+        if jobs < 1:
+            raise TitoException("Invalid number of mock jobs: %s" % jobs)
+        return jobs
+
+    def _get_mock_root_ttl(self):
+        """ Return MOCK_ROOT_TTL from ~/.titorc, in seconds. """
+        if not self.user_config or 'MOCK_ROOT_TTL' not in self.user_config:
+            return DEFAULT_MOCK_ROOT_TTL
+        try:
+            return int(self.user_config['MOCK_ROOT_TTL'])
+        except ValueError:
+            raise TitoException("Invalid MOCK_ROOT_TTL: %s" %
+                self.user_config['MOCK_ROOT_TTL'])
+
+    def artifact_cache_inputs(self, options):
+        inputs = Builder.artifact_cache_inputs(self, options)
+        # What the chroots are set up from, not the packages they get:
+        hasher = hashlib.sha256()
+        for mock_tag in self.mock_tags:
+            self._hash_mock_configs(hasher, mock_tag)
+        inputs['mock_configs'] = hasher.hexdigest()
+        return inputs
+
     def srpm(self, dist=None):
         """
         Build a source RPM.
@@ -1070,6 +1445,14 @@ def srpm(self, dist=None):
         self.srpm_location = self.normal_builder.srpm_location
         self.artifacts.append(self.srpm_location)
 
+    def prepare_srpm(self):
+        self.normal_builder.prepare_srpm()
+
+    def srpm_copy(self):
+        builder = copy.copy(self)
+        builder.normal_builder = self.normal_builder.srpm_copy()
+        return builder
+
     def rpm(self):
         """
         Uses the SRPM
@@ -1077,7 +1460,7 @@ def rpm(self):
         """
 
         print("Creating rpms for %s-%s in mock: %s" % (
-            self.project_name, self.display_version, self.mock_tag))
+            self.project_name, self.display_version, ", ".join(self.mock_tags)))
         if not self.srpm_location:
             self.srpm()
         print("Using srpm: %s" % self.srpm_location)
@@ -1088,34 +1471,199 @@ def cleanup(self):
             self.normal_builder.cleanup()
 
     def _build_in_mock(self):
-        if not self.speedup:
-            print("Initializing mock...")
-            run_command("mock %s -r %s --init" % (self.mock_cmd_args, self.mock_tag))
+        """
+        Rebuild the srpm in every chroot, up to mock_jobs of them at once.
+        """
+        if len(self.mock_tags) == 1:
+            builds = [self._mock_rebuild(self.mock_tag)]
         else:
-            print("Skipping mock --init due to speedup option.")
-
-        print("Installing deps in mock...")
-        run_command("mock %s -r %s %s" % (
-            self.mock_cmd_args, self.mock_tag, self.srpm_location))
-        print("Building RPMs in mock...")
-        run_command('mock %s -r %s --rebuild %s' %
-                (self.mock_cmd_args, self.mock_tag, self.srpm_location))
-        mock_output_dir = os.path.join(self.rpmbuild_dir, "mockoutput")
-        run_command("mock %s -r %s --copyout /builddir/build/RPMS/ %s" %
-                (self.mock_cmd_args, self.mock_tag, mock_output_dir))
-
-        # Copy everything mock wrote out to /tmp/tito:
-        files = os.listdir(mock_output_dir)
-        run_command("cp -v %s/*.rpm %s" %
-                (mock_output_dir, self.rpmbuild_basedir))
+            print("Building in %s chroots, %s at once..." % (len(self.mock_tags),
+                min(self.mock_jobs, len(self.mock_tags))))
+            pool = create_pool(min(self.mock_jobs, len(self.mock_tags)))
+            try:
+                builds = pool.map(self._mock_rebuild, self.mock_tags)
+            finally:
+                pool.close()
+                pool.join()
+
         print
         info_out("Wrote:")
-        for rpm in files:
-            rpm_path = os.path.join(self.rpmbuild_basedir, rpm)
-            print("  %s" % rpm_path)
-            self.artifacts.append(rpm_path)
+        for build in builds:
+            for rpm_path in build.rpms:
+                print("  %s" % rpm_path)
+                self.artifacts.append(rpm_path)
         print
 
+        if len(builds) > 1:
+            print("%-40s %10s  %s" % ("chroot", "time (s)", "result"))
+            for build in builds:
+                status = "ok"
+                if build.result.status:
+                    status = "failed, see %s" % build.log_file
+                print("%-40s %10.1f  %s" % (build.mock_tag, build.elapsed(), status))
+            print("")
+        for build in builds:
+            if build.root:
+                print("%s: %s" % (build.mock_tag, build.root))
+        failed = [build for build in builds if build.result.status]
+        if len(builds) == 1:
+            builds[0].result.check()
+        elif failed:
+            error_out("Mock build failed in: %s" %
+                ", ".join([build.mock_tag for build in failed]))
+
+    def _mock_rebuild(self, mock_tag):
+        """
+        Rebuild the srpm in the mock chroot mock_tag, returns a MockBuild.
+
+        mock initializes the chroot and installs the build dependencies
+        itself, unless it is kept warm. With several chroots or warm roots
+        each gets a buildroot of its own (--uniqueext), with several chroots
+        an output directory of its own too.
+        """
+        result_dir = os.path.join(self.rpmbuild_dir, "mockoutput")
+        copy_dir = self.rpmbuild_basedir
+        argv = ["mock"] + shlex.split(self.mock_cmd_args) + ["-r", mock_tag]
+        chroot_name = os.path.basename(mock_tag)
+        if chroot_name.endswith(".cfg"):
+            chroot_name = chroot_name[:-len(".cfg")]
+        if len(self.mock_tags) > 1:
+            result_dir = os.path.join(result_dir, chroot_name)
+            copy_dir = os.path.join(self.rpmbuild_basedir, chroot_name)
+        if len(self.mock_tags) > 1 or self.warm:
+            argv.append("--uniqueext=tito-%s" % self.project_name)
+        argv.extend(["--resultdir", result_dir])
+
+        build = MockBuild(mock_tag, None, os.path.join(result_dir, "build.log"))
+        if self.warm:
+            failed = self._warm_up(build, argv,
+                "%s-tito-%s" % (chroot_name, self.project_name))
+            if failed is not None:
+                build.result = failed
+                build.log_file = os.path.join(result_dir, "root.log")
+                return build
+            # Keep the root for the next build:
+            argv.extend(["--no-clean", "--no-cleanup-after"])
+
+        with trace_phase("mock", chroot=mock_tag):
+            build.result = run_argv(argv + ["--rebuild", self.srpm_location])
+        if build.result.status != 0:
+            return build
+
+        # Copy the rpms mock wrote out to /tmp/tito:
+        mkdir_p(copy_dir)
+        for rpm in sorted(os.listdir(result_dir)):
+            if rpm.endswith(".rpm") and not rpm.endswith(".src.rpm"):
+                shutil.copy(os.path.join(result_dir, rpm), copy_dir)
+                build.rpms.append(os.path.join(copy_dir, rpm))
+        return build
+
+    def _warm_up(self, build, argv, root):
+        """
+        Get the warm buildroot root ready for build, initializing it unless
+        it was for the same mock config and build dependencies. Describes
+        what was done in build.root, returns the CommandResult of a failed
+        initialization, None otherwise.
+        """
+        key = self._mock_root_key(build.mock_tag)
+        snapshot = "tito-%s" % key[:12]
+        state = self.mock_roots.get(root)
+        if state is None:
+            reason = "no warm root yet"
+        elif state["key"] != key:
+            reason = "mock config or BuildRequires changed"
+        elif time.time() - state["time"] > self.mock_root_ttl:
+            reason = "root older than %s seconds" % self.mock_root_ttl
+        elif self.warm == "snapshot":
+            with trace_phase("mock-rollback", chroot=build.mock_tag):
+                result = run_argv(argv + ["--rollback-to", snapshot])
+            build.setup_seconds = result.elapsed
+            if result.status == 0:
+                build.root = "rolled back to snapshot %s in %.1fs instead of " \
+                    "initializing for %.1fs" % (snapshot, result.elapsed, state["seconds"])
+                return None
+            reason = "no snapshot %s" % snapshot
+        else:
+            build.root = "reused warm root, saving the %.1fs initializing took" % \
+                state["seconds"]
+            return None
+
+        with trace_phase("mock-init", chroot=build.mock_tag):
+            start = time.time()
+            result = run_argv(argv + ["--init"])
+            if result.status == 0:
+                result = run_argv(argv + ["--installdeps", self.srpm_location])
+            seconds = time.time() - start
+        if result.status != 0:
+            build.root = "failed to initialize root (%s)" % reason
+            return result
+        build.setup_seconds += seconds
+        note = ""
+        if self.warm == "snapshot":
+            if state is not None:
+                # Otherwise every change of BuildRequires leaves a snapshot
+                # behind. Failing is fine, it may be gone already.
+                run_argv(argv + ["--remove-snapshot", "tito-%s" % state["key"][:12]])
+            if run_argv(argv + ["--snapshot", snapshot]).status == 0:
+                note = ", snapshot %s" % snapshot
+            else:
+                note = ", no snapshot (is the overlayfs or lvm_root plugin enabled?)"
+        self.mock_roots.put(root, key, seconds)
+        build.root = "initialized root in %.1fs (%s)%s" % (seconds, reason, note)
+        return None
+
+    def _mock_root_key(self, mock_tag):
+        """
+        Return a hash of what a buildroot is set up from: the mock options
+        and configs, and the BuildRequires of the srpm.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(self.mock_cmd_args.encode('utf8'))
+        self._hash_mock_configs(hasher, mock_tag)
+        # The srpm requires what the spec file BuildRequires, macros expanded:
+        result = run_argv(["rpm", "-qp", "--requires", self.srpm_location])
+        hasher.update("\n".join(sorted(result.lines())).encode('utf8'))
+        return hasher.hexdigest()
+
+    def _hash_mock_configs(self, hasher, mock_tag):
+        """ Add the mock config files of the chroot mock_tag to hasher. """
+        if mock_tag.endswith(".cfg"):
+            configs = [mock_tag]
+        else:
+            configs = [os.path.join(self.mock_config_dir, "%s.cfg" % mock_tag)]
+        for config_dir in [self.mock_config_dir, "/etc/mock"]:
+            configs.append(os.path.join(config_dir, "site-defaults.cfg"))
+            configs.extend(sorted(glob.glob(os.path.join(config_dir, "templates", "*.tpl"))))
+        configs.append(os.path.expanduser("~/.config/mock.cfg"))
+        for config in configs:
+            if os.path.exists(config):
+                f = open(config, 'rb')
+                try:
+                    hasher.update(config.encode('utf8') + b"\0" + f.read())
+                finally:
+                    f.close()
+
+
+class MockBuild(object):
+    """
+    What rebuilding the srpm in a mock chroot produced. With a warm root,
+    root describes how it was set up and setup_seconds how long that took.
+    """
+
+    def __init__(self, mock_tag, result, log_file):
+        self.mock_tag = mock_tag
+        self.result = result
+        self.log_file = log_file
+        self.rpms = []
+        self.root = None
+        self.setup_seconds = 0
+
+    def elapsed(self):
+        """ Seconds spent building, including setting up the root. """
+        if self.result is None:
+            return self.setup_seconds
+        return self.setup_seconds + self.result.elapsed
+
 
 class BrewDownloadBuilder(Builder):
     """
@@ -0,0 +1,415 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Persistent caches kept in the build directory, or in the git directory for
+what only depends on the repository.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Default maximum size of the tarball cache in MiB.
+DEFAULT_TARBALL_CACHE_SIZE = 1024
+
+# Default maximum size in MiB of the artifacts the artifact cache keeps.
+DEFAULT_ARTIFACT_CACHE_SIZE = 4096
+
+# Default number of seconds the tags of a remote repository are trusted.
+DEFAULT_REMOTE_TAG_CACHE_TTL = 300
+
+# Number of commits CommitCountCache remembers per section.
+COMMIT_COUNT_CACHE_ENTRIES = 200
+
+# Default number of seconds a warm mock buildroot is reused for.
+DEFAULT_MOCK_ROOT_TTL = 86400
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _write_json(path, data, **kwargs):
+    """
+    Write data to the JSON file path, through a temporary file so nobody
+    ever reads half of it. kwargs go to json.dump().
+    """
+    cache_dir = os.path.dirname(path)
+    _makedirs(cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(data, f, **kwargs)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+class TarballCache(object):
+    """
+    Content addressed cache of source tarballs.
+
+    The tarballs tito creates are a pure function of the tree being archived,
+    the prefix, the commit (which ends up in the pax header), its timestamp
+    and how the tarball is compressed, so a hash of those is all we need to
+    find one we already made.
+
+    Entries are evicted least recently used first once the cache grows over
+    max_size bytes. The mtime of an entry is its last use.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def key(self, *inputs):
+        hasher = hashlib.sha256()
+        for value in inputs:
+            hasher.update(("%s\0" % value).encode("utf8"))
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, dest):
+        """
+        Copy the cached file for key to dest. Returns False if there is none.
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, dest)
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Not there, or evicted by someone else while we were copying
+            return False
+        return True
+
+    def put(self, key, src):
+        """
+        Store a copy of src under key and evict whatever no longer fits.
+        """
+        _makedirs(self.cache_dir)
+
+        # Copy to a temporary name first so nobody ever sees half a tarball
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("."):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        while entries and total > self.max_size:
+            unused, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class ArtifactCache(object):
+    """
+    Manifests of what builds produced, to find the artifacts of a build with
+    the same inputs without building again.
+
+    Every manifest lists the inputs of a build, and the path, size and mtime
+    of each artifact it wrote to the build directory. A manifest only
+    matches while all of its artifacts are still there, unchanged. Once the
+    artifacts of all manifests take more than max_size bytes, the least
+    recently used manifests are dropped. The artifacts themselves are left
+    alone, they are the user's. The mtime of a manifest is its last use.
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def key(self, inputs):
+        """ Return the key of a build, from the dictionary of its inputs. """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(inputs, sort_keys=True).encode("utf8"))
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "%s.json" % key)
+
+    def _read(self, path):
+        try:
+            f = open(path, 'r')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get(self, key):
+        """
+        Return the artifacts of the build with key, None if there are none
+        or some changed since.
+        """
+        manifest = self._read(self._path(key))
+        if manifest is None:
+            return None
+        for artifact in manifest["artifacts"]:
+            try:
+                st = os.stat(artifact["path"])
+            except OSError:
+                return None
+            if st.st_size != artifact["size"] or st.st_mtime != artifact["mtime"]:
+                return None
+        try:
+            os.utime(self._path(key), None)
+        except OSError:
+            return None
+        return [artifact["path"] for artifact in manifest["artifacts"]]
+
+    def put(self, key, inputs, artifacts):
+        """
+        Store the manifest of a build which wrote artifacts, and evict
+        whatever no longer fits.
+        """
+        entries = []
+        for path in artifacts:
+            st = os.stat(path)
+            entries.append({"path": path, "size": st.st_size, "mtime": st.st_mtime})
+        _write_json(self._path(key), {"inputs": inputs, "artifacts": entries},
+            indent=1, sort_keys=True)
+        self.evict()
+
+    def evict(self):
+        manifests = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(".") or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            manifest = self._read(path)
+            if manifest is None:
+                continue
+            size = sum([artifact["size"] for artifact in manifest["artifacts"]])
+            manifests.append((mtime, size, path))
+            total += size
+
+        manifests.sort()
+        while manifests and total > self.max_size:
+            unused, size, path = manifests.pop(0)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class RemoteTagCache(object):
+    """
+    The tags of remote git repositories as "git ls-remote" last listed
+    them, one JSON file per repository URL. Listings older than ttl seconds
+    are ignored.
+    """
+
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir,
+            hashlib.sha256(url.encode("utf8")).hexdigest() + ".json")
+
+    def load(self, url):
+        """
+        Return a dict of tag name to SHA1 for the repository, or None if it
+        isn't cached or the listing expired.
+        """
+        try:
+            f = open(self._path(url), 'r')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get("url") != url:
+            return None
+        age = time.time() - data.get("listed", 0)
+        if age < 0 or age > self.ttl:
+            return None
+        return data.get("tags")
+
+    def save(self, url, tags):
+        _write_json(self._path(url), {"url": url, "listed": time.time(), "tags": tags})
+
+
+class CommitCountCache(object):
+    """
+    Facts about commits which never change once looked up: how many
+    commits one is ahead of a tag, its root commits... Kept in one JSON
+    file, split in sections of at most COMMIT_COUNT_CACHE_ENTRIES commits
+    each. The least recently stored commits are dropped first.
+
+    Nothing is raised when the file can't be read or written, everything
+    can be looked up again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sections = None
+
+    def _load(self):
+        if self._sections is None:
+            try:
+                f = open(self.path, 'r')
+                try:
+                    self._sections = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                self._sections = {}
+        return self._sections
+
+    def get(self, section, commit):
+        """ Return the value stored for a commit, None if there is none. """
+        for (entry_commit, value) in self._load().get(section, []):
+            if entry_commit == commit:
+                return value
+        return None
+
+    def recent(self, section, count):
+        """ Return the last count (commit, value) pairs stored, newest first. """
+        entries = self._load().get(section, [])
+        return [tuple(entry) for entry in reversed(entries[-count:])]
+
+    def put(self, section, commit, value):
+        entries = [entry for entry in self._load().get(section, [])
+            if entry[0] != commit]
+        entries.append([commit, value])
+        self._sections[section] = entries[-COMMIT_COUNT_CACHE_ENTRIES:]
+        try:
+            _write_json(self.path, self._sections)
+        except (IOError, OSError):
+            # Read-only checkout, we'll just have to count again next time
+            pass
+
+
+class MacroCache(object):
+    """
+    Expanded rpm macros, in one JSON file. Everything in it is forgotten
+    when the fingerprint of rpm's macro files changes.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._macros = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._macros is None:
+            self._macros = {}
+            try:
+                f = open(self.path, 'r')
+                try:
+                    data = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, OSError, ValueError):
+                return self._macros
+            if data.get("fingerprint") == self.fingerprint:
+                self._macros = data.get("macros", {})
+        return self._macros
+
+    def get(self, key):
+        """ Return the expansion stored for key, None if there is none. """
+        return self._load().get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self._load()[key] = value
+            try:
+                _write_json(self.path, {"fingerprint": self.fingerprint,
+                    "macros": self._macros})
+            except (IOError, OSError):
+                # Expanded again next time
+                pass
+
+
+class MockRootCache(object):
+    """
+    What the mock buildroots tito keeps warm were set up for: a key of
+    their mock config and build dependencies, when, and how many seconds
+    it took. In one JSON file, read again before every change as several
+    tito processes may build in different roots at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, root):
+        """ Return {"key", "time", "seconds"} of a root, None if unknown. """
+        return self._load().get(root)
+
+    def put(self, root, key, seconds):
+        with self._lock:
+            roots = self._load()
+            roots[root] = {"key": key, "time": time.time(), "seconds": seconds}
+            try:
+                _write_json(self.path, roots)
+            except (IOError, OSError):
+                # The root is initialized again next time
+                pass
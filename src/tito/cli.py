@@ -16,20 +16,23 @@
 
 import sys
 import os
+import shutil
 
 from optparse import OptionParser, SUPPRESS_HELP
 
 from tito.common import find_git_root, error_out, debug, get_class_by_name, \
     DEFAULT_BUILDER, BUILDCONFIG_SECTION, DEFAULT_TAGGER, \
     create_builder, get_project_name, get_relative_project_dir, \
-    DEFAULT_BUILD_DIR, run_command, tito_config_dir, warn_out, info_out, \
-    read_user_config
-from tito.compat import RawConfigParser, getstatusoutput, getoutput
+    DEFAULT_BUILD_DIR, run_command, run_argv, tito_config_dir, warn_out, \
+    info_out, read_user_config, mkdir_p
+from tito.compat import RawConfigParser, getstatusoutput, getoutput, \
+    decode_bytes
+from tito.context import reset_contexts, set_remote_tag_cache
 from tito.exception import TitoException
-
-# Hack for Python 2.4, seems to require we import these so they get compiled
-# before we try to dynamically import them based on a string name.
-import tito.tagger  # NOQA
+from tito.gitrepo import get_repository
+from tito.specfile import macro_files_fingerprint, set_macro_cache
+from tito.trace import start_tracing, start_tracing_from_environment, \
+    stop_tracing, trace_phase
 
 TITO_PROPS = "tito.props"
 RELEASERS_CONF_FILENAME = "releasers.conf"
@@ -156,12 +159,8 @@ def _read_project_config(self):
             relative_dir = get_relative_project_dir(self.package_name, self.tag)
             debug("Relative project dir: %s" % relative_dir)
 
-            cmd = "git show %s:%s%s" % (self.tag, relative_dir,
-                    TITO_PROPS)
-            debug(cmd)
-            (status, output) = getstatusoutput(cmd)
-
-            if status == 0:
+            output = self._read_tagged_file(relative_dir, TITO_PROPS)
+            if output is not None:
                 faux_config_file = FauxConfigFile(output)
                 self.config.read_fp(faux_config_file)
                 print("Loaded package specific tito.props overrides from %s" %
@@ -170,6 +169,26 @@ def _read_project_config(self):
 
         debug("Unable to locate package specific config for this package.")
 
+    def _read_tagged_file(self, relative_dir, filename):
+        """
+        Return the contents of a file in the project directory as of
+        self.tag, or None if it didn't exist back then.
+        """
+        repository = get_repository()
+        if repository is not None and relative_dir is not None:
+            content = repository.read_file(self.tag,
+                os.path.normpath(relative_dir + filename))
+            if content is None:
+                return None
+            return decode_bytes(content, 'utf8')
+
+        cmd = "git show %s:%s%s" % (self.tag, relative_dir, filename)
+        debug(cmd)
+        (status, output) = getstatusoutput(cmd)
+        if status != 0:
+            return None
+        return output
+
 
 def lookup_build_dir(user_config):
     """
@@ -197,9 +216,17 @@ def main(self, argv):
             self._usage()
             sys.exit(1)
 
-        module_class = CLI_MODULES[argv[0]]
-        module = module_class()
-        return module.main(argv)
+        # Everything about the checkout is looked up again, once, for every
+        # invocation:
+        reset_contexts()
+
+        start_tracing_from_environment()
+        try:
+            module_class = CLI_MODULES[argv[0]]
+            module = module_class()
+            return module.main(argv)
+        finally:
+            stop_tracing()
 
     def _usage(self):
         print("Usage: tito MODULENAME --help")
@@ -235,6 +262,13 @@ def _add_common_options(self):
             help="do not attempt any remote communication (avoid using " +
                 "this please)",
             default=False)
+        self.parser.add_option("--refresh-remote", dest="refresh_remote",
+            action="store_true", default=False,
+            help="list the tags of the remote git repository again instead "
+                "of using the ones cached in the output directory")
+        self.parser.add_option("--trace", dest="trace", metavar="FILE",
+            help="record how long each step and command takes to FILE, "
+                "in the Chrome trace event format")
 
         default_output_dir = lookup_build_dir(self.user_config)
         if not os.path.exists(default_output_dir):
@@ -250,14 +284,51 @@ def _add_common_options(self):
     def main(self, argv):
         (self.options, self.args) = self.parser.parse_args(argv)
 
+        if self.options.trace:
+            start_tracing(self.options.trace)
+
         self._validate_options()
 
+        set_remote_tag_cache(self._get_remote_tag_cache(),
+            refresh=self.options.refresh_remote)
+        set_macro_cache(self._get_macro_cache())
+
         if len(argv) < 1:
             print(self.parser.error("Must supply an argument. "
                 "Try -h for help."))
 
+    def _get_remote_tag_cache(self):
+        """
+        Return the cache of remote tags in the output directory, or None if
+        it was disabled by setting REMOTE_TAG_CACHE_TTL to 0 in ~/.titorc.
+        """
+        from tito.cache import DEFAULT_REMOTE_TAG_CACHE_TTL, RemoteTagCache
+        ttl = DEFAULT_REMOTE_TAG_CACHE_TTL
+        if 'REMOTE_TAG_CACHE_TTL' in self.user_config:
+            try:
+                ttl = int(self.user_config['REMOTE_TAG_CACHE_TTL'])
+            except ValueError:
+                raise TitoException("Invalid REMOTE_TAG_CACHE_TTL: %s" %
+                    self.user_config['REMOTE_TAG_CACHE_TTL'])
+        if ttl <= 0:
+            return None
+        return RemoteTagCache(os.path.join(self.options.output_dir, ".cache",
+            "remote-tags"), ttl)
+
+    def _get_macro_cache(self):
+        """
+        Return the cache of expanded rpm macros in the output directory, or
+        None if it was disabled by setting RPM_MACRO_CACHE to 0 in ~/.titorc.
+        """
+        from tito.cache import MacroCache
+        if self.user_config.get('RPM_MACRO_CACHE', '1').lower() in ('0', 'false'):
+            return None
+        return MacroCache(os.path.join(self.options.output_dir, ".cache",
+            "rpm-macros.json"), macro_files_fingerprint())
+
     def load_config(self, package_name, build_dir, tag):
-        self.config = ConfigLoader(package_name, build_dir, tag).load()
+        with trace_phase("config"):
+            self.config = ConfigLoader(package_name, build_dir, tag).load()
 
         if self.config.has_option(BUILDCONFIG_SECTION,
                 "offline"):
@@ -315,6 +386,10 @@ def __init__(self):
         self.parser.add_option("--no-cleanup", dest="no_cleanup",
                 action="store_true",
                 help="do not clean up temporary build directories/files")
+        self.parser.add_option("--force-rebuild", dest="force_rebuild",
+                action="store_true",
+                help="build even if the output directory has the artifacts "
+                    "of a build with the same inputs")
         self.parser.add_option("--tag", dest="tag", metavar="PKGTAG",
                 help="build a specific tag instead of the latest version " +
                     "(i.e. spacewalk-java-0.4.0-1)")
@@ -340,18 +415,40 @@ def __init__(self):
                 default='',
                 metavar="COLLECTION", help="Build package for software collection.")
 
+        self.parser.add_option("--all-packages", dest="all_packages",
+                action="store_true",
+                help="Build every package of the repository, each after the "
+                    "packages it BuildRequires")
+        self.parser.add_option("--changed-since", dest="changed_since",
+                metavar="REF",
+                help="Build the packages with changes since the git revision "
+                    "REF, and the packages which BuildRequire them")
+        self.parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                metavar="N",
+                help="Number of packages to build at once with --all-packages "
+                    "or --changed-since (default: number of CPUs)")
+
     def main(self, argv):
         BaseCliModule.main(self, argv)
 
         build_dir = os.path.normpath(os.path.abspath(self.options.output_dir))
+        if self.options.all_packages or self.options.changed_since:
+            return self._build_packages(build_dir)
+
         package_name = get_project_name(tag=self.options.tag)
 
         build_tag = self.options.tag
 
         self.load_config(package_name, build_dir, self.options.tag)
 
-        args = self._parse_builder_args()
-        kwargs = {
+        builder = create_builder(package_name, build_tag,
+                self.config,
+                build_dir, self.user_config, self._parse_builder_args(),
+                builder_class=self.options.builder, **self._builder_kwargs())
+        return builder.run(self.options)
+
+    def _builder_kwargs(self):
+        return {
             'dist': self.options.dist,
             'test': self.options.test,
             'offline': self.options.offline,
@@ -360,12 +457,109 @@ def main(self, argv):
             'scl': self.options.scl,
         }
 
-        builder = create_builder(package_name, build_tag,
+    def _build_packages(self, build_dir):
+        """
+        Build every package, or those changed since --changed-since and the
+        packages which BuildRequire them, several at once. Each package's
+        rpms go to a repository in the output directory as soon as it is
+        built, for the packages requiring it.
+        """
+        from tito.scheduler import BuildGraph, BuildScheduler, changed_packages, \
+            read_build_dependencies, read_packages
+
+        self.git_root = find_git_root()
+        self.packages = read_packages(os.path.join(self.git_root, tito_config_dir()))
+        if not self.packages:
+            error_out("No packages found in %s/packages" % tito_config_dir())
+
+        with trace_phase("dependencies"):
+            unknown = read_build_dependencies(self.packages, self.git_root)
+        if unknown:
+            warn_out(["Unable to read BuildRequires of: %s" % " ".join(unknown),
+                "   They are built without waiting for other packages, "
+                "install the rpm Python bindings to read them."])
+
+        graph = BuildGraph(self.packages)
+        if self.options.changed_since:
+            changed = changed_packages(self.packages, self.git_root,
+                self.options.changed_since)
+            graph = graph.select(graph.dependents(changed))
+            if not graph.names:
+                info_out("No packages changed since %s" % self.options.changed_since)
+                return []
+
+        self.repo_dir = os.path.join(build_dir, "repo")
+        mkdir_p(self.repo_dir)
+        # mock fails on a repository without metadata, even an empty one:
+        result = run_argv(["createrepo", "-q", self.repo_dir])
+        if result.status != 0:
+            warn_out(["Unable to create the repository of built packages:",
+                result.output, "   Packages are built without it."])
+            self.repo_dir = None
+        jobs = self.options.jobs
+        if not jobs:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        scheduler = BuildScheduler(graph, self._build_package,
+            jobs=jobs, log_dir=os.path.join(build_dir, "logs"))
+        print("Building %s packages, %s at once, logs in %s" % (len(graph.names),
+            jobs, scheduler.log_dir))
+
+        def on_done(name):
+            if name in scheduler.built:
+                print("Built %s: %s" % (name, " ".join(scheduler.built[name])))
+                self._add_to_repo(scheduler.built[name])
+            else:
+                warn_out("Failed to build %s (%s), see %s" % (name,
+                    scheduler.failed[name], scheduler.log_file(name)))
+
+        with trace_phase("build-packages", jobs=jobs):
+            scheduler.run(on_done)
+
+        for name in scheduler.skipped:
+            warn_out("Skipped %s, a package it requires failed to build" % name)
+        if scheduler.failed or scheduler.skipped:
+            error_out("%s packages failed to build, %s skipped" % (
+                len(scheduler.failed), len(scheduler.skipped)))
+        if self.repo_dir is not None:
+            info_out("Built %s packages, their rpms are in the repository %s" % (
+                len(scheduler.built), self.repo_dir))
+        else:
+            info_out("Built %s packages" % len(scheduler.built))
+        return [artifact for name in graph.order() for artifact in scheduler.built[name]]
+
+    def _build_package(self, package_name):
+        """ Build a package of _build_packages() in a worker process. """
+        build_dir = os.path.normpath(os.path.abspath(self.options.output_dir))
+        os.chdir(os.path.join(self.git_root, self.packages[package_name].relative_dir))
+        self.load_config(package_name, build_dir, None)
+
+        builder = create_builder(package_name, None,
                 self.config,
-                build_dir, self.user_config, args,
-                builder_class=self.options.builder, **kwargs)
+                build_dir, self.user_config, self._parse_builder_args(),
+                builder_class=self.options.builder, **self._builder_kwargs())
+        if self.repo_dir is not None and hasattr(builder, "mock_cmd_args"):
+            # Let mock install the packages built before this one:
+            builder.mock_cmd_args = "%s --addrepo=file://%s" % (
+                builder.mock_cmd_args, self.repo_dir)
         return builder.run(self.options)
 
+    def _add_to_repo(self, artifacts):
+        """ Add the binary rpms of artifacts to the repository of built packages. """
+        if self.repo_dir is None:
+            return
+        rpms = [artifact for artifact in artifacts
+            if artifact.endswith(".rpm") and not artifact.endswith(".src.rpm")]
+        if not rpms:
+            return
+        for rpm in rpms:
+            shutil.copy2(rpm, self.repo_dir)
+        result = run_argv(["createrepo", "-q", "--update", self.repo_dir])
+        if result.status != 0:
+            warn_out(["Unable to update the repository of built packages:",
+                result.output, "   Packages are built without it from now on."])
+            self.repo_dir = None
+
     def _validate_options(self):
         if not any([self.options.rpm, self.options.srpm, self.options.tgz]):
             error_out("Need an artifact type to build.  Use --rpm, --srpm, or --tgz")
@@ -373,6 +567,10 @@ def _validate_options(self):
             error_out("Cannot combine --srpm and --rpm")
         if self.options.test and self.options.tag:
             error_out("Cannot build test version of specific tag.")
+        if (self.options.all_packages or self.options.changed_since) and self.options.tag:
+            error_out("Cannot build a specific tag of every package.")
+        if self.options.jobs is not None and self.options.jobs < 1:
+            error_out("--jobs must be at least 1")
 
     def _parse_builder_args(self):
         """
@@ -550,12 +748,24 @@ def main(self, argv):
 
         orig_cwd = os.getcwd()
 
-        # Create an instance of the releaser we intend to use:
+        # Targets releasing the same artifacts share the builder of the first
+        # one, the last one cleans it up:
+        releaser_classes = {}
+        keys = {}
+        remaining = {}
         for target in targets:
-            print("Releasing to target: %s" % target)
             if not releaser_config.has_section(target):
                 error_out("No such releaser configured: %s" % target)
-            releaser_class = get_class_by_name(releaser_config.get(target, "releaser"))
+            releaser_classes[target] = get_class_by_name(releaser_config.get(target, "releaser"))
+            keys[target] = releaser_classes[target].build_key(releaser_config, target)
+            if keys[target] is not None:
+                remaining[keys[target]] = remaining.get(keys[target], 0) + 1
+        builders = {}
+
+        # Create an instance of the releaser we intend to use:
+        for target in targets:
+            print("Releasing to target: %s" % target)
+            releaser_class = releaser_classes[target]
             debug("Using releaser class: %s" % releaser_class)
 
             builder_args = {}
@@ -575,29 +785,44 @@ def main(self, argv):
                 'offline': self.options.offline
             }
 
-            releaser = releaser_class(
-                name=package_name,
-                tag=self.options.tag,
-                build_dir=build_dir,
-                config=self.config,
-                user_config=self.user_config,
-                target=target,
-                releaser_config=releaser_config,
-                no_cleanup=self.options.no_cleanup,
-                test=self.options.test,
-                auto_accept=self.options.auto_accept,
-                **kwargs)
+            with trace_phase("releaser-init", target=target):
+                releaser = releaser_class(
+                    name=package_name,
+                    tag=self.options.tag,
+                    build_dir=build_dir,
+                    config=self.config,
+                    user_config=self.user_config,
+                    target=target,
+                    releaser_config=releaser_config,
+                    no_cleanup=self.options.no_cleanup,
+                    test=self.options.test,
+                    auto_accept=self.options.auto_accept,
+                    **kwargs)
+
+            key = keys[target]
+            if key is not None:
+                remaining[key] -= 1
+                if key in builders:
+                    releaser.use_builder(builders[key])
+                releaser.cleanup_builder = remaining[key] == 0
 
             try:
                 try:
-                    releaser.release(dry_run=self.options.dry_run,
-                            no_build=self.options.no_build,
-                            scratch=self.options.scratch)
+                    with trace_phase("release", target=target):
+                        releaser.release(dry_run=self.options.dry_run,
+                                no_build=self.options.no_build,
+                                scratch=self.options.scratch)
                 except KeyboardInterrupt:
                     print("Interrupted, cleaning up...")
             finally:
                 releaser.cleanup()
 
+            if not releaser.cleanup_builder:
+                if releaser.built:
+                    builders.setdefault(key, releaser.builder)
+                else:
+                    releaser.builder.cleanup()
+
             # Make sure we go back to where we started, otherwise multiple
             # builders gets very confused:
             os.chdir(orig_cwd)
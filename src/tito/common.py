@@ -16,26 +16,30 @@
 """
 Common operations.
 """
+import collections
 import errno
 import fileinput
 import glob
+import gzip
 import os
 import pickle
 import re
+import select
 import sys
 import subprocess
 import shlex
 import shutil
+import signal
 import tempfile
+import time
 
-from blessings import Terminal
-
-from bugzilla.rhbugzilla import RHBugzilla
-
-from tito.compat import xmlrpclib, getstatusoutput
+from tito.compat import xmlrpclib, getstatusoutput, decode_bytes
 from tito.exception import TitoException
 from tito.exception import RunCommandException
-from tito.tar import TarFixer
+from tito.context import get_context, invalidate_context
+from tito.gitrepo import get_repository
+from tito.specfile import eval_macro, query_spec
+from tito.trace import trace_command, trace_phase
 
 DEFAULT_BUILD_DIR = "/tmp/tito"
 DEFAULT_BUILDER = "builder"
@@ -203,6 +207,8 @@ def _filter_bzs_with_flags(self):
         return filtered_bzs
 
     def _load_bug(self, bug_id):
+        # Only needed by releasers which look at bugzilla, and slow to import
+        from bugzilla.rhbugzilla import RHBugzilla
         bugzilla = RHBugzilla(url='https://bugzilla.redhat.com/xmlrpc.cgi')
         return bugzilla.getbug(bug_id, include_fields=['id', 'flags'])
 
@@ -226,18 +232,24 @@ def _out(msgs, prefix, color_func, stream=sys.stdout):
         print(color_func(fmt % {'prefix': prefix, 'msg': msgs}), file=stream)
 
 
+def _terminal():
+    # Imported on first use, to keep tito quick to start
+    from blessings import Terminal
+    return Terminal()
+
+
 def error_out(error_msgs, die=True):
     """
     Print the given error message (or list of messages) and exit.
     """
-    term = Terminal()
+    term = _terminal()
     _out(error_msgs, "ERROR", term.red, sys.stderr)
     if die:
         sys.exit(1)
 
 
 def info_out(msgs):
-    term = Terminal()
+    term = _terminal()
     _out(msgs, None, term.blue)
 
 
@@ -245,7 +257,7 @@ def warn_out(msgs):
     """
     Print the given error message (or list of messages) and exit.
     """
-    term = Terminal()
+    term = _terminal()
     _out(msgs, "WARNING", term.yellow)
 
 
@@ -287,22 +299,29 @@ def create_builder(package_name, build_tag,
     debug("Using builder class: %s" % builder_class)
 
     # Instantiate the builder:
-    builder = builder_class(
-        name=package_name,
-        tag=build_tag,
-        build_dir=build_dir,
-        config=config,
-        user_config=user_config,
-        args=args,
-        **kwargs)
+    with trace_phase("builder-init", builder=builder_class.__name__):
+        builder = builder_class(
+            name=package_name,
+            tag=build_tag,
+            build_dir=build_dir,
+            config=config,
+            user_config=user_config,
+            args=args,
+            **kwargs)
     return builder
 
 
-def find_file_with_extension(in_dir, suffix=None):
-    """ Find the file with given extension in the current directory. """
+def find_file_with_extension(in_dir, suffix=None, names=None):
+    """
+    Find the file with given extension in the current directory.
+
+    names can list the directory's contents if they are already known.
+    """
     file_name = None
     debug("Looking for %s in %s" % (suffix, in_dir))
-    for f in os.listdir(in_dir):
+    if names is None:
+        names = os.listdir(in_dir)
+    for f in names:
         if f.endswith(suffix):
             if file_name is not None:
                 error_out("At least two %s files in directory: %s and %s" % (suffix, file_name, f))
@@ -341,12 +360,12 @@ def find_gemspec_file(in_dir=None):
     return result
 
 
-def find_spec_like_file(in_dir=None):
+def find_spec_like_file(in_dir=None, names=None):
     if in_dir is None:
         in_dir = os.getcwd()
     extension_list = ['.spec', '.spec.tmpl']
     for ext in extension_list:
-        result = find_file_with_extension(in_dir, ext)
+        result = find_file_with_extension(in_dir, ext, names)
         if result:
             return result
     else:
@@ -377,14 +396,19 @@ def find_git_root():
 
     Returned as a full path.
     """
-    (status, cdup) = getstatusoutput("git rev-parse --show-cdup")
-    if status > 0:
+    return get_required_context().git_root
+
+
+def get_required_context():
+    """
+    Return the RepositoryContext of the checkout we're in, exits if we
+    aren't in one.
+    """
+    context = get_context()
+    if context is None:
         error_out(["%s does not appear to be within a git checkout." %
                 os.getcwd()])
-
-    if cdup.strip() == "":
-        cdup = "./"
-    return os.path.abspath(cdup)
+    return context
 
 
 def package_manager():
@@ -396,11 +420,7 @@ def tito_config_dir():
     """ Returns "rel-eng" for old tito projects and ".tito" for
     recent projects.
     """
-    tito_dir = os.path.join(find_git_root(), ".tito")
-    if os.path.isdir(tito_dir):
-        return ".tito"
-    else:
-        return "rel-eng"
+    return get_required_context().config_dir
 
 
 def extract_sha1(output):
@@ -411,13 +431,12 @@ def extract_sha1(output):
         return ""
 
 
-def run_command(command, print_on_success=False):
+def _check_command_status(command, status, output):
     """
-    Run command.
-    If command fails, print status code and command output.
+    Print status code and command output and raise a RunCommandException
+    if the given command failed.
     """
-    (status, output) = getstatusoutput(command)
-    if status > 0:
+    if status != 0:
         msgs = [
             "Error running command: %s\n" % command,
             "Status code: %s\n" % status,
@@ -425,6 +444,102 @@ def run_command(command, print_on_success=False):
         ]
         error_out(msgs, die=False)
         raise RunCommandException(command, status, output)
+
+
+class CommandResult(object):
+    """
+    What running a command with run_argv produced. stdout and stderr are
+    kept apart, elapsed is the wall clock time in seconds.
+    """
+
+    def __init__(self, argv, status, stdout, stderr, elapsed):
+        self.argv = argv
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+    @property
+    def command(self):
+        return " ".join(self.argv)
+
+    @property
+    def output(self):
+        """ stdout and stderr the way getstatusoutput returns them. """
+        output = self.stdout + self.stderr
+        if output.endswith("\n"):
+            output = output[:-1]
+        return output
+
+    def lines(self):
+        """ The non-empty lines of stdout. """
+        return [line for line in self.stdout.splitlines() if line.strip()]
+
+    def first_line(self):
+        """ The first non-empty line of stdout, "" if there is none. """
+        lines = self.lines()
+        if lines:
+            return lines[0]
+        return ""
+
+    def first_field(self):
+        """ The first word of the first line of stdout, "" if there is none. """
+        fields = self.first_line().split()
+        if fields:
+            return fields[0]
+        return ""
+
+    def check(self):
+        """
+        Print the status code and output and raise a RunCommandException if
+        the command failed.
+        """
+        _check_command_status(self.command, self.status, self.output)
+        return self
+
+
+def run_argv(argv, cwd=None, env=None):
+    """
+    Run a command given as a list of arguments, without a shell in between,
+    and return a CommandResult. Nothing is raised when the command fails or
+    doesn't exist, check the status or call check() on the result.
+    """
+    with trace_command(argv, cwd) as record:
+        result = _run_argv(argv, cwd, env)
+        record.status = result.status
+    return result
+
+
+def _run_argv(argv, cwd, env):
+    start = time.time()
+    try:
+        proc = subprocess.Popen(argv, cwd=cwd, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        # What a shell would have told us
+        e = sys.exc_info()[1]
+        return CommandResult(argv, 127, "", "%s: %s\n" % (argv[0], e.strerror),
+            time.time() - start)
+    (stdout, stderr) = proc.communicate()
+    return CommandResult(argv, proc.returncode, decode_bytes(stdout, 'utf8'),
+        decode_bytes(stderr, 'utf8'), time.time() - start)
+
+
+def run_command(command, print_on_success=False):
+    """
+    Run command.
+    If command fails, print status code and command output.
+
+    command is either a shell command line or a list of arguments, which
+    is run without a shell.
+    """
+    if isinstance(command, (list, tuple)):
+        result = run_argv(command)
+        (command, status, output) = (result.command, result.status, result.output)
+    else:
+        (status, output) = getstatusoutput(command)
+    if status > 0:
+        _check_command_status(command, status, output)
     elif print_on_success:
         print("Command: %s\n" % command)
         print("Status code: %s\n" % status)
@@ -432,34 +547,73 @@ def run_command(command, print_on_success=False):
     return output
 
 
-def run_command_print(command):
+# Number of lines of output run_command_print keeps for error messages.
+OUTPUT_TAIL_LINES = 200
+
+
+def run_command_print(command, line_callbacks=None, log_file=None,
+        tail_lines=OUTPUT_TAIL_LINES):
     """
     Simliar to run_command but prints each line of output on the fly.
+
+    Output is never held in memory as a whole, only its last tail_lines
+    lines are returned (and used for the RunCommandException if the command
+    fails). Every line is passed to each of line_callbacks as it arrives,
+    and written to log_file, gzip compressed if it ends with ".gz".
     """
-    output = []
+    tail = collections.deque(maxlen=tail_lines)
+    callbacks = [tail.append] + list(line_callbacks or [])
+    log = None
+    if log_file:
+        if log_file.endswith(".gz"):
+            log = gzip.open(log_file, 'wb')
+        else:
+            log = open(log_file, 'wb')
+
     env = os.environ.copy()
     env['LC_ALL'] = 'C'
-    p = subprocess.Popen(shlex.split(command),
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
-        universal_newlines=True)
-    for line in run_subprocess(p):
-        line = line.rstrip('\n')
-        print(line)
-        output.append(line)
+    argv = shlex.split(command)
+    with trace_command(argv) as record:
+        p = subprocess.Popen(argv,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        try:
+            for line in _stream_lines(p.stdout, log):
+                print(line)
+                for callback in callbacks:
+                    callback(line)
+        finally:
+            p.stdout.close()
+            status = p.wait()
+            record.status = status
+            if log:
+                log.close()
     print("\n"),
-    if p.poll() > 0:
-        raise RunCommandException(command, p.poll(), "\n".join(output))
-    return '\n'.join(output)
-
-
-def run_subprocess(p):
-    while(True):
-        retcode = p.poll()
-        line = p.stdout.readline()
-        if len(line) > 0:
-            yield line
-        if(retcode is not None):
+    if status > 0:
+        raise RunCommandException(command, status, "\n".join(tail))
+    return '\n'.join(tail)
+
+
+def _stream_lines(pipe, log=None):
+    """
+    Yield the lines read from pipe without their line endings, waiting for
+    output with select() instead of polling. Everything read is also written
+    to log.
+    """
+    fd = pipe.fileno()
+    partial = b""
+    while True:
+        select.select([fd], [], [])
+        chunk = os.read(fd, 64 * 1024)
+        if not chunk:
             break
+        if log:
+            log.write(chunk)
+        lines = (partial + chunk).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            yield line.decode('utf8', 'replace')
+    if partial:
+        yield partial.decode('utf8', 'replace')
 
 
 def render_cheetah(template_file, destination_directory, cheetah_input):
@@ -489,11 +643,13 @@ def render_cheetah(template_file, destination_directory, cheetah_input):
 
 
 def tag_exists_locally(tag):
-    (status, output) = getstatusoutput("git tag | grep %s" % tag)
-    if status > 0:
-        return False
-    else:
-        return True
+    context = get_context()
+    if context is not None:
+        return context.refs.has_tag(tag)
+
+    result = run_argv(["git", "rev-parse", "--quiet", "--verify",
+        "refs/tags/%s" % tag])
+    return result.status == 0
 
 
 def tag_exists_remotely(tag):
@@ -511,13 +667,39 @@ def tag_exists_remotely(tag):
 
 
 def get_local_tag_sha1(tag):
-    tag_sha1 = run_command(
-        "git ls-remote ./. --tag %s | awk '{ print $1 ; exit }'"
-        % tag)
+    context = get_context()
+    if context is not None:
+        return context.refs.tag_sha1(tag) or ""
+
+    tag_sha1 = run_argv(["git", "ls-remote", "./.", "--tag", tag]).first_field()
     tag_sha1 = extract_sha1(tag_sha1)
     return tag_sha1
 
 
+def _resolve_object(name):
+    """
+    Return the SHA1 of a git object, without starting git when the
+    repository's object reader is already running.
+    """
+    repository = get_repository()
+    if repository is not None:
+        sha1 = repository.rev_parse(name)
+        if sha1 is not None:
+            return sha1
+    # Let git report the error:
+    return run_command(["git", "rev-parse", name])
+
+
+def _resolve_commit(name):
+    """ Return the SHA1 of the commit name is, or points to. """
+    repository = get_repository()
+    if repository is not None:
+        sha1 = repository.rev_parse("%s^{commit}" % name)
+        if sha1 is not None:
+            return sha1
+    return run_command(["git", "rev-list", "--max-count=1", name])
+
+
 def head_points_to_tag(tag):
     """
     Ensure the current git head is the same commit as tag.
@@ -527,8 +709,13 @@ def head_points_to_tag(tag):
     for now.
     """
     debug("Checking that HEAD commit is %s" % tag)
-    head_sha1 = run_command("git rev-list --max-count=1 HEAD")
-    tag_sha1 = run_command("git rev-list --max-count=1 %s" % tag)
+    context = get_context()
+    head_sha1 = None
+    if context is not None:
+        head_sha1 = context.head
+    if head_sha1 is None:
+        head_sha1 = _resolve_commit("HEAD")
+    tag_sha1 = _resolve_commit(tag)
     debug("   head_sha1 = %s" % head_sha1)
     debug("   tag_sha1 = %s" % tag_sha1)
     return head_sha1 == tag_sha1
@@ -542,21 +729,38 @@ def undo_tag(tag):
     """
     # Using --merge here as it appears to undo the changes in the commit,
     # but preserve any modified files:
-    output = run_command("git tag -d %s && git reset --merge HEAD^1" % tag)
+    try:
+        output = run_command(["git", "tag", "-d", tag])
+        context = get_context()
+        if context is not None:
+            context.refs.remove_tag(tag)
+        output = "\n".join([output,
+            run_command(["git", "reset", "--merge", "HEAD^1"])])
+    finally:
+        invalidate_context(refs=False)
     print(output)
 
 
-def get_remote_tag_sha1(tag):
+def get_remote_tag_sha1(tag, expected=None):
     """
     Get the SHA1 referenced by this git tag in the remote git repo.
     Will return "" if the git tag does not exist remotely.
+
+    The remote's tags are listed once and kept, see RemoteTags. expected is
+    the SHA1 we hope to find, a cached listing that disagrees is refreshed.
     """
-    # TODO: X11 forwarding messages can appear in this output, find a better way
     repo_url = get_git_repo_url()
     print("Checking for tag [%s] in git repo [%s]" % (tag, repo_url))
-    cmd = "git ls-remote %s --tag %s | awk '{ print $1 ; exit }'" % \
-            (repo_url, tag)
-    upstream_tag_sha1 = run_command(cmd)
+    context = get_context()
+    if context is not None:
+        remote_tags = context.remote_tags(repo_url)
+        upstream_tag_sha1 = remote_tags.tag_sha1(tag, expected)
+        if remote_tags.error:
+            debug("Listing tags of %s failed: %s" % (repo_url, remote_tags.error))
+        return upstream_tag_sha1
+
+    # TODO: X11 forwarding messages can appear in this output, find a better way
+    upstream_tag_sha1 = run_argv(["git", "ls-remote", repo_url, "--tag", tag]).first_field()
     upstream_tag_sha1 = extract_sha1(upstream_tag_sha1)
     return upstream_tag_sha1
 
@@ -579,7 +783,7 @@ def check_tag_exists(tag, offline=False):
     except:
         warn_out('remote.origin does not exist. Assuming --offline, for remote tag checking.\n')
         return
-    upstream_tag_sha1 = get_remote_tag_sha1(tag)
+    upstream_tag_sha1 = get_remote_tag_sha1(tag, expected=tag_sha1)
     if upstream_tag_sha1 == "":
         error_out(["Tag does not exist in remote git repo: %s" % tag,
             "You must tag, then git push and git push --tags"])
@@ -606,10 +810,11 @@ def get_spec_version_and_release(sourcedir, spec_file_name):
     if os.path.splitext(spec_file_name)[1] == ".tmpl":
         return scrape_version_and_release(spec_file_name)
 
-    command = ("""rpm -q --qf '%%{version}-%%{release}\n' --define """
-        """"_sourcedir %s" --define 'dist %%undefined' --specfile """
-        """%s 2> /dev/null | grep -e '^$' -v | head -1""" % (sourcedir, spec_file_name))
-    return run_command(command)
+    spec = query_spec(spec_file_name, [("_sourcedir", sourcedir),
+        ("dist", "%undefined")])
+    if spec is None:
+        return ""
+    return "%s-%s" % (spec.version, spec.release)
 
 
 def search_for(file_name, *args):
@@ -735,8 +940,7 @@ def scrape_version_and_release(template_file_name):
 def scl_to_rpm_option(scl, silent=None):
     """ Returns rpm option which disable or enable SC and print warning if needed """
     rpm_options = ""
-    cmd = "rpm --eval '%scl'"
-    output = run_command(cmd).rstrip()
+    output = eval_macro("%scl")
     if scl:
         if (output != scl) and (output != "%scl") and not silent:
             warn_out([
@@ -755,6 +959,13 @@ def scl_to_rpm_option(scl, silent=None):
     return rpm_options
 
 
+def scl_macros(scl):
+    """ The macros scl_to_rpm_option sets, for query_spec. """
+    if scl:
+        return [("scl", scl)]
+    return [("scl", None)]
+
+
 def get_project_name(tag=None, scl=None):
     """
     Extract the project name from the specified tag or a spec file in the
@@ -775,14 +986,12 @@ def get_project_name(tag=None, scl=None):
             name = search_for(file_path, r"\s*Name:\s*(.*?)\s*$")[0][0]
             return name
         else:
-            output = run_command(
-                "rpm -q --qf '%%{name}\n' %s --specfile %s 2> /dev/null | grep -e '^$' -v | head -1" %
-                (scl_to_rpm_option(scl, silent=True), file_path))
-            if not output:
+            spec = query_spec(file_path, scl_macros(scl))
+            if spec is None or not spec.name:
                 error_out(["Unable to determine project name from spec file: %s" % file_path,
                     "Try rpm -q --specfile %s" % file_path,
                     "Try rpmlint -i %s" % file_path])
-            return output
+            return spec.name
 
 
 def replace_version(line, new_version):
@@ -816,17 +1025,20 @@ def get_relative_project_dir(project_name, commit):
     resides, so we export a copy of the project's metadata from
     .tito/packages/ at the point in time of the tag we are building.
     """
-    cmd = "git show %s:%s/packages/%s" % (commit, tito_config_dir(),
-            project_name)
-    try:
-        (status, pkg_metadata) = getstatusoutput(cmd)
-    except:
-        cmd = "git show %s:%s/packages/%s" % (commit, "rel-eng",
-            project_name)
-        (status, pkg_metadata) = getstatusoutput(cmd)
-    tokens = pkg_metadata.strip().split(" ")
+    repository = get_repository()
+    if repository is not None:
+        pkg_metadata = repository.read_file(commit, "%s/packages/%s" %
+            (tito_config_dir(), project_name))
+        if pkg_metadata is not None:
+            tokens = decode_bytes(pkg_metadata, 'utf8').strip().split(" ")
+            debug("Got package metadata: %s" % tokens)
+            return tokens[1]
+
+    result = run_argv(["git", "show", "%s:%s/packages/%s" % (commit,
+        tito_config_dir(), project_name)])
+    tokens = result.output.strip().split(" ")
     debug("Got package metadata: %s" % tokens)
-    if status != 0:
+    if result.status != 0:
         return None
     return tokens[1]
 
@@ -847,21 +1059,242 @@ def get_relative_project_dir_cwd(git_root):
     return relative
 
 
+def _relative_git_dir(relative_dir):
+    # Accomodate standalone projects with specfile i root of git repo:
+    if relative_dir in ['/', './']:
+        return ""
+    return relative_dir
+
+
+def list_git_dir(commit, relative_dir):
+    """
+    Return the names of the files and directories in the project's directory
+    at the given commit, or None if it doesn't exist.
+    """
+    repository = get_repository()
+    if repository is not None:
+        return repository.list_tree("%s:%s" % (commit, _relative_git_dir(relative_dir)))
+
+    result = run_argv(["git", "ls-tree", "-z", "--name-only", "%s:%s" %
+        (commit, _relative_git_dir(relative_dir))])
+    if result.status != 0:
+        return None
+    return [f for f in result.stdout.split("\0") if f]
+
+
+def export_git_file(commit, relative_dir, name, dest):
+    """
+    Write a file from the project's directory at the given commit to dest,
+    straight from the git object database.
+    """
+    git_path = os.path.join(_relative_git_dir(relative_dir), name)
+    repository = get_repository()
+    if repository is not None:
+        content = repository.read_file(commit, git_path)
+        if content is not None:
+            dest_fh = open(dest, 'wb')
+            try:
+                dest_fh.write(content)
+            finally:
+                dest_fh.close()
+            return
+
+    dest_fh = open(dest, 'wb')
+    try:
+        proc = subprocess.Popen(['git', 'show', '%s:%s' % (commit, git_path)],
+            stdout=dest_fh, stderr=subprocess.PIPE)
+        output = decode_bytes(proc.communicate()[1], 'utf8')
+    finally:
+        dest_fh.close()
+    _check_command_status("git show %s:%s" % (commit, git_path),
+        proc.returncode, output)
+
+
+def get_spec_lines_from_git(commit, relative_dir):
+    """
+    Return the lines of the spec file in the project's directory at the
+    given commit without exporting anything, or None if there isn't one.
+    """
+    names = list_git_dir(commit, relative_dir)
+    if names is None:
+        return None
+    spec_files = [f for f in names if f.endswith(".spec")]
+    if not spec_files:
+        return None
+
+    spec_path = os.path.join(_relative_git_dir(relative_dir), spec_files[0])
+    repository = get_repository()
+    if repository is not None:
+        content = repository.read_file(commit, spec_path)
+        if content is None:
+            return None
+        return decode_bytes(content, 'utf8').splitlines()
+
+    result = run_argv(["git", "show", "%s:%s" % (commit, spec_path)])
+    if result.status != 0:
+        return None
+    return result.stdout.splitlines()
+
+
+def get_spec_file_references(spec_file_lines):
+    """
+    Returns the names of the Source and Patch files a spec file expects to
+    find next to it, macros not expanded. URLs and paths are skipped.
+    """
+    filenames = []
+    pattern = re.compile(r'^\s*(Source|Patch)\d*\s*:\s*(\S+)')
+    for line in spec_file_lines:
+        match = pattern.match(line)
+        if match:
+            name = match.group(2)
+            if "/" not in name:
+                filenames.append(name)
+    return filenames
+
+
+def get_source0(spec_file_lines):
+    """
+    Returns the file name of the spec's Source0, or None if it has none.
+    """
+    source_pattern = re.compile(r'^\s*Source0?\s*:\s*(\S+)')
+    for line in spec_file_lines:
+        match = source_pattern.match(line)
+        if match:
+            return os.path.basename(match.group(1))
+    return None
+
+
 def get_build_commit(tag, test=False):
     """ Return the git commit we should build. """
     if test:
         return get_latest_commit(".")
     else:
-        tag_sha1 = run_command(
-            "git ls-remote ./. --tag %s | awk '{ print $1 ; exit }'"
-            % tag)
-        tag_sha1 = extract_sha1(tag_sha1)
-        commit_id = run_command('git rev-list --max-count=1 %s' % tag_sha1)
+        context = get_context()
+        if context is not None:
+            commit_id = context.refs.tag_commit(tag)
+            if commit_id is not None:
+                return commit_id
+
+        tag_sha1 = get_local_tag_sha1(tag)
+        commit_id = run_command(["git", "rev-list", "--max-count=1", tag_sha1])
         return commit_id
 
 
+# Number of cached commits get_commit_count checks for being an ancestor of
+# the commit it counts for, before counting the whole history.
+COMMIT_COUNT_ANCESTORS = 5
+
+
 def get_commit_count(tag, commit_id):
     """ Return the number of commits between the tag and commit_id"""
+    context = get_context()
+    commit = None
+    if context is not None:
+        commit = context.repository.rev_parse("%s^{commit}" % commit_id)
+    if commit is None:
+        return _get_commit_count(tag, commit_id)
+
+    # Counts are kept in the git directory. A commit which was counted
+    # before, or has a counted ancestor, costs at most a couple of git
+    # commands instead of walking the whole history.
+    cache = context.commit_counts
+    tag_commit = context.refs.tag_commit(tag)
+    if tag_commit is not None:
+        section = "tag %s %s" % (tag, tag_commit)
+        count = _cached_commit_count(cache, section, commit, [tag_commit])
+        if count is None:
+            count = _describe_commit_count(tag, commit)
+            # -1 remembers that git describe didn't find the tag
+            cache.put(section, commit, count)
+        if count >= 0:
+            return count
+
+    debug("git describe of tag %s failed" % tag)
+    debug("going to use number of commits from initial commit")
+    roots = None
+    if context.head is not None:
+        roots = _root_commits(cache, context.head)
+    if not roots:
+        return 0
+    section = "roots %s" % " ".join(roots)
+    count = _cached_commit_count(cache, section, commit, roots)
+    if count is None:
+        result = run_argv(["git", "rev-list", "--count", commit] +
+            ["^%s" % root for root in roots])
+        if result.status != 0:
+            return 0
+        count = int(result.output)
+        cache.put(section, commit, count)
+    return count
+
+
+def _is_ancestor(ancestor, commit):
+    return run_argv(["git", "merge-base", "--is-ancestor", ancestor, commit]).status == 0
+
+
+def _cached_commit_count(cache, section, commit, exclude):
+    """
+    Return the number of commits reachable from commit but not from any of
+    exclude, from the cache or from the count of a cached ancestor. None if
+    there is neither.
+    """
+    count = cache.get(section, commit)
+    if count is not None:
+        return count
+    for (ancestor, ancestor_count) in cache.recent(section, COMMIT_COUNT_ANCESTORS):
+        if ancestor_count < 0 or not _is_ancestor(ancestor, commit):
+            continue
+        # Everything the ancestor reaches is already in its count
+        result = run_argv(["git", "rev-list", "--count", commit, "^%s" % ancestor] +
+            ["^%s" % sha1 for sha1 in exclude])
+        if result.status == 0:
+            count = ancestor_count + int(result.output)
+            cache.put(section, commit, count)
+            return count
+    return None
+
+
+def _root_commits(cache, commit):
+    """ Return the sorted SHA1s of the root commits of commit, or None. """
+    roots = cache.get("roots", commit)
+    if roots is not None:
+        return roots
+    argv = ["git", "rev-list", "--max-parents=0", commit]
+    known = []
+    for (ancestor, ancestor_roots) in cache.recent("roots", COMMIT_COUNT_ANCESTORS):
+        if _is_ancestor(ancestor, commit):
+            # Only look for roots merged in since
+            argv.append("^%s" % ancestor)
+            known = ancestor_roots
+            break
+    result = run_argv(argv)
+    if result.status != 0:
+        return None
+    roots = sorted(set(known + result.lines()))
+    cache.put("roots", commit, roots)
+    return roots
+
+
+def _describe_commit_count(tag, commit):
+    """
+    Return the number of commits since the tag according to git describe,
+    -1 if it doesn't describe commit in terms of the tag.
+    """
+    # git describe returns either a tag-commitcount-gSHA1 OR
+    # just the tag.
+    result = run_argv(["git", "describe", "--match=%s" % tag, commit])
+    debug("tag - %s" % tag)
+    debug("output - %s" % result.output)
+    if result.status != 0:
+        return -1
+    if tag != result.output:
+        # tag-commitcount-gSHA1, we want the penultimate value
+        return int(result.output.split("-")[-2])
+    return 0
+
+
+def _get_commit_count(tag, commit_id):
+    """ get_commit_count without a git checkout to cache counts in. """
     # git describe returns either a tag-commitcount-gSHA1 OR
     # just the tag.
     #
@@ -871,23 +1304,22 @@ def get_commit_count(tag, commit_id):
     #     return 0
     # else:
     #     parse the count from the output
-    (status, output) = getstatusoutput(
-        "git describe --match=%s %s" % (tag, commit_id))
+    result = run_argv(["git", "describe", "--match=%s" % tag, commit_id])
+    output = result.output
 
     debug("tag - %s" % tag)
     debug("output - %s" % output)
 
-    if status != 0:
-        debug("git describe of tag %s failed (%d)" % (tag, status))
+    if result.status != 0:
+        debug("git describe of tag %s failed (%d)" % (tag, result.status))
         debug("going to use number of commits from initial commit")
-        (status, output) = getstatusoutput(
-            "git rev-list --max-parents=0 HEAD")
-        if status == 0:
+        result = run_argv(["git", "rev-list", "--max-parents=0", "HEAD"])
+        if result.status == 0:
             # output is now inital commit
-            (status, output) = getstatusoutput(
-                "git rev-list %s..%s --count" % (output, commit_id))
-            if status == 0:
-                return output
+            result = run_argv(["git", "rev-list", "%s..%s" % (result.output, commit_id),
+                "--count"])
+            if result.status == 0:
+                return result.output
         return 0
 
     if tag != output:
@@ -900,7 +1332,7 @@ def get_commit_count(tag, commit_id):
 
 def get_latest_commit(path="."):
     """ Return the latest git commit for the given path. """
-    commit_id = run_command("git log --pretty=format:%%H --max-count=1 %s" % path)
+    commit_id = run_command(["git", "log", "--pretty=format:%H", "--max-count=1", path])
     return commit_id
 
 
@@ -910,17 +1342,79 @@ def get_commit_timestamp(sha1_or_tag):
     keep the hash the same on all .tar.gz's we generate for a particular
     version regardless of when they are generated.
     """
-    output = run_command(
-        "git rev-list --timestamp --max-count=1 %s | awk '{print $1}'"
-        % sha1_or_tag)
-    return output
+    repository = get_repository()
+    if repository is not None:
+        timestamp = repository.commit_timestamp(sha1_or_tag)
+        if timestamp is not None:
+            return str(timestamp)
+
+    return run_argv(["git", "rev-list", "--timestamp", "--max-count=1",
+        sha1_or_tag]).first_field()
+
+
+class _TarExtractor(object):
+    """
+    Extracts a tar stream written to it into a directory with tar(1).
+    """
+    mode = 'wb'
+
+    def __init__(self, extract_dir):
+        args = ['tar', '-x', '-C', extract_dir, '-f', '-']
+        self.command = " ".join(args)
+        self.errors = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+            stdout=self.errors, stderr=subprocess.STDOUT)
+        self.status = None
+        self.output = ""
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except IOError as e:
+            # tar exits as soon as it sees the end of the archive, without
+            # reading the padding after it. If it died of something else
+            # its exit status will tell.
+            if e.errno != errno.EPIPE:
+                raise
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.status is not None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        self.status = self.proc.wait()
+        self.errors.seek(0)
+        self.output = decode_bytes(self.errors.read(), 'utf8')
+        self.errors.close()
 
 
 def create_tgz(git_root, prefix, commit, relative_dir,
-    dest_tgz):
+    dest_tgz, compression_threads=None, compression=None,
+    cache=None, extract_dir=None, member_callback=None):
     """
     Create a .tar.gz from a projects source in git.
+
+    compression selects another format, see tito.compress. With
+    compression_threads set the tarball is compressed in that many threads.
+    If a TarballCache is given, the tarball is copied from it when it was
+    created before, and stored in it otherwise.
+
+    With extract_dir set the sources are also extracted there, from the same
+    stream the tarball is written from. member_callback is called with the
+    path of every file and directory in the tarball as it is written, except
+    when it comes from the cache.
     """
+    # Only needed when building, not for every tito command:
+    from tito.compress import DEFAULT_FORMAT, compressor_id, open_compressed
+    from tito.tar import TarFixer, TeeFile
+
+    compression = compression or DEFAULT_FORMAT
     os.chdir(os.path.abspath(git_root))
     timestamp = get_commit_timestamp(commit)
 
@@ -929,13 +1423,20 @@ def create_tgz(git_root, prefix, commit, relative_dir,
     if relative_git_dir in ['/', './']:
         relative_git_dir = ""
 
-    basename = os.path.splitext(dest_tgz)[0]
-    initial_tar = "%s.initial" % basename
+    if cache is not None:
+        tree_id = _resolve_object("%s:%s" % (commit, relative_git_dir))
+        cache_key = cache.key(tree_id, prefix, timestamp, commit,
+            compressor_id(compression, compression_threads))
+        if cache.get(cache_key, dest_tgz):
+            debug("Copied %s from the tarball cache" % os.path.basename(dest_tgz))
+            if extract_dir:
+                run_command(["tar", "-x", "-C", extract_dir, "-f", dest_tgz])
+            return ""
 
     # command to generate a git-archive
-    git_archive_cmd = 'git archive --format=tar --prefix=%s/ %s:%s --output=%s' % (
-        prefix, commit, relative_git_dir, initial_tar)
-    run_command(git_archive_cmd)
+    git_archive_args = ['git', 'archive', '--format=tar',
+        '--prefix=%s/' % prefix, '%s:%s' % (commit, relative_git_dir)]
+    git_archive_cmd = ' '.join(git_archive_args)
 
     # Run git-archive separately if --debug was specified.
     # This allows us to detect failure early.
@@ -943,16 +1444,78 @@ def create_tgz(git_root, prefix, commit, relative_dir,
     debug('git-archive fails if relative dir is not in git tree',
         '%s > /dev/null' % git_archive_cmd)
 
-    fixed_tar = "%s.tar" % basename
-    fixed_tar_fh = open(fixed_tar, 'wb')
+    # The archive is streamed straight from git through the TarFixer and
+    # into the compressor, nothing but the final tarball ever touches the disk.
+    # If we need the sources extracted too, tar gets a copy of the stream so
+    # we don't have to decompress the tarball we just compressed.
+    fix_error = None
+    archive_proc = None
+    compressed_fh = None
+    extractor = None
+    tarfixer = None
+    # Whether git archive's output was read to the end, or it was killed:
+    drained = False
+    dest_fh = open(dest_tgz, 'wb')
     try:
-        tarfixer = TarFixer(open(initial_tar, 'rb'), fixed_tar_fh, timestamp, commit)
-        tarfixer.fix()
+        archive_proc = subprocess.Popen(git_archive_args,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        compressed_fh = open_compressed(dest_fh, compression, compression_threads)
+        out_fh = compressed_fh
+        if extract_dir:
+            extractor = _TarExtractor(extract_dir)
+            out_fh = TeeFile(compressed_fh, extractor)
+        tarfixer = TarFixer(archive_proc.stdout, out_fh, timestamp, commit)
+        tarfixer.member_callback = member_callback
+        try:
+            tarfixer.fix()
+        except IOError:
+            # A truncated stream usually means git archive died on us, in
+            # which case its exit status gives the better error message.
+            fix_error = sys.exc_info()[1]
+            if archive_proc.poll() is None:
+                archive_proc.kill()
+        drained = True
     finally:
-        fixed_tar_fh.close()
-
-    # It's a pity we can't use Python's gzip, but it doesn't offer an equivalent of -n
-    return run_command("gzip -n -c < %s > %s" % (fixed_tar, dest_tgz))
+        # Whatever was set up before an error is cleaned up, and the error
+        # is the one reported:
+        try:
+            if compressed_fh is not None:
+                compressed_fh.close()
+            if extractor:
+                extractor.close()
+            if archive_proc is not None:
+                if not drained and archive_proc.poll() is None:
+                    archive_proc.kill()
+                archive_proc.stdout.close()
+                archive_output = decode_bytes(archive_proc.stderr.read(), 'utf8')
+                archive_proc.stderr.close()
+                archive_status = archive_proc.wait()
+        finally:
+            dest_fh.close()
+
+    # The TarFixer stops reading once it sees the end of archive marker, so
+    # git may be killed by SIGPIPE while writing out the last of its padding.
+    if tarfixer.done and archive_status in (-signal.SIGPIPE, 128 + signal.SIGPIPE):
+        archive_status = 0
+
+    _check_command_status(git_archive_cmd, archive_status, archive_output)
+    _check_command_status("%s > %s" % (compressed_fh.command, dest_tgz),
+        compressed_fh.status, "")
+    if extractor:
+        _check_command_status(extractor.command, extractor.status,
+            extractor.output)
+    if fix_error:
+        raise fix_error
+
+    if cache is not None:
+        try:
+            cache.put(cache_key, dest_tgz)
+        except (IOError, OSError):
+            # The tarball is fine, it just won't be reused
+            e = sys.exc_info()[1]
+            debug("Unable to store %s in the tarball cache: %s" % (
+                os.path.basename(dest_tgz), e))
+    return ""
 
 
 def get_git_repo_url():
@@ -961,7 +1524,10 @@ def get_git_repo_url():
 
     Uses ~/.git/config remote origin url.
     """
-    return run_command("git config remote.origin.url")
+    context = get_context()
+    if context is not None and context.remote_url is not None:
+        return context.remote_url
+    return run_command(["git", "config", "--get", "remote.origin.url"])
 
 
 def get_latest_tagged_version(package_name):
@@ -978,8 +1544,13 @@ def get_latest_tagged_version(package_name):
     if not os.path.exists(file_path):
         return None
 
-    output = run_command("awk '{ print $1 ; exit }' %s" % file_path)
-    if output is None or output.strip() == "":
+    metadata_file = open(file_path, 'r')
+    try:
+        fields = metadata_file.readline().split()
+    finally:
+        metadata_file.close()
+    output = fields and fields[0] or ""
+    if output.strip() == "":
         error_out("Error looking up latest tagged version in: %s" % file_path)
 
     return output
@@ -1024,6 +1595,11 @@ def mkdir_p(path, mode=511):
             raise
 
 
+# Builder, tagger and releaser classes by name. Nothing is imported until a
+# class is asked for, so e.g. "tito build --help" never loads the releasers.
+_classes = {}
+
+
 def get_class_by_name(name):
     """
     Get a Python class specified by it's fully qualified name.
@@ -1032,14 +1608,16 @@ def get_class_by_name(name):
     a Class object.
     """
     name = normalize_class_name(name)
-    # Split name into module and class name:
-    tokens = name.split(".")
-    class_name = tokens[-1]
-    module = '.'.join(tokens[0:-1])
+    if name not in _classes:
+        # Split name into module and class name:
+        tokens = name.split(".")
+        class_name = tokens[-1]
+        module = '.'.join(tokens[0:-1])
 
-    debug("Importing %s" % name)
-    mod = __import__(module, globals(), locals(), [class_name])
-    return getattr(mod, class_name)
+        debug("Importing %s" % name)
+        mod = __import__(module, globals(), locals(), [class_name])
+        _classes[name] = getattr(mod, class_name)
+    return _classes[name]
 
 
 def increase_version(version_string):
@@ -1074,15 +1652,38 @@ def find_wrote_in_rpmbuild_output(output):
     Parse the output from rpmbuild looking for lines beginning with
     "Wrote:". Return a list of file names for each path found.
     """
-    paths = []
-    look_for = "Wrote: "
+    rpmbuild_output = RpmbuildOutput()
     for line in output.split('\n'):
-        if line.startswith(look_for):
-            paths.append(line[len(look_for):])
-            debug("Found wrote line: %s" % paths[-1])
-    if not paths:
-        error_out("Unable to locate 'Wrote: ' lines in rpmbuild output: '%s'" % output)
-    return paths
+        rpmbuild_output(line)
+    return rpmbuild_output.wrote(output)
+
+
+class RpmbuildOutput(object):
+    """
+    A run_command_print line callback picking what we need out of
+    rpmbuild's output as it goes by, so the output never has to be kept.
+    """
+    look_for = "Wrote: "
+
+    def __init__(self):
+        self.paths = []
+        self.failed_build_dependencies = False
+
+    def __call__(self, line):
+        if line.startswith(self.look_for):
+            self.paths.append(line[len(self.look_for):])
+            debug("Found wrote line: %s" % self.paths[-1])
+        elif 'Failed build dependencies' in line:
+            self.failed_build_dependencies = True
+
+    def wrote(self, output):
+        """
+        Return the file names of the "Wrote:" lines seen, exits if there
+        were none. output is what to show in the error message.
+        """
+        if not self.paths:
+            error_out("Unable to locate 'Wrote: ' lines in rpmbuild output: '%s'" % output)
+        return self.paths
 
 
 def compare_version(version1, version2):
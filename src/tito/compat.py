@@ -18,20 +18,65 @@
 """
 import os
 import sys
+
+from tito.trace import trace_command
+
 ENCODING = sys.getdefaultencoding()
 PY2 = sys.version_info[0] == 2
 if PY2:
     import commands
     from ConfigParser import NoOptionError
     from ConfigParser import RawConfigParser
+    from Queue import Empty, Queue
     from StringIO import StringIO
-    import xmlrpclib
 else:
     import subprocess
     from configparser import NoOptionError
     from configparser import RawConfigParser
     from io import StringIO
-    import xmlrpc.client as xmlrpclib
+    from queue import Empty, Queue
+
+
+class _LazyModule(object):
+    """
+    Stands in for a module which is only imported once one of its
+    attributes is used, for modules few tito commands need and which take
+    a while to import.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attr)
+
+
+if PY2:
+    xmlrpclib = _LazyModule('xmlrpclib')
+else:
+    xmlrpclib = _LazyModule('xmlrpc.client')
+
+
+def create_pool(processes, fork=False, **kwargs):
+    """
+    Return a multiprocessing pool of processes threads, or with fork of
+    processes forked from this one. kwargs go to the pool.
+
+    Threads are enough to wait for commands, or for C code which releases
+    the GIL. multiprocessing takes a while to import, so only what uses a
+    pool imports it, here.
+    """
+    import multiprocessing
+    if not fork:
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(processes, **kwargs)
+    if hasattr(multiprocessing, 'get_context'):
+        multiprocessing = multiprocessing.get_context('fork')
+    return multiprocessing.Pool(processes, **kwargs)
 
 
 def decode_bytes(x, source_encoding):
@@ -53,10 +98,13 @@ def getstatusoutput(cmd):
     Returns (status, output) of executing cmd in a shell.
     Supports Python 2.4 and 3.x.
     """
-    if PY2:
-        return commands.getstatusoutput(cmd)
-    else:
-        return subprocess.getstatusoutput(cmd)
+    with trace_command(cmd) as record:
+        if PY2:
+            (status, output) = commands.getstatusoutput(cmd)
+        else:
+            (status, output) = subprocess.getstatusoutput(cmd)
+        record.status = status
+    return (status, output)
 
 
 def getoutput(cmd):
@@ -0,0 +1,379 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Compression of source tarballs.
+"""
+
+import bz2
+import collections
+import struct
+import subprocess
+import zlib
+
+from tito.compat import create_pool
+from tito.exception import TitoException
+
+# Input is split into blocks of exactly this size no matter how many threads
+# are in use, which is what makes the output reproducible.
+BLOCK_SIZE = 128 * 1024
+
+# bzip2 works on blocks of up to 900k anyway, so compressing them separately
+# costs next to nothing.
+BZ2_BLOCK_SIZE = 900 * 1000
+
+# Fixed for the same reason as BLOCK_SIZE, xz picks one based on the
+# compression level otherwise.
+XZ_BLOCK_SIZE = 24 * 1024 * 1024
+
+DEFAULT_FORMAT = 'gz'
+
+# Tarball file name extensions of the supported formats.
+TARBALL_EXTENSIONS = {
+    'gz': '.tar.gz',
+    'bz2': '.tar.bz2',
+    'xz': '.tar.xz',
+    'zst': '.tar.zst',
+}
+
+# Other extensions a spec file might use for them.
+EXTENSION_ALIASES = [
+    ('.tgz', 'gz'),
+    ('.tbz2', 'bz2'),
+    ('.tbz', 'bz2'),
+    ('.txz', 'xz'),
+    ('.tzst', 'zst'),
+]
+
+COMPRESSION_LEVEL = 6
+
+# Equivalent of gzip -n: no file name, mtime 0, "Unix" as the OS.
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+
+# An empty, final, fixed Huffman block terminating the deflate stream.
+DEFLATE_END = b"\x03\x00"
+
+
+def compress_block(data, level=COMPRESSION_LEVEL):
+    """
+    Compress one block into a raw deflate stream ending on a byte boundary
+    so the blocks can simply be concatenated.
+
+    zlib releases the GIL while compressing so this is run in threads.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compress_bz2_block(data):
+    """
+    Compress one block into a complete bzip2 stream. bzip2 happily
+    decompresses several streams concatenated together.
+    """
+    return bz2.compress(data, 9)
+
+
+def format_from_filename(filename):
+    """
+    Return the compression format a tarball file name implies, or None if
+    it doesn't look like a tarball we know how to create.
+    """
+    for compression, extension in TARBALL_EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    for extension, compression in EXTENSION_ALIASES:
+        if filename.endswith(extension):
+            return compression
+    return None
+
+
+def tarball_extension(compression):
+    return TARBALL_EXTENSIONS[compression]
+
+
+def parse_compression_format(value):
+    value = str(value).strip().strip('"').lower()
+    if value.startswith(".tar."):
+        value = value[len(".tar."):]
+    if value not in TARBALL_EXTENSIONS:
+        raise TitoException("Unsupported tarball compression: %s (use one of %s)" %
+            (value, ", ".join(sorted(TARBALL_EXTENSIONS))))
+    return value
+
+
+# "<tool> --version" of the external compressors, by tool.
+_tool_versions = {}
+
+
+def _external_args(compression, threads):
+    """
+    Return the command line of the external tool compressing a format, or
+    None if we compress it ourselves.
+    """
+    if compression == 'gz' and not threads:
+        # It's a pity we can't use Python's gzip, but it doesn't offer an
+        # equivalent of -n
+        return ['gzip', '-n', '-c']
+    if compression == 'xz':
+        # xz writes a different stream in single threaded mode, so make sure
+        # the multi-threaded encoder is used even when asked for one thread.
+        return ['xz', '-c', '-T%d' % max(2, threads),
+            '--block-size=%d' % XZ_BLOCK_SIZE]
+    if compression == 'zst':
+        return ['zstd', '-q', '-c', '-T%d' % max(1, threads)]
+    return None
+
+
+def tool_version(tool):
+    """
+    Return the first line "<tool> --version" prints, looked up once. Empty
+    if the tool can't tell.
+    """
+    if tool not in _tool_versions:
+        try:
+            proc = subprocess.Popen([tool, '--version'], stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        except OSError:
+            output = b""
+        lines = output.decode('utf8', 'replace').strip().splitlines()
+        _tool_versions[tool] = lines and lines[0].strip() or ""
+    return _tool_versions[tool]
+
+
+def compressor_id(compression=DEFAULT_FORMAT, threads=0):
+    """
+    Identifies how open_compressed compresses a format, two tarballs created
+    with the same id are identical. For the external tools it includes
+    their version, a new one may compress differently.
+    """
+    args = _external_args(compression, threads)
+    if args is not None:
+        return "%s-%s-%s" % (compression, args[0], tool_version(args[0]))
+    if compression == 'gz':
+        return "gz-parallel-%d-%d" % (BLOCK_SIZE, COMPRESSION_LEVEL)
+    if compression == 'bz2':
+        return "bz2-parallel-%d" % BZ2_BLOCK_SIZE
+    return compression
+
+
+def open_compressed(fileobj, compression=DEFAULT_FORMAT, threads=0):
+    """
+    Return a write only file object which compresses everything written to
+    it into fileobj.
+
+    The output only depends on the data, the compressor_id() and, for gz,
+    whether threads is 0: gzip(1) and our own parallel gzip write different
+    streams. Any number of threads above 0 gives the same output. After
+    close() the status attribute holds the exit status of the compressor.
+    """
+    if compression not in TARBALL_EXTENSIONS:
+        raise TitoException("Unsupported tarball compression: %s" % compression)
+    args = _external_args(compression, threads)
+    if args is not None:
+        return ExternalCompressor(fileobj, args)
+    if compression == 'gz':
+        return ParallelGzipFile(fileobj, threads)
+    return ParallelBzip2File(fileobj, threads)
+
+
+def parse_compression_threads(value):
+    """
+    Convert a thread count from the configuration into an int. "auto" means
+    one thread per CPU, 0 means .tar.gz files are compressed by an external
+    gzip process.
+    """
+    value = str(value).strip().strip('"')
+    if value.lower() == "auto":
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    try:
+        threads = int(value)
+    except ValueError:
+        raise TitoException("Invalid number of compression threads: %s" % value)
+    if threads < 0:
+        raise TitoException("Invalid number of compression threads: %s" % value)
+    return threads
+
+
+class ExternalCompressor(object):
+    """
+    Feeds everything written to it to a compression program's stdin.
+    """
+    mode = 'wb'
+
+    def __init__(self, fileobj, args):
+        self.command = " ".join(args)
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=fileobj)
+        self.status = None
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def flush(self):
+        self.proc.stdin.flush()
+
+    def close(self):
+        if self.status is None:
+            self.proc.stdin.close()
+            self.status = self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ParallelCompressor(object):
+    """
+    A write only file object compressing the data in fixed size blocks on
+    a pool of threads. Subclasses define how a block is compressed and what
+    goes around the compressed blocks.
+    """
+    mode = 'wb'
+    block_size = BLOCK_SIZE
+
+    def __init__(self, fileobj, threads, block_size=None):
+        self.fileobj = fileobj
+        self.threads = max(1, threads)
+        if block_size:
+            self.block_size = block_size
+        self.command = "%s (%d threads)" % (self.__class__.__name__, self.threads)
+        self.status = None
+
+        self.pool = create_pool(self.threads)
+        # Blocks handed to the pool in the order they have to be written.
+        # Bounded so we don't buffer the whole tarball in memory when the
+        # producer is faster than the compressors.
+        self.pending = collections.deque()
+        self.max_pending = self.threads * 2
+
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+
+        self.fileobj.write(self.header())
+
+    def header(self):
+        return b""
+
+    def trailer(self):
+        return b""
+
+    def compress_args(self, block):
+        raise NotImplementedError()
+
+    def update(self, data):
+        """ Called with all uncompressed data in order. """
+        pass
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        if not data:
+            return
+
+        self.update(data)
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            data = b"".join(self.buffer)
+            offset = 0
+            while len(data) - offset >= self.block_size:
+                self._submit(data[offset:offset + self.block_size])
+                offset += self.block_size
+            self.buffer = [data[offset:]]
+            self.buffered = len(data) - offset
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(*self.compress_args(block)))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffered:
+                self._submit(b"".join(self.buffer))
+            self.buffer = []
+            while self.pending:
+                self._write_next()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+
+        self.fileobj.write(self.trailer())
+        self.status = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ParallelGzipFile(ParallelCompressor):
+    """
+    Produces a gzip stream.
+
+    Every block is compressed independently and flushed to a byte boundary,
+    the way pigz does it. The result is a single member gzip file any gzip
+    implementation can read. It is not byte-for-byte what "gzip -n" creates
+    but it is always the same for the same input, whatever the number of
+    threads.
+    """
+    block_size = BLOCK_SIZE
+
+    def __init__(self, fileobj, threads, block_size=None,
+            level=COMPRESSION_LEVEL):
+        self.level = level
+        self.crc = zlib.crc32(b"")
+        self.size = 0
+        ParallelCompressor.__init__(self, fileobj, threads, block_size)
+
+    def header(self):
+        return GZIP_HEADER
+
+    def compress_args(self, block):
+        return compress_block, (block, self.level)
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+    def trailer(self):
+        return DEFLATE_END + struct.pack("<II", self.crc & 0xffffffff,
+            self.size & 0xffffffff)
+
+
+class ParallelBzip2File(ParallelCompressor):
+    """
+    Produces a series of bzip2 streams, one per block, like pbzip2 does.
+    """
+    block_size = BZ2_BLOCK_SIZE
+
+    def compress_args(self, block):
+        return compress_bz2_block, (block,)
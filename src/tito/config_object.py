@@ -14,8 +14,7 @@
 Shared code for builder and tagger class
 """
 
-import os
-from tito.common import find_git_root, tito_config_dir
+from tito.common import get_required_context
 
 
 class ConfigObject(object):
@@ -37,5 +36,7 @@ def __init__(self, config=None):
                 self.config.set(section, options,
                         config.get(section, options))
 
-        self.git_root = find_git_root()
-        self.rel_eng_dir = os.path.join(self.git_root, tito_config_dir())
+        # Shared by every builder, tagger and releaser of this invocation:
+        self.context = get_required_context()
+        self.git_root = self.context.git_root
+        self.rel_eng_dir = self.context.rel_eng_dir
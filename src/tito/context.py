@@ -0,0 +1,172 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Facts about the git checkout tito is working in, looked up once per
+invocation no matter how many builders, taggers and releasers ask.
+"""
+
+import os
+
+from tito.gitrepo import RemoteTags, close_repositories, \
+    forget_repositories, get_repository
+
+# Where remote tags are cached between invocations, and whether to list
+# them again anyway. Set up by the CLI.
+_remote_tag_cache = None
+_refresh_remote = False
+
+
+class RepositoryContext(object):
+    """
+    The git root, tito config directory, git user, HEAD and remote URL of a
+    checkout. Each is looked up the first time it is asked for and kept
+    until invalidate() is called.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self._facts = {}
+        self._remote_tags = {}
+        self._commit_counts = None
+
+    def _fact(self, name, lookup):
+        if name not in self._facts:
+            self._facts[name] = lookup()
+        return self._facts[name]
+
+    @property
+    def git_root(self):
+        return self.repository.path
+
+    @property
+    def config_dir(self):
+        """ "rel-eng" for old tito projects and ".tito" for recent ones. """
+        def lookup():
+            if os.path.isdir(os.path.join(self.git_root, ".tito")):
+                return ".tito"
+            return "rel-eng"
+        return self._fact("config_dir", lookup)
+
+    @property
+    def rel_eng_dir(self):
+        return os.path.join(self.git_root, self.config_dir)
+
+    @property
+    def head(self):
+        """ SHA1 of the commit HEAD points to, None on an unborn branch. """
+        return self._fact("head", lambda: self.repository.rev_parse("HEAD^{commit}"))
+
+    @property
+    def git_user(self):
+        """ user.name from the git config, None if it isn't set. """
+        return self._fact("git_user", lambda: self.repository.config("user.name"))
+
+    @property
+    def git_email(self):
+        """ user.email from the git config, None if it isn't set. """
+        return self._fact("git_email", lambda: self.repository.config("user.email"))
+
+    @property
+    def remote_url(self):
+        """ remote.origin.url from the git config, None if it isn't set. """
+        return self._fact("remote_url",
+            lambda: self.repository.config("remote.origin.url"))
+
+    @property
+    def refs(self):
+        """ The RefIndex of the checkout's tags. """
+        return self.repository.refs
+
+    def remote_tags(self, url):
+        """
+        The RemoteTags of a remote repository, listed at most once per
+        invocation.
+        """
+        if url not in self._remote_tags:
+            self._remote_tags[url] = RemoteTags(url, _remote_tag_cache,
+                _refresh_remote)
+        return self._remote_tags[url]
+
+    @property
+    def commit_counts(self):
+        """ The CommitCountCache of the checkout, kept in its git directory. """
+        if self._commit_counts is None:
+            from tito.cache import CommitCountCache
+            self._commit_counts = CommitCountCache(os.path.join(
+                self.repository.git_dir, "tito", "commit-counts.json"))
+        return self._commit_counts
+
+    def invalidate(self, refs=True):
+        """
+        Forget everything looked up so far. Needed after tito itself changed
+        the checkout, e.g. by committing or removing a tag. Pass refs=False
+        when the RefIndex was updated along with the change.
+        """
+        self._facts = {}
+        self.repository.invalidate(refs=refs)
+
+
+# Contexts by the top level directory of their checkout.
+_contexts = {}
+
+
+def get_context(path=None):
+    """
+    Return the context of the checkout the directory (by default the current
+    one) is in, or None if it isn't in one.
+    """
+    repository = get_repository(path)
+    if repository is None:
+        return None
+    context = _contexts.get(repository.path)
+    if context is None or context.repository is not repository:
+        context = RepositoryContext(repository)
+        _contexts[repository.path] = context
+    return context
+
+
+def invalidate_context(path=None, refs=True):
+    context = get_context(path)
+    if context is not None:
+        context.invalidate(refs=refs)
+
+
+def forget_contexts(directory):
+    """
+    Drop the contexts of all checkouts in or under directory, for components
+    which remove a checkout and may clone a different one in its place
+    (dist-git working directories).
+    """
+    forget_repositories(directory)
+    directory = os.path.abspath(directory)
+    for root in list(_contexts):
+        if root == directory or root.startswith(directory.rstrip(os.sep) + os.sep):
+            del _contexts[root]
+
+
+def set_remote_tag_cache(cache, refresh=False):
+    """
+    Use the RemoteTagCache cache (None for no cache) for remote tag
+    lookups. With refresh, remote tags are listed again once before the
+    cache is used.
+    """
+    global _remote_tag_cache, _refresh_remote
+    _remote_tag_cache = cache
+    _refresh_remote = refresh
+
+
+def reset_contexts():
+    """ Start over, used at the beginning of every CLI invocation. """
+    close_repositories()
+    _contexts.clear()
+    set_remote_tag_cache(None)
@@ -0,0 +1,401 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Long lived access to a git repository's object database.
+
+Looking up an object through "git cat-file --batch" costs a line of IO
+instead of a fork and exec of git, which adds up quickly when releasing to a
+lot of targets.
+"""
+
+import atexit
+import os
+import subprocess
+
+from tito.compat import decode_bytes, encode_bytes
+from tito.exception import TitoException
+
+
+class RefIndex(object):
+    """
+    Every tag of a repository, read with one "git for-each-ref" so finding
+    a tag is a dict lookup no matter how many tags there are.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        # tag name -> (SHA1 of the tag, SHA1 of the commit it points to)
+        self.tags = {}
+        proc = subprocess.Popen(['git', 'for-each-ref',
+            '--format=%(objectname) %(*objectname) %(refname)', 'refs/tags/'],
+            cwd=repository.path, stdout=subprocess.PIPE)
+        output = decode_bytes(proc.communicate()[0], 'utf8')
+        for line in output.splitlines():
+            # Lightweight tags have nothing to peel: "<sha1>  refs/tags/<tag>"
+            (sha1, peeled, refname) = line.split(" ", 2)
+            self.tags[refname[len("refs/tags/"):]] = (sha1, peeled or sha1)
+
+    def has_tag(self, tag):
+        return tag in self.tags
+
+    def tag_sha1(self, tag):
+        """
+        Return the SHA1 the tag ref points to, what "git ls-remote" shows,
+        or None if there is no such tag.
+        """
+        if tag not in self.tags:
+            return None
+        return self.tags[tag][0]
+
+    def tag_commit(self, tag):
+        """ Return the SHA1 of the commit a tag points to, or None. """
+        if tag not in self.tags:
+            return None
+        return self.tags[tag][1]
+
+    def add_tag(self, tag):
+        """ Record a tag that was just created. """
+        sha1 = self.repository.rev_parse("refs/tags/%s" % tag)
+        if sha1 is None:
+            self.remove_tag(tag)
+            return
+        # Tags don't necessarily point to commits, but ours always do
+        commit = self.repository.rev_parse("refs/tags/%s^{}" % tag)
+        self.tags[tag] = (sha1, commit)
+
+    def remove_tag(self, tag):
+        """ Forget a tag that was just deleted. """
+        self.tags.pop(tag, None)
+
+
+class RemoteTags(object):
+    """
+    The tags of a remote repository, listed with one "git ls-remote" the
+    first time one is needed.
+
+    With a RemoteTagCache the listing is shared with later invocations until
+    it expires. A tag missing from a cached listing, or pointing somewhere
+    other than expected, makes us list the remote again since it may have
+    been pushed in the meantime. refresh=True ignores the cached listing.
+    """
+
+    def __init__(self, url, cache=None, refresh=False):
+        self.url = url
+        self.cache = cache
+        self.tags = None
+        self.listed = False
+        self.error = None
+        if cache is not None and not refresh:
+            self.tags = cache.load(url)
+
+    def list(self):
+        # Protocol v2 lets the server send only refs/tags/ instead of every
+        # ref it has.
+        proc = subprocess.Popen(['git', '-c', 'protocol.version=2',
+            'ls-remote', '--tags', self.url],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (output, error) = proc.communicate()
+        self.listed = True
+        self.tags = {}
+        if proc.returncode != 0:
+            # Not cached, the remote may well be back next time
+            self.error = decode_bytes(error, 'utf8')
+            return
+        for line in decode_bytes(output, 'utf8').splitlines():
+            # "<sha1>\trefs/tags/<tag>", followed by "<sha1>\trefs/tags/<tag>^{}"
+            # for annotated tags
+            (sha1, refname) = line.split("\t", 1)
+            if refname.startswith("refs/tags/") and not refname.endswith("^{}"):
+                self.tags[refname[len("refs/tags/"):]] = sha1
+        if self.cache is not None:
+            self.cache.save(self.url, self.tags)
+
+    def tag_sha1(self, tag, expected=None):
+        """
+        Return the SHA1 the tag points to in the remote repository, "" if
+        it doesn't exist there. expected is the SHA1 the caller hopes for.
+        """
+        if self.tags is None:
+            self.list()
+        sha1 = self.tags.get(tag)
+        if not self.listed and (sha1 is None or
+                (expected is not None and sha1 != expected)):
+            self.list()
+            sha1 = self.tags.get(tag)
+        return sha1 or ""
+
+
+class GitRepository(object):
+    """
+    A git repository, reading objects through one "git cat-file --batch" and
+    one "git cat-file --batch-check" process which are started the first
+    time they are needed.
+
+    Object names are anything "git rev-parse" understands: SHA1s, refs,
+    "<rev>^{commit}", "<rev>:<path>" with the path relative to the top of
+    the repository, etc.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._batch = None
+        self._batch_check = None
+        self._config = None
+        self._refs = None
+        self._git_dir = None
+
+    def _start(self, option):
+        return subprocess.Popen(['git', 'cat-file', option], cwd=self.path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _request(self, proc, name):
+        if "\n" in name:
+            raise TitoException("Invalid git object name: %r" % name)
+        proc.stdin.write(encode_bytes(name, 'utf8') + b"\n")
+        proc.stdin.flush()
+        header = decode_bytes(proc.stdout.readline(), 'utf8')
+        if not header:
+            raise TitoException("git cat-file exited unexpectedly in %s" % self.path)
+        tokens = header.split()
+        # "<name> missing" or "<name> ambiguous"
+        if len(tokens) != 3 or tokens[1] in ("missing", "ambiguous"):
+            return None
+        return (tokens[0], tokens[1], int(tokens[2]))
+
+    def object_info(self, name):
+        """
+        Return (sha1, type, size) of the object, or None if it doesn't exist.
+        """
+        if self._batch_check is None:
+            self._batch_check = self._start('--batch-check')
+        return self._request(self._batch_check, name)
+
+    def rev_parse(self, name):
+        """
+        Return the SHA1 of the object, or None if it doesn't exist. Use
+        "<rev>^{commit}" to peel tags down to the commit they point to.
+        """
+        info = self.object_info(name)
+        if info is None:
+            return None
+        return info[0]
+
+    def read_object(self, name):
+        """
+        Return (type, content) of the object, or None if it doesn't exist.
+        """
+        if self._batch is None:
+            self._batch = self._start('--batch')
+        info = self._request(self._batch, name)
+        if info is None:
+            return None
+        (sha1, obj_type, size) = info
+        content = self._batch.stdout.read(size)
+        # Every object is followed by a newline
+        self._batch.stdout.read(1)
+        return (obj_type, content)
+
+    def read_file(self, commit, path):
+        """
+        Return the contents of a file at the given commit as bytes, or None
+        if it doesn't exist.
+        """
+        obj = self.read_object("%s:%s" % (commit, path))
+        if obj is None or obj[0] != "blob":
+            return None
+        return obj[1]
+
+    def list_tree(self, name):
+        """
+        Return the names of the entries of a tree, e.g. "<commit>:<dir>", or
+        None if there is no such tree.
+        """
+        obj = self.read_object(name)
+        if obj is None or obj[0] != "tree":
+            return None
+        content = obj[1]
+        # The tree entries are "<mode> <name>\0<binary object id>"
+        id_length = len(self.rev_parse(name)) // 2
+        names = []
+        pos = 0
+        while pos < len(content):
+            name_start = content.index(b" ", pos) + 1
+            name_end = content.index(b"\0", name_start)
+            names.append(decode_bytes(content[name_start:name_end], 'utf8'))
+            pos = name_end + 1 + id_length
+        return names
+
+    def commit_timestamp(self, commit):
+        """
+        Return the committer timestamp of a commit, or of the commit a tag
+        points to, or None if there is no such commit.
+        """
+        obj = self.read_object("%s^{commit}" % commit)
+        if obj is None:
+            return None
+        for line in obj[1].split(b"\n"):
+            if not line:
+                break
+            if line.startswith(b"committer "):
+                return int(line.rsplit(b" ", 2)[1])
+        return None
+
+    def config(self, key):
+        """
+        Return the value of a git config key, or None if it isn't set. The
+        whole configuration is read once with "git config --list".
+        """
+        if self._config is None:
+            proc = subprocess.Popen(['git', 'config', '--list', '-z'],
+                cwd=self.path, stdout=subprocess.PIPE)
+            output = decode_bytes(proc.communicate()[0], 'utf8')
+            self._config = {}
+            for entry in output.split("\0"):
+                if not entry:
+                    continue
+                if "\n" in entry:
+                    (entry_key, value) = entry.split("\n", 1)
+                else:
+                    (entry_key, value) = (entry, "")
+                # Like git config --get, the last value wins
+                self._config[entry_key.lower()] = value
+        return self._config.get(key.lower())
+
+    @property
+    def git_dir(self):
+        """ The .git directory, the one shared by all worktrees. """
+        if self._git_dir is None:
+            # Older gits don't know --git-common-dir and print it back
+            proc = subprocess.Popen(['git', 'rev-parse', '--git-dir',
+                '--git-common-dir'], cwd=self.path, stdout=subprocess.PIPE)
+            lines = decode_bytes(proc.communicate()[0], 'utf8').splitlines()
+            git_dir = lines[-1]
+            if git_dir.startswith("--"):
+                git_dir = lines[0]
+            self._git_dir = os.path.normpath(os.path.join(self.path, git_dir))
+        return self._git_dir
+
+    @property
+    def refs(self):
+        """ The RefIndex of this repository, loaded on first use. """
+        if self._refs is None:
+            self._refs = RefIndex(self)
+        return self._refs
+
+    def invalidate_config(self):
+        self._config = None
+
+    def invalidate(self, refs=True):
+        """
+        Forget everything read so far, for when git commands outside of this
+        object changed the repository. Callers which keep the RefIndex up to
+        date themselves can pass refs=False to keep it.
+        """
+        self.invalidate_config()
+        if refs:
+            self._refs = None
+        self.close()
+
+    def close(self):
+        for proc in (self._batch, self._batch_check):
+            if proc is not None:
+                proc.stdin.close()
+                proc.wait()
+                proc.stdout.close()
+        self._batch = None
+        self._batch_check = None
+
+    def detach(self):
+        """ Forget the cat-file processes without stopping them. """
+        self._batch = None
+        self._batch_check = None
+
+
+# Repositories by the directory tito asked from, and by their top level
+# directory, so every directory of a checkout shares the same processes.
+_repositories = {}
+_repositories_by_root = {}
+
+
+def find_repository_root(path):
+    """
+    Return the top level directory of the git checkout path is in, the way
+    find_git_root always has, or None if it isn't in one.
+    """
+    proc = subprocess.Popen(['git', 'rev-parse', '--show-cdup'], cwd=path,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    cdup = decode_bytes(proc.communicate()[0], 'utf8').strip()
+    if proc.returncode != 0:
+        return None
+    return os.path.abspath(os.path.join(path, cdup or "./"))
+
+
+def get_repository(path=None):
+    """
+    Return the GitRepository the directory (by default the current one) is
+    in, or None if it isn't in a git checkout.
+    """
+    if path is None:
+        path = os.getcwd()
+    path = os.path.abspath(path)
+    if path in _repositories:
+        return _repositories[path]
+
+    root = find_repository_root(path)
+    if root is None:
+        # Not remembered, the directory may well become a checkout later.
+        return None
+    repository = _repositories_by_root.get(root)
+    if repository is None:
+        repository = GitRepository(root)
+        _repositories_by_root[root] = repository
+    _repositories[path] = repository
+    return repository
+
+
+def _is_within(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def forget_repositories(directory):
+    """
+    Close and forget every repository in or under directory, e.g. before
+    it is removed. A checkout created there later is looked up again.
+    """
+    directory = os.path.abspath(directory)
+    for path in list(_repositories):
+        if _is_within(path, directory) or _is_within(_repositories[path].path, directory):
+            del _repositories[path]
+    for root in list(_repositories_by_root):
+        if _is_within(root, directory):
+            _repositories_by_root.pop(root).close()
+
+
+def detach_repositories():
+    """
+    Forget the cat-file processes of every repository without stopping
+    them, in a forked child which shares them with its parent. The child
+    starts its own the first time it needs them.
+    """
+    for repository in _repositories_by_root.values():
+        repository.detach()
+
+
+def close_repositories():
+    for repository in _repositories_by_root.values():
+        repository.close()
+    _repositories.clear()
+    _repositories_by_root.clear()
+
+
+atexit.register(close_repositories)
@@ -16,6 +16,7 @@
 
 from tito.common import run_command, info_out, error_out
 from tito.release import KojiReleaser
+from tito.trace import trace_command
 
 
 class CoprReleaser(KojiReleaser):
@@ -110,7 +111,8 @@ def _submit(self, srpm_location, project):
         self._run_command(cmd_submit)
 
     def _run_command(self, cmd):
-        process = subprocess.Popen(cmd.split())
-        process.wait()
+        with trace_command(cmd.split()) as record:
+            process = subprocess.Popen(cmd.split())
+            record.status = process.wait()
         if process.returncode > 0:
             error_out("Failed running `%s`" % cmd)
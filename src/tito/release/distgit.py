@@ -22,6 +22,7 @@
 from tito.release import Releaser
 from tito.release.main import PROTECTED_BUILD_SYS_FILES
 from tito.buildparser import BuildTargetParser
+from tito.trace import trace_phase
 from tito.exception import RunCommandException
 import getpass
 from string import Template
@@ -87,13 +88,15 @@ def _git_release(self):
 
         # Mead builds need to be in the git_root.  Other builders are agnostic.
         with chdir(self.git_root):
-            self.builder.tgz()
+            with trace_phase("tgz"):
+                self.builder.tgz()
 
         if self.test:
             self.builder._setup_test_specfile()
 
-        self._git_sync_files(self.package_workdir)
-        self._git_upload_sources(self.package_workdir)
+        with trace_phase("sync"):
+            self._git_sync_files(self.package_workdir)
+            self._git_upload_sources(self.package_workdir)
         self._git_user_confirm_commit(self.package_workdir)
 
     def _get_bz_flags(self):
@@ -205,7 +208,8 @@ def _git_user_confirm_commit(self, project_checkout):
             else:
                 print("Proceeding with commit.")
                 os.chdir(self.package_workdir)
-                run_command(cmd)
+                with trace_phase("commit"):
+                    run_command(cmd)
 
             os.unlink(commit_msg_file)
 
@@ -216,12 +220,14 @@ def _git_user_confirm_commit(self, project_checkout):
             # Push
             print(cmd)
             try:
-                run_command(cmd)
+                with trace_phase("push", branch=main_branch):
+                    run_command(cmd)
             except RunCommandException as e:
                 error_out("`%s` failed with: %s" % (cmd, e.output))
 
         if not self.no_build:
-            self._build(main_branch)
+            with trace_phase("submit", branch=main_branch):
+                self._build(main_branch)
 
         for branch in self.git_branches[1:]:
             info_out("Merging branch: '%s' -> '%s'" % (main_branch, branch))
@@ -234,12 +240,14 @@ def _git_user_confirm_commit(self, project_checkout):
             else:
                 print(cmd)
                 try:
-                    run_command(cmd)
+                    with trace_phase("push", branch=branch):
+                        run_command(cmd)
                 except RunCommandException as e:
                     error_out("`%s` failed with: %s" % (cmd, e.output))
 
             if not self.no_build:
-                self._build(branch)
+                with trace_phase("submit", branch=branch):
+                    self._build(branch)
 
             print
 
@@ -481,7 +489,8 @@ def _sync_mead_scm(self):
                 raise
 
     def _git_release(self):
-        self._sync_mead_scm()
+        with trace_phase("push", remote=self.push_url):
+            self._sync_mead_scm()
         DistGitReleaser._git_release(self)
 
     def _git_upload_sources(self, project_checkout):
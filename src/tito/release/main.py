@@ -14,19 +14,20 @@
 Code for submitting builds for release.
 """
 
-import copy
 import os
 import sys
-import rpm
 
 from tempfile import mkdtemp
 import shutil
 
 from tito.common import create_builder, debug, \
     run_command, get_project_name, warn_out, error_out
-from tito.compat import PY2, dictionary_override
+from tito.compat import PY2, create_pool, dictionary_override
+from tito.compress import format_from_filename
+from tito.context import forget_contexts
 from tito.exception import TitoException
 from tito.config_object import ConfigObject
+from tito.trace import trace_phase
 
 # List of files to protect when syncing:
 PROTECTED_BUILD_SYS_FILES = ('branch', 'Makefile', 'sources', ".git", ".gitignore", ".osc", "tito-mead-url")
@@ -97,8 +98,32 @@ def __init__(self, name=None, tag=None, build_dir=None,
         self.auto_accept = auto_accept  # don't ask for input, just go ahead
         self.no_cleanup = no_cleanup
 
+        # Whether the builder already built what we release, see
+        # use_builder(), and whether we are the last to use it:
+        self.built = False
+        self.cleanup_builder = True
+
         self._check_releaser_config()
 
+    @classmethod
+    def build_key(cls, releaser_config, target):
+        """
+        Return what the artifacts released to target depend on besides the
+        package and the command line. Targets with the same key release
+        the same artifacts, built once, see use_builder(). None if the
+        releaser builds nothing it could share.
+        """
+        return None
+
+    def use_builder(self, builder):
+        """
+        Release the artifacts another target with the same build_key()
+        built with builder, instead of building them again.
+        """
+        self.builder.cleanup()
+        self.builder = builder
+        self.built = True
+
     def _ask_yes_no(self, prompt="Y/N? ", default_auto_answer=True):
         if self.auto_accept:
             return default_auto_answer
@@ -157,9 +182,12 @@ def release(self, dry_run=False, no_build=False, scratch=False):
     def cleanup(self):
         if not self.no_cleanup:
             debug("Cleaning up [%s]" % self.working_dir)
+            # Checkouts in there (dist-git) are gone, don't keep their git
+            # processes and facts around.
+            forget_contexts(self.working_dir)
             run_command("rm -rf %s" % self.working_dir)
 
-            if self.builder:
+            if self.builder and self.cleanup_builder:
                 self.builder.cleanup()
         else:
             warn_out("leaving %s (--no-cleanup)" % self.working_dir)
@@ -248,21 +276,22 @@ def __init__(self, name=None, tag=None, build_dir=None,
             warn_out("please rename 'scl' to 'builder.scl' in releasers.conf")
             self.builder.scl = self.releaser_config.get(self.target, "scl")
 
+    @classmethod
+    def build_key(cls, releaser_config, target):
+        options = sorted((opt, releaser_config.get(target, opt))
+            for opt in releaser_config.options(target)
+            if opt in ["builder", "srpm_disttag", "scl"] or opt.startswith("builder."))
+        return ("rsync", tuple(options))
+
     def release(self, dry_run=False, no_build=False, scratch=False):
         self.dry_run = dry_run
 
-        # Should this run?
-        self.builder.no_cleanup = self.no_cleanup
-        self.builder.tgz()
-
-        # Check if the releaser specifies a srpm disttag:
-        srpm_disttag = None
-        if self.releaser_config.has_option(self.target, "srpm_disttag"):
-            srpm_disttag = self.releaser_config.get(self.target, "srpm_disttag")
-        self.builder.srpm(dist=srpm_disttag)
-
-        self.builder.rpm()
-        self.builder.cleanup()
+        if self.built:
+            print("Using the artifacts already built for another target")
+        else:
+            self.build()
+        if self.cleanup_builder:
+            self.builder.cleanup()
 
         if self.releaser_config.has_option(self.target, 'rsync_args'):
             self.rsync_args = self.releaser_config.get(self.target, 'rsync_args')
@@ -277,10 +306,28 @@ def release(self, dry_run=False, no_build=False, scratch=False):
             # Make a temp directory to sync the existing repo contents into:
             temp_dir = mkdtemp(dir=self.build_dir, prefix=self.prefix)
 
-            self._rsync_from_remote(self.rsync_args, rsync_location, temp_dir)
-            self._copy_files_to_temp_dir(temp_dir)
-            self.process_packages(temp_dir)
-            self.rsync_to_remote(self.rsync_args, temp_dir, rsync_location)
+            with trace_phase("sync", location=rsync_location):
+                self._rsync_from_remote(self.rsync_args, rsync_location, temp_dir)
+                self._copy_files_to_temp_dir(temp_dir)
+                self.process_packages(temp_dir)
+                self.rsync_to_remote(self.rsync_args, temp_dir, rsync_location)
+
+    def build(self):
+        # Should this run?
+        self.builder.no_cleanup = self.no_cleanup
+        with trace_phase("tgz"):
+            self.builder.tgz()
+
+        # Check if the releaser specifies a srpm disttag:
+        srpm_disttag = None
+        if self.releaser_config.has_option(self.target, "srpm_disttag"):
+            srpm_disttag = self.releaser_config.get(self.target, "srpm_disttag")
+        with trace_phase("srpm"):
+            self.builder.srpm(dist=srpm_disttag)
+
+        with trace_phase("rpm"):
+            self.builder.rpm()
+        self.built = True
 
     def _rsync_from_remote(self, rsync_args, rsync_location, temp_dir):
         os.chdir(temp_dir)
@@ -313,7 +360,7 @@ def _copy_files_to_temp_dir(self, temp_dir):
             self.filetypes = self.releaser_config.get(self.target, 'filetypes').split(" ")
 
         for artifact in self.builder.artifacts:
-            if artifact.endswith('.tar.gz'):
+            if format_from_filename(artifact):
                 artifact_type = 'tgz'
             elif artifact.endswith('src.rpm'):
                 artifact_type = 'srpm'
@@ -387,6 +434,7 @@ def prune_other_versions(self, temp_dir):
         to downgrade the contents of a yum repo).
         """
         os.chdir(temp_dir)
+        import rpm
         rpm_ts = rpm.TransactionSet()
         self.new_rpm_dep_sets = {}
         for artifact in self.builder.artifacts:
@@ -490,6 +538,7 @@ def _koji_release(self):
             koji_opts = ' '.join(['--config', self.conf_file, koji_opts])
 
         # TODO: need to re-do this metaphor to use release targets instead:
+        builds = []
         for koji_tag in koji_tags:
             if self.only_tags and koji_tag not in self.only_tags:
                 continue
@@ -516,18 +565,62 @@ def _koji_release(self):
                     "   Package *NOT* submitted to %s." % self.NAME,
                 ])
                 continue
+            builds.append((koji_tag, disttag, scl))
+
+        if self.skip_srpm:
+            for (koji_tag, disttag, scl) in builds:
+                with trace_phase("submit", koji_tag=koji_tag):
+                    self._submit_build(self.executable, koji_opts, koji_tag,
+                        self.builder.srpm_location)
+            return
 
-            # Getting tricky here, normally Builder's are only used to
-            # create one rpm and then exit. Here we're going to try
-            # to run multiple srpm builds:
-            builder = self.builder
-            if not self.skip_srpm:
+        # Getting tricky here, normally Builder's are only used to
+        # create one rpm and then exit. Here we're going to run an srpm build
+        # for each disttag and scl, all at once, each in a copy of the builder
+        # sharing its sources, and submit every tag as soon as its srpm is
+        # ready:
+        srpms = []
+        for (koji_tag, disttag, scl) in builds:
+            if (disttag, scl) not in srpms:
+                srpms.append((disttag, scl))
+        if not srpms:
+            return
+        with trace_phase("prepare-srpm"):
+            self.builder.prepare_srpm()
+        from multiprocessing import cpu_count
+        pool = create_pool(max(1, min(len(srpms), cpu_count())))
+        try:
+            results = {}
+            for (disttag, scl) in srpms:
+                builder = self.builder.srpm_copy()
                 if scl:
-                    builder = copy.copy(self.builder)
                     builder.scl = scl
+                results[(disttag, scl)] = (builder,
+                    pool.apply_async(self._build_srpm, (builder, disttag)))
+            for (koji_tag, disttag, scl) in builds:
+                (builder, result) = results[(disttag, scl)]
+                error = result.get()
+                if error is not None:
+                    raise error
+                with trace_phase("submit", koji_tag=koji_tag):
+                    self._submit_build(self.executable, koji_opts, koji_tag,
+                        builder.srpm_location)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _build_srpm(self, builder, disttag):
+        """
+        Build an srpm in a pool thread. Returns the SystemExit of an
+        error_out(), which would otherwise end the thread and leave us
+        waiting for the srpm forever.
+        """
+        try:
+            with trace_phase("srpm", disttag=disttag, scl=builder.scl or ""):
                 builder.srpm(dist=disttag)
-
-            self._submit_build(self.executable, koji_opts, koji_tag, builder.srpm_location)
+        except SystemExit:
+            return sys.exc_info()[1]
+        return None
 
     def __is_whitelisted(self, koji_tag, scl):
         """ Return true if package is whitelisted in tito.props"""
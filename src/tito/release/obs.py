@@ -19,6 +19,7 @@
 from tito.common import run_command, debug, BugzillaExtractor
 from tito.compat import getoutput, write, getstatusoutput
 from tito.release.distgit import FedoraGitReleaser
+from tito.trace import trace_phase
 
 
 class ObsReleaser(FedoraGitReleaser):
@@ -55,11 +56,13 @@ def release(self, dry_run=False, no_build=False, scratch=False):
 
         os.chdir(self.package_workdir)
 
-        self.builder.tgz()
+        with trace_phase("tgz"):
+            self.builder.tgz()
         if self.test:
             self.builder._setup_test_specfile()
 
-        self._obs_sync_files(self.package_workdir)
+        with trace_phase("sync"):
+            self._obs_sync_files(self.package_workdir)
         self._obs_user_confirm_commit(self.package_workdir)
 
     def _confirm_commit_msg(self, diff_output):
@@ -134,7 +137,8 @@ def _obs_user_confirm_commit(self, project_checkout):
             else:
                 print("Proceeding with commit.")
                 os.chdir(self.package_workdir)
-                print(run_command(cmd))
+                with trace_phase("commit"):
+                    print(run_command(cmd))
 
             os.unlink(commit_msg_file)
 
@@ -0,0 +1,360 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Building every package of a repository in one tito run, several at once,
+each after the packages it BuildRequires.
+
+Builds run in worker processes forked from the tito process, so they all
+start with what it already looked up: the configuration, git facts,
+parsed spec files and expanded macros.
+"""
+
+import errno
+import os
+import select
+import sys
+
+from tito.common import find_file_with_extension, run_argv
+from tito.compat import Empty, Queue, create_pool
+from tito.exception import TitoException
+from tito.gitrepo import detach_repositories
+from tito.specfile import query_spec
+
+# What the worker processes build, set up before they are forked.
+_build = None
+_log_dir = None
+# Where the worker processes write "<pid> <name>" as they start a build.
+_started_fd = None
+
+# Seconds between checks that the workers of running builds are alive.
+WORKER_POLL_INTERVAL = 1
+
+
+class Package(object):
+    """
+    A package listed in the packages directory of the tito config
+    directory. build_requires and provides are None until read from its
+    spec file, see read_build_dependencies().
+    """
+
+    def __init__(self, name, version, relative_dir):
+        self.name = name
+        self.version = version
+        self.relative_dir = relative_dir
+        self.build_requires = None
+        self.provides = None
+
+    def __repr__(self):
+        return "Package(%r, %r, %r)" % (self.name, self.version, self.relative_dir)
+
+
+def read_packages(rel_eng_dir):
+    """
+    Return the Packages tito tagged so far, by name, from their
+    "<version> <relative dir>" metadata files.
+    """
+    packages = {}
+    package_metadata_dir = os.path.join(rel_eng_dir, "packages")
+    if not os.path.isdir(package_metadata_dir):
+        return packages
+    for md_file in os.listdir(package_metadata_dir):
+        if md_file[0] == '.':
+            continue
+        f = open(os.path.join(package_metadata_dir, md_file))
+        try:
+            (version, relative_dir) = f.readline().strip().split(" ")
+        finally:
+            f.close()
+        # Hack for single project git repos:
+        if relative_dir == '/':
+            relative_dir = ""
+        packages[md_file] = Package(md_file, version, relative_dir.rstrip("/"))
+    return packages
+
+
+def read_build_dependencies(packages, git_root):
+    """
+    Fill in the build_requires and provides of packages from the spec file
+    in their directory. Returns the packages whose BuildRequires rpm could
+    not tell, they are built without waiting for any other package.
+    """
+    unknown = []
+    for package in packages.values():
+        project_dir = os.path.join(git_root, package.relative_dir)
+        spec_file = None
+        if os.path.isdir(project_dir):
+            spec_file = find_file_with_extension(project_dir, '.spec')
+        info = None
+        if spec_file is not None:
+            info = query_spec(spec_file)
+        if info is not None:
+            package.build_requires = info.build_requires
+            package.provides = info.provides
+        if package.build_requires is None:
+            unknown.append(package.name)
+    return sorted(unknown)
+
+
+def changed_packages(packages, git_root, ref):
+    """
+    Return the names of the packages with files that changed since the git
+    revision ref, including uncommitted changes.
+    """
+    result = run_argv(["git", "diff", "--name-only", ref, "--"], cwd=git_root).check()
+    changed = set()
+    for path in result.lines():
+        for package in packages.values():
+            if not package.relative_dir or \
+                    path.startswith(package.relative_dir + "/"):
+                changed.add(package.name)
+    return changed
+
+
+class BuildGraph(object):
+    """
+    Which packages have to be built before which: a package requires those
+    which provide one of its BuildRequires.
+    """
+
+    def __init__(self, packages, names=None):
+        self.packages = packages
+        if names is None:
+            names = packages.keys()
+        self.names = set(names)
+
+        providers = {}
+        for name in self.names:
+            package = packages[name]
+            for provide in package.provides or [name]:
+                providers.setdefault(provide, set()).add(name)
+        self.requires = {}
+        self.required_by = dict((name, set()) for name in self.names)
+        for name in self.names:
+            requires = set()
+            for build_require in packages[name].build_requires or []:
+                requires.update(providers.get(build_require, ()))
+            requires.discard(name)
+            self.requires[name] = requires
+            for required in requires:
+                self.required_by[required].add(name)
+
+    def select(self, names):
+        """ Return the graph of the packages names. """
+        return BuildGraph(self.packages, names)
+
+    def dependents(self, names):
+        """
+        Return names and every package which requires one of them, directly
+        or not.
+        """
+        result = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name in result:
+                continue
+            result.add(name)
+            todo.extend(self.required_by.get(name, ()))
+        return result
+
+    def order(self):
+        """
+        Return the package names in an order they can be built in, raise a
+        TitoException if packages require each other.
+        """
+        requires = dict((name, set(self.requires[name])) for name in self.names)
+        result = []
+        while requires:
+            ready = sorted([name for name in requires if not requires[name]])
+            if not ready:
+                raise TitoException("Packages require each other to build: %s" %
+                    ", ".join(sorted(requires)))
+            for name in ready:
+                del requires[name]
+                for others in requires.values():
+                    others.discard(name)
+            result.extend(ready)
+        return result
+
+
+class BuildScheduler(object):
+    """
+    Runs build(name) for every package of a BuildGraph in at most jobs
+    worker processes at once, starting each package once the packages it
+    requires were built. build returns the artifacts it built; raising an
+    exception or exiting fails the package and skips its dependents.
+
+    With log_dir, the output of every build goes to <log_dir>/<name>.log.
+    """
+
+    def __init__(self, graph, build, jobs=1, log_dir=None):
+        self.graph = graph
+        self.build = build
+        self.jobs = jobs
+        self.log_dir = log_dir
+
+        # Artifacts by package name, and the error of packages which failed.
+        self.built = {}
+        self.failed = {}
+        self.skipped = []
+
+    def log_file(self, name):
+        if self.log_dir is None:
+            return None
+        return os.path.join(self.log_dir, "%s.log" % name)
+
+    def run(self, on_done=None):
+        """
+        Build all packages, calling on_done(name) in this process as each
+        one is built or failed. Returns whether all of them were built.
+        """
+        # Raise before forking anything:
+        self.graph.order()
+
+        global _build, _log_dir, _started_fd
+        (_build, _log_dir) = (self.build, self.log_dir)
+        if self.log_dir is not None and not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        # Packages many others wait for go first:
+        weight = dict((name, len(self.graph.dependents([name])))
+            for name in self.graph.names)
+        waiting = dict((name, set(self.graph.requires[name]))
+            for name in self.graph.names)
+        running = {}
+        results = Queue()
+        (started_read, _started_fd) = os.pipe()
+        workers = _WorkerWatch(started_read)
+        # Workers have to start as copies of this process, see the module
+        # docstring, and each build as a fresh one as builders change
+        # directories:
+        pool = create_pool(self.jobs, fork=True, maxtasksperchild=1)
+        try:
+            while waiting or running:
+                ready = [name for name in waiting if not waiting[name]]
+                for name in sorted(ready, key=lambda name: (-weight[name], name)):
+                    del waiting[name]
+                    running[name] = pool.apply_async(_build_in_child, (name,),
+                        callback=results.put)
+
+                try:
+                    (name, built, value) = results.get(timeout=WORKER_POLL_INTERVAL)
+                except Empty:
+                    lost = workers.lost(running)
+                    if not lost:
+                        continue
+                    (name, built, value) = lost
+                del running[name]
+                if built:
+                    self.built[name] = value
+                    for requires in waiting.values():
+                        requires.discard(name)
+                else:
+                    self.failed[name] = value
+                    for dependent in sorted(self.graph.dependents([name])):
+                        if dependent in waiting:
+                            del waiting[dependent]
+                            self.skipped.append(dependent)
+                if on_done is not None:
+                    on_done(name)
+        finally:
+            pool.terminate()
+            pool.join()
+            os.close(started_read)
+            os.close(_started_fd)
+            (_build, _log_dir, _started_fd) = (None, None, None)
+        return not self.failed and not self.skipped
+
+
+class _WorkerWatch(object):
+    """
+    Finds the builds whose result will never come: the worker process died
+    (killed by the OOM killer...), or the result failed to reach us (it
+    can't be pickled...). The pool then never calls us back.
+    """
+
+    def __init__(self, started_fd):
+        self.started_fd = started_fd
+        self.pids = {}
+        self.dead = set()
+        self._partial = ""
+
+    def _read_started(self):
+        while select.select([self.started_fd], [], [], 0)[0]:
+            data = os.read(self.started_fd, 4096)
+            if not data:
+                break
+            lines = (self._partial + data.decode("utf8")).split("\n")
+            self._partial = lines.pop()
+            for line in lines:
+                (pid, name) = line.split(" ", 1)
+                self.pids[name] = int(pid)
+
+    def lost(self, running):
+        """
+        Return (name, False, error) for one of the running builds, a dict
+        of their AsyncResult by name, which is lost. None if there is none.
+        """
+        self._read_started()
+        for name in sorted(running):
+            result = running[name]
+            if result.ready() and not result.successful():
+                try:
+                    result.get()
+                except Exception:
+                    e = sys.exc_info()[1]
+                    return (name, False, "%s: %s" % (e.__class__.__name__, e))
+            pid = self.pids.get(name)
+            if pid is None or _alive(pid):
+                continue
+            # Give a result the worker sent just before exiting one more
+            # interval to arrive:
+            if name in self.dead:
+                return (name, False, "worker process %s died" % pid)
+            self.dead.add(name)
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        e = sys.exc_info()[1]
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _build_in_child(name):
+    """ Run in a worker process, returns (name, built, artifacts or error). """
+    os.write(_started_fd, ("%s %s\n" % (os.getpid(), name)).encode("utf8"))
+    detach_repositories()
+    if _log_dir is not None:
+        # Both for us and the commands we run:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log = open(os.path.join(_log_dir, "%s.log" % name), "w")
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        sys.stdout = sys.stderr = log
+    try:
+        try:
+            return (name, True, _build(name))
+        except BaseException:
+            # error_out() exits, having printed the error
+            e = sys.exc_info()[1]
+            if isinstance(e, SystemExit):
+                return (name, False, "exited with %s" % e.code)
+            return (name, False, "%s: %s" % (e.__class__.__name__, e))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
@@ -0,0 +1,283 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Asking rpm what a spec file says.
+
+With the rpm Python bindings spec files are parsed and macros expanded
+in-process, otherwise the rpm command is run. Either way a spec file is
+parsed once per content and set of macros, and a macro expanded once per
+set of macros defined around it, however often tito asks. Expanded macros
+can also be kept on disk until rpm's macro files change, see
+set_macro_cache().
+"""
+
+import glob
+import hashlib
+import os
+import subprocess
+import threading
+
+from tito.compat import decode_bytes
+from tito.trace import trace_command
+
+# Where rpm reads macros from, on the systems tito runs on.
+MACRO_FILES = [
+    "/usr/lib/rpm/macros",
+    "/usr/lib/rpm/macros.d/*",
+    "/usr/lib/rpm/*/macros",
+    "/etc/rpm/*",
+    "~/.rpmmacros",
+]
+
+# Parsed spec files by spec_cache_key(), and expanded macros by
+# _macro_key().
+_specs = {}
+_macros = {}
+
+# The MacroCache expanded macros are also kept in, None for none.
+_macro_cache = None
+
+# Held while using the bindings, whose macros are global to the process.
+# Srpms are built in several threads at once.
+_rpm_lock = threading.Lock()
+
+
+class SpecInfo(object):
+    """
+    What tito needs to know about a spec file. sources, patches and
+    build_requires are only known with the rpm Python bindings, they are None
+    without. provides are the names of the binary packages, plus what they
+    Provide with the bindings.
+    """
+
+    def __init__(self, name, version, release, sources=None, patches=None,
+            build_requires=None, provides=None):
+        self.name = name
+        self.version = version
+        self.release = release
+        self.sources = sources
+        self.patches = patches
+        self.build_requires = build_requires
+        self.provides = provides
+
+    def __repr__(self):
+        return "SpecInfo(%r, %r, %r)" % (self.name, self.version, self.release)
+
+
+def _import_rpm():
+    try:
+        import rpm
+    except ImportError:
+        return None
+    return rpm
+
+
+def _str(value):
+    if isinstance(value, bytes):
+        return decode_bytes(value, 'utf8')
+    return value
+
+
+def spec_cache_key(spec_file, defines):
+    """
+    Parsing depends on the spec file's content and the macros we define
+    for it, not on its name or when it was written.
+    """
+    hasher = hashlib.sha256()
+    f = open(spec_file, 'rb')
+    try:
+        hasher.update(f.read())
+    finally:
+        f.close()
+    for (name, value) in defines:
+        hasher.update(("\0%s\0%s" % (name, value)).encode('utf8'))
+    return hasher.hexdigest()
+
+
+def query_spec(spec_file, defines=()):
+    """
+    Return the SpecInfo of a spec file, or None if rpm can't parse it.
+
+    defines is a list of (macro name, value) pairs to define while parsing,
+    a value of None undefines the macro.
+    """
+    defines = tuple(defines)
+    key = spec_cache_key(spec_file, defines)
+    if key not in _specs:
+        rpm = _import_rpm()
+        if rpm is not None:
+            with _rpm_lock:
+                _specs[key] = _parse_with_bindings(rpm, spec_file, defines)
+        else:
+            _specs[key] = _parse_with_rpm_command(spec_file, defines)
+    return _specs[key]
+
+
+def _parse_with_bindings(rpm, spec_file, defines):
+    for (name, value) in defines:
+        if value is None:
+            rpm.delMacro(name)
+        else:
+            rpm.addMacro(name, value)
+    try:
+        try:
+            spec = rpm.spec(spec_file)
+        except ValueError:
+            return None
+        header = spec.sourceHeader
+        sources = []
+        patches = []
+        # (file or URL, number, RPMBUILD_ISSOURCE or RPMBUILD_ISPATCH)
+        for (source, number, flags) in spec.sources:
+            if flags & 2:
+                patches.append(_str(source))
+            else:
+                sources.append(_str(source))
+        provides = []
+        for package in spec.packages:
+            for name in [package.header[rpm.RPMTAG_NAME]] + \
+                    list(package.header[rpm.RPMTAG_PROVIDENAME]):
+                if _str(name) not in provides:
+                    provides.append(_str(name))
+        return SpecInfo(_str(header[rpm.RPMTAG_NAME]),
+            _str(header[rpm.RPMTAG_VERSION]),
+            _str(header[rpm.RPMTAG_RELEASE]),
+            sources, patches,
+            [_str(name) for name in header[rpm.RPMTAG_REQUIRENAME]],
+            provides)
+    finally:
+        # Don't let this spec file's macros leak into the next one
+        if hasattr(rpm, 'reloadConfig'):
+            rpm.reloadConfig()
+        else:
+            for (name, value) in defines:
+                if value is not None:
+                    rpm.delMacro(name)
+
+
+def _rpm_options(defines):
+    options = []
+    for (name, value) in defines:
+        if value is None:
+            # can be replaced by "--undefine" when el6 and fc17 are retired
+            options.extend(["--eval", "%%undefine %s" % name])
+        else:
+            options.extend(["--define", "%s %s" % (name, value)])
+    return options
+
+
+def _parse_with_rpm_command(spec_file, defines):
+    argv = ["rpm", "-q", "--qf", "%{name}\t%{version}\t%{release}\n"] + \
+        _rpm_options(defines) + ["--specfile", spec_file]
+    with trace_command(argv) as record:
+        try:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError:
+            return None
+        output = decode_bytes(proc.communicate()[0], 'utf8')
+        record.status = proc.returncode
+    # One line per binary package, the first is the main one. Lines
+    # printed by --eval have no tabs.
+    packages = [line.split("\t") for line in output.splitlines()]
+    packages = [fields for fields in packages if len(fields) == 3]
+    if not packages:
+        return None
+    return SpecInfo(*packages[0], provides=[fields[0] for fields in packages])
+
+
+def macro_files_fingerprint():
+    """
+    Return a hash of the names and modification times of rpm's macro
+    files, which changes whenever a package adds, removes or updates one.
+    """
+    hasher = hashlib.sha256()
+    for pattern in MACRO_FILES:
+        for path in sorted(glob.glob(os.path.expanduser(pattern))):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            hasher.update(("%s\0%r\0" % (path, mtime)).encode('utf8'))
+    return hasher.hexdigest()
+
+
+def set_macro_cache(cache):
+    """ Keep expanded macros in the MacroCache cache too, None to stop. """
+    global _macro_cache
+    _macro_cache = cache
+
+
+def _macro_key(expression, defines):
+    return "\0".join(["%s=%s" % (name, value) for (name, value) in defines] +
+        [expression])
+
+
+def eval_macro(expression, defines=()):
+    """
+    Return what rpm expands expression to, like "rpm --eval". defines are
+    (macro name, value) pairs to define first, as for query_spec().
+    """
+    defines = tuple(defines)
+    key = _macro_key(expression, defines)
+    if key not in _macros:
+        value = None
+        if _macro_cache is not None:
+            value = _macro_cache.get(key)
+        if value is None:
+            rpm = _import_rpm()
+            if rpm is not None:
+                with _rpm_lock:
+                    value = _eval_with_bindings(rpm, expression, defines)
+            else:
+                value = _eval_with_rpm_command(expression, defines)
+            if value is None:
+                # No rpm at all, nothing is defined
+                value = expression
+            elif _macro_cache is not None:
+                _macro_cache.put(key, value)
+        _macros[key] = value
+    return _macros[key]
+
+
+def _eval_with_bindings(rpm, expression, defines):
+    if not defines:
+        return _str(rpm.expandMacro(expression))
+    for (name, value) in defines:
+        if value is None:
+            rpm.delMacro(name)
+        else:
+            rpm.addMacro(name, value)
+    try:
+        return _str(rpm.expandMacro(expression))
+    finally:
+        if hasattr(rpm, 'reloadConfig'):
+            rpm.reloadConfig()
+        else:
+            for (name, value) in defines:
+                if value is not None:
+                    rpm.delMacro(name)
+
+
+def _eval_with_rpm_command(expression, defines):
+    argv = ["rpm"] + _rpm_options(defines) + ["--eval", expression]
+    with trace_command(argv) as record:
+        try:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        except OSError:
+            return None
+        output = decode_bytes(proc.communicate()[0], 'utf8')
+        record.status = proc.returncode
+    # Every "--eval %undefine" prints an empty line first
+    undefines = len([name for (name, value) in defines if value is None])
+    return "\n".join(output.split("\n")[undefines:]).rstrip()
@@ -16,7 +16,6 @@
 
 import os
 import re
-import rpm
 import shutil
 import subprocess
 import sys
@@ -38,7 +37,7 @@
         tag_exists_locally, tag_exists_remotely, head_points_to_tag, undo_tag,
         increase_version, reset_release, increase_zstream, warn_out,
         BUILDCONFIG_SECTION, get_relative_project_dir_cwd, info_out)
-from tito.compat import write, StringIO, getstatusoutput
+from tito.compat import write, StringIO
 from tito.exception import TitoException
 from tito.config_object import ConfigObject
 
@@ -113,6 +112,7 @@ def run(self, options):
     def check_tag_precondition(self):
         if self.config.has_option("tagconfig", "require_package"):
             packages = self.config.get("tagconfig", "require_package").split(',')
+            import rpm
             ts = rpm.TransactionSet()
             missing_packages = []
             for p in packages:
@@ -507,6 +507,8 @@ def _update_package_metadata(self, new_version):
 
         new_tag = self._get_new_tag(new_version)
         run_command('git tag -m "%s" %s' % (tag_msg, new_tag))
+        self.context.invalidate(refs=False)
+        self.context.refs.add_tag(new_tag)
         print
         info_out("Created tag: %s" % new_tag)
         print("   View: git show HEAD")
@@ -514,9 +516,7 @@ def _update_package_metadata(self, new_version):
         print("   Push: git push origin && git push origin %s" % new_tag)
 
     def _check_tag_does_not_exist(self, new_tag):
-        status, output = getstatusoutput(
-            'git tag -l %s|grep ""' % new_tag)
-        if status == 0:
+        if tag_exists_locally(new_tag):
             raise Exception("Tag %s already exists!" % new_tag)
 
     def _clear_package_metadata(self):
@@ -554,16 +554,13 @@ def _clear_package_metadata(self):
 
     def _get_git_user_info(self):
         """ Return the user.name and user.email git config values. """
-        try:
-            name = run_command('git config --get user.name')
-        except:
+        name = self.context.git_user
+        if name is None:
             warn_out('user.name in ~/.gitconfig not set.\n')
             name = 'Unknown name'
-        try:
-            email = run_command('git config --get user.email')
-        except:
+        email = self.context.git_email
+        if email is None:
             warn_out('user.email in ~/.gitconfig not set.\n')
-            email = None
         return (name, email)
 
     def _get_new_tag(self, new_version):
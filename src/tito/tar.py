@@ -11,11 +11,14 @@
 # granted to use or replicate Red Hat trademarks that are incorporated
 # in this software or its documentation.
 
-import re
+import codecs
+import io
+import os
+import stat
 import struct
 import sys
 
-from tito.compat import decode_bytes, encode_bytes
+from tito.compat import PY2, decode_bytes, encode_bytes
 
 RECORD_SIZE = 512
 
@@ -23,6 +26,105 @@
 # implementation in archive-tar.c doesn't have any comments on the matter.
 GIT_BLOCK_SIZE = RECORD_SIZE * 20
 
+# File data is copied through a buffer of this size so memory use stays the
+# same no matter how large the members of the archive are.
+COPY_CHUNK_SIZE = RECORD_SIZE * 128
+
+
+# As defined in tar.h
+# An collections.OrderedDict would be more appropriate here but I'm trying to
+# maintain Python 2.6 compatibility.
+TAR_STRUCT = [
+    ('name', '100s'),
+    ('mode', '8s'),
+    ('uid', '8s'),
+    ('gid', '8s'),
+    ('size', '12s'),
+    ('mtime', '12s'),
+    ('checksum', '8s'),
+    ('typeflag', '1s'),
+    ('linkname', '100s'),
+    ('magic', '6s'),
+    ('version', '2s'),
+    ('uname', '32s'),
+    ('gname', '32s'),
+    ('devmajor', '8s'),
+    ('devminor', '8s'),
+    ('prefix', '155s'),
+]
+
+# The items in the list below are zero-padded octal numbers in ASCII.
+# All other fields are null-terminated character strings. Each numeric
+# field of width w contains w minus 1 digits, and a null.
+#
+# The checksum is technically an octal_member but we handle it specially.
+OCTAL_MEMBERS = [
+    'mode',
+    'uid',
+    'gid',
+    'size',
+    'mtime',
+    'devmajor',
+    'devminor',
+]
+
+# The struct only covers 500 bytes so it is padded to a full record.
+HEADER_STRUCT = struct.Struct("=" + "".join(x[1] for x in TAR_STRUCT) + "12x")
+
+# Slices of a header record holding each member, so headers can be patched in
+# place without unpacking and repacking every field.
+HEADER_FIELDS = {}
+_offset = 0
+for _name, _fmt in TAR_STRUCT:
+    _width = struct.calcsize(_fmt)
+    HEADER_FIELDS[_name] = slice(_offset, _offset + _width)
+    _offset += _width
+CHECKSUMMED_LENGTH = _offset
+del _offset, _name, _fmt, _width
+
+
+def _field_width(name):
+    field = HEADER_FIELDS[name]
+    return field.stop - field.start
+
+
+def _octal_field(value, width):
+    """Format value the way encode_header does: width - 1 zero-padded octal
+    digits and a NUL, truncated like struct.pack would if it doesn't fit."""
+    as_string = ("%0" + str(width - 1) + "o\x00") % value
+    return as_string.encode("ascii")[:width]
+
+
+def _is_real_file(fh):
+    """Whether reads and writes on fh go straight to its file descriptor, as
+    opposed to e.g. a GzipFile which has a descriptor for the compressed
+    data."""
+    return isinstance(fh, io.FileIO) or \
+        (isinstance(fh, (io.BufferedReader, io.BufferedWriter, io.BufferedRandom)) and
+            isinstance(fh.raw, io.FileIO))
+
+
+class TeeFile(object):
+    """
+    A write only binary file object writing everything to several others.
+    """
+    mode = 'wb'
+
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, data):
+        for out in self.outs:
+            out.write(data)
+
+    def flush(self):
+        for out in self.outs:
+            out.flush()
+
+    def close(self):
+        for out in self.outs:
+            out.close()
+
 
 class TarFixer(object):
     """Code for updating a tar header's mtime.  For details on the tar format
@@ -61,42 +163,8 @@ class TarFixer(object):
     def __init__(self, fh, out, timestamp, gitref, maven_built=False):
         self.maven_built = maven_built
 
-        # As defined in tar.h
-        # An collections.OrderedDict would be more appropriate here but I'm trying to
-        # maintain Python 2.6 compatibility.
-        self.tar_struct = [
-            ('name', '100s'),
-            ('mode', '8s'),
-            ('uid', '8s'),
-            ('gid', '8s'),
-            ('size', '12s'),
-            ('mtime', '12s'),
-            ('checksum', '8s'),
-            ('typeflag', '1s'),
-            ('linkname', '100s'),
-            ('magic', '6s'),
-            ('version', '2s'),
-            ('uname', '32s'),
-            ('gname', '32s'),
-            ('devmajor', '8s'),
-            ('devminor', '8s'),
-            ('prefix', '155s'),
-        ]
-
-        # The items in the list below are zero-padded octal numbers in ASCII.
-        # All other fields are null-terminated character strings. Each numeric
-        # field of width w contains w minus 1 digits, and a null.
-        #
-        # The checksum is technically an octal_member but we handle it specially.
-        self.octal_members = [
-            'mode',
-            'uid',
-            'gid',
-            'size',
-            'mtime',
-            'devmajor',
-            'devminor',
-        ]
+        self.tar_struct = TAR_STRUCT
+        self.octal_members = OCTAL_MEMBERS
 
         # Add an '=' to use native byte order with standard sizes
         self.struct_template = "=" + "".join(map(lambda x: x[1], self.tar_struct))
@@ -117,28 +185,59 @@ def __init__(self, fh, out, timestamp, gitref, maven_built=False):
         self.timestamp = int(timestamp)
         self.gitref = gitref
 
+        # Every header gets the same mtime so only format it once
+        self.mtime_field = _octal_field(self.timestamp, _field_width('mtime'))
+
+        # Reused for every file we copy, see process_file_data
+        self.chunk_size = COPY_CHUNK_SIZE
+        self.copy_buffer = None
+
+        # Called with the path of every member as it streams by
+        self.member_callback = None
+
+        # Text mode output has to be decoded, and a chunk boundary can fall
+        # in the middle of a multibyte character.
+        self.decoder = codecs.getincrementaldecoder("utf8")()
+
     def full_read(self, read_size):
         read = self.fh.read(read_size)
         amount_read = len(read)
+        if amount_read == read_size:
+            return read
+
+        reads = [read]
         while (amount_read < read_size):
             left_to_read = read_size - amount_read
             next_read = self.fh.read(left_to_read)
 
-            if next_read == '':
+            if not next_read:
                 raise IOError("Buffer underflow when reading")
 
             amount_read += len(next_read)
-            read = read + next_read
+            reads.append(next_read)
+
+        return read[:0].join(reads)
+
+    def full_readinto(self, view):
+        """Fill the given memoryview from the input file."""
+        amount_read = 0
+        while amount_read < len(view):
+            read = self.fh.readinto(view[amount_read:])
+            if not read:
+                raise IOError("Buffer underflow when reading")
+            amount_read += read
 
-        return read
+    def _out_is_binary(self):
+        return hasattr(self.out, 'mode') and 'b' in self.out.mode
 
     def write(self, data):
         """Write the data correctly depending on the mode of the file.  While binary mode
         is preferred, we support text mode for streams like stdout."""
-        if hasattr(self.out, 'mode') and 'b' in self.out.mode:
-            data = bytearray(data)
-        else:
-            data = decode_bytes(data, "utf8")
+        if not self._out_is_binary():
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            if not PY2:
+                data = self.decoder.decode(data)
         self.out.write(data)
 
     def chunk_to_hash(self, chunk):
@@ -189,11 +288,8 @@ def encode_header(self, chunk_props, encode_order=None):
         for member in encode_order:
             if member in self.octal_members:
                 # Pad out the octal value to the right length
-                member_template = self.struct_hash[member]
-                field_size = int(re.match('(\d+)', member_template).group(1)) - 1
-                fmt = "%0" + str(field_size) + "o\x00"
-                as_string = fmt % chunk_props[member]
-                pack_values.append(as_string.encode("utf8"))
+                field_size = struct.calcsize(self.struct_hash[member])
+                pack_values.append(_octal_field(chunk_props[member], field_size))
             else:
                 pack_values.append(chunk_props[member].encode("utf8"))
         return pack_values
@@ -203,10 +299,7 @@ def process_header(self, chunk_props):
         chunk_props['checksum'] = self.calculate_checksum(chunk_props)
         pack_values = self.encode_header(chunk_props)
 
-        # The struct itself is only 500 bytes so we have to pad it to 512
-        data_out = struct.pack(self.struct_template + "12x", *pack_values)
-        self.write(data_out)
-        self.total_length += len(data_out)
+        self.write_header(HEADER_STRUCT.pack(*pack_values))
 
     def process_extended_header(self):
         # Trash the original comment
@@ -226,9 +319,79 @@ def create_extended_header(self):
         self.total_length += len(data_out)
 
     def process_file_data(self, size):
-        data_out = self.full_read(self.padded_size(size))
-        self.write(data_out)
-        self.total_length += len(data_out)
+        length = self.padded_size(size)
+        if length == 0:
+            return
+
+        if not self._copy_file_range(length):
+            if hasattr(self.fh, 'readinto'):
+                self._copy_chunks(length)
+            else:
+                remaining = length
+                while remaining > 0:
+                    data_out = self.full_read(min(remaining, self.chunk_size))
+                    self.write(data_out)
+                    remaining -= len(data_out)
+        self.total_length += length
+
+    def _copy_chunks(self, length):
+        """Copy length bytes from the input to the output through one reusable
+        buffer."""
+        if self.copy_buffer is None:
+            self.copy_buffer = memoryview(bytearray(self.chunk_size))
+        remaining = length
+        while remaining > 0:
+            view = self.copy_buffer[:min(remaining, self.chunk_size)]
+            self.full_readinto(view)
+            self.write(view)
+            remaining -= len(view)
+
+    def _copy_file_range(self, length):
+        """When reading from and writing to regular files, let the kernel copy
+        the data without it ever passing through Python.  Returns False if that
+        isn't possible and the caller should copy the data itself."""
+        copy_func = getattr(os, 'copy_file_range', None)
+        if copy_func is None:
+            copy_func = getattr(os, 'sendfile', None)
+            if copy_func is None:
+                return False
+        if not (_is_real_file(self.fh) and _is_real_file(self.out)):
+            return False
+        try:
+            in_fd = self.fh.fileno()
+            out_fd = self.out.fileno()
+            if not (stat.S_ISREG(os.fstat(in_fd).st_mode) and
+                    stat.S_ISREG(os.fstat(out_fd).st_mode)):
+                return False
+            in_pos = self.fh.tell()
+            self.out.flush()
+            out_pos = self.out.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            # Not a real file, e.g. a pipe or a gzip stream.
+            return False
+
+        # Both file objects are buffered, so copy relative to their logical
+        # positions and seek them past the copied data afterwards.
+        os.lseek(out_fd, out_pos, os.SEEK_SET)
+        copied = 0
+        while copied < length:
+            try:
+                if copy_func is os.sendfile:
+                    count = copy_func(out_fd, in_fd, in_pos + copied, length - copied)
+                else:
+                    count = copy_func(in_fd, out_fd, length - copied, in_pos + copied)
+            except OSError:
+                if copied:
+                    raise
+                # e.g. EXDEV on older kernels, fall back to copying ourselves
+                self.out.seek(out_pos)
+                return False
+            if count == 0:
+                raise IOError("Buffer underflow when reading")
+            copied += count
+        self.fh.seek(in_pos + length)
+        self.out.seek(out_pos + length)
+        return True
 
     def calculate_checksum(self, chunk_props):
         """The checksum field is the ASCII representation of the octal value of the simple
@@ -239,13 +402,56 @@ def calculate_checksum(self, chunk_props):
         """
         chunk_props['checksum'] = " " * 8
         values = self.encode_header(chunk_props)
-        new_chksum = 0
-        for val in values:
-            val_bytes = val.decode("utf8")
-            for b in val_bytes:
-                new_chksum += ord(b)
+        new_chksum = sum(bytearray(b"".join(values)))
         return "%07o\x00" % new_chksum
 
+    def header_value(self, header, member):
+        """Return a member of a raw header record without its NUL padding."""
+        return bytes(header[HEADER_FIELDS[member]]).rstrip(b"\x00")
+
+    def member_path(self, header):
+        """Return the path of the member a raw header record describes."""
+        path = self.header_value(header, 'name')
+        prefix = self.header_value(header, 'prefix')
+        if prefix:
+            path = prefix + b"/" + path
+        return decode_bytes(path, 'utf8')
+
+    def normalize_octal(self, header, member, value=None):
+        """Reformat an octal member of a raw header record in place."""
+        if value is None:
+            value = self.header_value(header, member)
+        header[HEADER_FIELDS[member]] = _octal_field(int(value, 8), _field_width(member))
+
+    def normalize_maven_header(self, header):
+        # Maven does all sorts of horrible things in the tarfile it creates.
+        # Everything is padded out with spaces instead of NUL bytes and the uid
+        # and gid fields are left empty.
+        #
+        # Plus it sets the uname and gname to the current user resulting in
+        # the checksum changing from person to person.
+        # See https://jira.codehaus.org/browse/PLXCOMP-233
+        for member in ['uname', 'gname']:
+            header[HEADER_FIELDS[member]] = b"root".ljust(_field_width(member), b"\x00")
+        for member in ['uid', 'gid']:
+            self.normalize_octal(header, member, b"0")
+        # In a tar file, the highest 3 bits in the mode represent if the tarfile
+        # should be extracted with the GID or UID set.  Maven adds these but we don't
+        # want them, so we just take the last 4 which are the ones that matter to us.
+        self.normalize_octal(header, 'mode', self.header_value(header, 'mode')[-4:-1])
+        header[HEADER_FIELDS['version']] = b"00"
+        for member in ['size', 'devmajor', 'devminor']:
+            self.normalize_octal(header, member, self.header_value(header, member).strip())
+
+    def header_checksum(self, header):
+        """Same as calculate_checksum but for a raw header record."""
+        header[HEADER_FIELDS['checksum']] = b" " * _field_width('checksum')
+        return ("%07o\x00" % sum(header[:CHECKSUMMED_LENGTH])).encode("ascii")
+
+    def write_header(self, header):
+        self.write(header)
+        self.total_length += len(header)
+
     def process_chunk(self, chunk):
         # Tar archives end with two 512 byte blocks of zeroes
         if chunk == b"\x00" * 512:
@@ -260,59 +466,44 @@ def process_chunk(self, chunk):
 
         self.last_chunk_was_nulls = False
 
-        chunk_props = self.chunk_to_hash(chunk)
-
-        # Delete the old checksum since it's now invalid and we don't want even
-        # an inadvertent reference to it.
-        del(chunk_props['checksum'])
-
-        # Remove the trailing NUL byte(s) on the end of members
-        for k, v in chunk_props.items():
-            chunk_props[k] = v.rstrip("\x00")
+        header = bytearray(chunk)
 
         # This line is the whole purpose of this class!
-        chunk_props['mtime'] = "%o" % self.timestamp
+        header[HEADER_FIELDS['mtime']] = self.mtime_field
 
         if self.maven_built:
-            # Maven does all sorts of horrible things in the tarfile it creates.
-            # Everything is padded out with spaces instead of NUL bytes and the uid
-            # and gid fields are left empty.
-            #
-            # Plus it sets the uname and gname to the current user resulting in
-            # the checksum changing from person to person.
-            # See https://jira.codehaus.org/browse/PLXCOMP-233
-            chunk_props['uname'] = 'root'
-            chunk_props['gname'] = 'root'
-            chunk_props['uid'] = '0'
-            chunk_props['gid'] = '0'
-            # In a tar file, the highest 3 bits in the mode represent if the tarfile
-            # should be extracted with the GID or UID set.  Maven adds these but we don't
-            # want them, so we just take the last 4 which are the ones that matter to us.
-            chunk_props['mode'] = str(chunk_props['mode'])[-4:-1]
-            chunk_props['version'] = '00'
-            for x in ['size', 'devmajor', 'devminor']:
-                chunk_props[x] = chunk_props[x].strip()
+            self.normalize_maven_header(header)
 
+        # Rewrite the remaining octals so they are padded the same way git does it
         for member in self.octal_members:
-            # Convert octals to decimal
-            chunk_props[member] = int(chunk_props[member], 8)
+            if member != 'mtime':
+                self.normalize_octal(header, member)
+
+        header[CHECKSUMMED_LENGTH:] = b"\x00" * (RECORD_SIZE - CHECKSUMMED_LENGTH)
+        header[HEADER_FIELDS['checksum']] = self.header_checksum(header)
+
+        typeflag = self.header_value(header, 'typeflag')
+        size = int(self.header_value(header, 'size'), 8)
+
+        if self.member_callback and typeflag not in (b'g', b'x'):
+            self.member_callback(self.member_path(header))
 
         # If there is no global header, we need to create one
         if self.need_header:
             # When run against a tree ID, git archive doesn't create
             # a global header.  The first block is just the header for
             # the first file.
-            if chunk_props['typeflag'] != 'g':
+            if typeflag != b'g':
                 self.create_global_header()
                 self.create_extended_header()
-                self.process_header(chunk_props)
+                self.write_header(header)
             else:
-                self.process_header(chunk_props)
+                self.write_header(header)
                 self.process_extended_header()
             self.need_header = False
         else:
-            self.process_header(chunk_props)
-            self.process_file_data(chunk_props['size'])
+            self.write_header(header)
+            self.process_file_data(size)
 
     def fix(self):
         # The gzip file object has its mode as an integer.  We have to
@@ -0,0 +1,227 @@
+# Copyright (c) 2008-2014 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+"""
+Records where tito spends its time.
+
+With --trace FILE (or TITO_TRACE=FILE in the environment) every phase of a
+run (loading config, creating builders, tgz, srpm, rpm, sync, commit, push,
+submit...) and every command tito runs is written to FILE in the Chrome
+trace event format, which chrome://tracing, Perfetto and speedscope can
+show. A summary table is printed when tito exits.
+
+With TITO_TRACE_PROFILE=1 each top level phase is also run under cProfile,
+the statistics go to FILE.<n>-<phase>.prof.
+
+Nothing here imports the rest of tito so it can be used from anywhere,
+including tito.compat.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The Tracer of this run, None when not tracing.
+_tracer = None
+
+
+class CommandRecord(object):
+    """ Handed to the code running a traced command to fill in the status. """
+
+    def __init__(self):
+        self.status = None
+
+
+class Tracer(object):
+    """
+    Collects trace events, in microseconds since the tracer was created.
+    """
+
+    def __init__(self, path, profile=False):
+        self.path = path
+        self.profile = profile
+        self.start = time.time()
+        self.events = []
+        self.depth = 0
+        self.profiles = 0
+        self.pid = os.getpid()
+
+    def _now(self):
+        return int((time.time() - self.start) * 1000000)
+
+    def _event(self, name, category, start, args):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": self._now() - start,
+            "pid": self.pid,
+            "tid": threading.current_thread().ident,
+            "args": args,
+        })
+
+    @contextmanager
+    def phase(self, name, args):
+        start = self._now()
+        profiler = None
+        if self.profile and self.depth == 0:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+                self.profiles += 1
+                profile_path = "%s.%d-%s.prof" % (self.path, self.profiles, name)
+                profiler.dump_stats(profile_path)
+                args = dict(args, profile=profile_path)
+            self._event(name, "phase", start, args)
+
+    @contextmanager
+    def command(self, command, cwd):
+        start = self._now()
+        before = _child_usage()
+        record = CommandRecord()
+        try:
+            yield record
+        finally:
+            after = _child_usage()
+            args = {"cwd": cwd, "status": record.status}
+            if isinstance(command, (list, tuple)):
+                args["argv"] = list(command)
+                command = " ".join(command)
+            else:
+                args["command"] = command
+            if before and after:
+                args["user_cpu"] = round(after.ru_utime - before.ru_utime, 3)
+                args["system_cpu"] = round(after.ru_stime - before.ru_stime, 3)
+                # The largest of all children so far, there's no per child RSS
+                args["max_child_rss_kb"] = after.ru_maxrss
+            self._event(command.split(" ", 1)[0], "command", start, args)
+
+    def summary(self):
+        """
+        Return (category, name, count, total seconds, longest seconds) for
+        every phase and command name, phases first, slowest first.
+        """
+        totals = {}
+        for event in self.events:
+            key = (event["cat"], event["name"])
+            (count, total, longest) = totals.get(key, (0, 0, 0))
+            totals[key] = (count + 1, total + event["dur"], max(longest, event["dur"]))
+        rows = [(cat, name, count, total / 1000000.0, longest / 1000000.0)
+            for ((cat, name), (count, total, longest)) in totals.items()]
+        rows.sort(key=lambda row: (row[0] != "phase", -row[3]))
+        return rows
+
+    def write(self):
+        trace = {
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "argv": sys.argv,
+                "summary": [dict(zip(("category", "name", "count", "total", "longest"), row))
+                    for row in self.summary()],
+            },
+        }
+        f = open(self.path, 'w')
+        try:
+            json.dump(trace, f, indent=1)
+        finally:
+            f.close()
+
+    def print_summary(self, out=None):
+        out = out or sys.stderr
+        print("%-8s %-30s %6s %10s %10s" % ("", "name", "count", "total (s)", "max (s)"),
+            file=out)
+        for (category, name, count, total, longest) in self.summary():
+            print("%-8s %-30s %6d %10.3f %10.3f" % (category, name[:30], count, total,
+                longest), file=out)
+        print("Trace written to %s" % self.path, file=out)
+
+
+def _child_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN)
+
+
+def start_tracing(path, profile=None):
+    """
+    Start recording to path, unless already tracing. profile defaults to
+    the TITO_TRACE_PROFILE environment variable.
+    """
+    global _tracer
+    if _tracer is not None:
+        return
+    if profile is None:
+        profile = os.environ.get('TITO_TRACE_PROFILE', '') not in ('', '0')
+    _tracer = Tracer(os.path.abspath(path), profile)
+
+
+def start_tracing_from_environment():
+    if os.environ.get('TITO_TRACE'):
+        start_tracing(os.environ['TITO_TRACE'])
+
+
+def stop_tracing():
+    """ Write the trace and print the summary, if we were tracing. """
+    global _tracer
+    if _tracer is None:
+        return
+    tracer = _tracer
+    _tracer = None
+    tracer.write()
+    tracer.print_summary()
+
+
+def is_tracing():
+    return _tracer is not None
+
+
+@contextmanager
+def trace_phase(name, **args):
+    """ Record the code run in the with block as a phase called name. """
+    if _tracer is None:
+        yield
+    else:
+        with _tracer.phase(name, args):
+            yield
+
+
+@contextmanager
+def trace_command(command, cwd=None):
+    """
+    Record running command (a shell command line or an argument list) in
+    the with block. Set the status attribute of what is yielded to the exit
+    status.
+    """
+    if _tracer is None:
+        yield CommandRecord()
+    else:
+        with _tracer.command(command, cwd or os.getcwd()) as record:
+            yield record
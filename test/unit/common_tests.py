@@ -17,13 +17,18 @@
     search_for, compare_version, run_command_print, find_wrote_in_rpmbuild_output,
     render_cheetah, increase_zstream, reset_release, find_file_with_extension,
     normalize_class_name, extract_sha1, BugzillaExtractor, DEFAULT_BUILD_DIR, munge_specfile,
-    munge_setup_macro,
-    _out)
+    munge_setup_macro, get_source0, get_spec_file_references, run_argv,
+    run_command, RpmbuildOutput, _out, create_tgz)
+from tito.exception import RunCommandException, TitoException
 
 from tito.compat import StringIO
 
+import gzip
 import os
 import re
+import shutil
+import sys
+import tempfile
 import unittest
 
 from mock import Mock, patch, call
@@ -99,6 +104,25 @@ def test_extract_sha1(self):
         self.assertEquals("fe87e2b75ed1850718d99c797cc171b88bfad5ca",
                           extract_sha1(ls_remote_output))
 
+    def test_get_source0(self):
+        lines = ["Name: tito", "Source0: %{name}-%{version}.tar.xz", "Source1: other.tar.gz"]
+        self.assertEqual("%{name}-%{version}.tar.xz", get_source0(lines))
+        lines = ["Source:   https://example.com/download/tito.tar.bz2#/tito-1.0.tar.bz2"]
+        self.assertEqual("tito-1.0.tar.bz2", get_source0(lines))
+        self.assertEqual(None, get_source0(["Name: tito", "Source1: other.tar.gz"]))
+
+    def test_get_spec_file_references(self):
+        lines = [
+            "Source0: %{name}-%{version}.tar.gz",
+            "Source1: extra.conf",
+            "Source2: https://example.com/tito.tar.gz",
+            "Patch0:  fix.patch",
+            "Patch1: %{name}-fix.patch",
+            "Requires: extra.conf",
+        ]
+        self.assertEqual(["%{name}-%{version}.tar.gz", "extra.conf", "fix.patch",
+            "%{name}-fix.patch"], get_spec_file_references(lines))
+
     def test_compare_version(self):
         self.assertEquals(0, compare_version("1", "1"))
         self.assertTrue(compare_version("2.1", "2.2") < 0)
@@ -120,6 +144,78 @@ def test_compare_version(self):
     def test_run_command_print(self):
         self.assertEquals('', run_command_print("sleep 0.1"))
 
+    def test_run_command_print_streams_lines(self):
+        lines = []
+        with Capture(silent=True):
+            output = run_command_print("seq 1 1000", line_callbacks=[lines.append],
+                tail_lines=3)
+        self.assertEquals([str(i) for i in range(1, 1001)], lines)
+        self.assertEquals("998\n999\n1000", output)
+
+    def test_run_command_print_log_file(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            log_file = os.path.join(log_dir, "build.log.gz")
+            with Capture(silent=True):
+                run_command_print("seq 1 1000", log_file=log_file, tail_lines=1)
+            log = gzip.open(log_file, 'rb')
+            try:
+                self.assertEquals("".join("%d\n" % i for i in range(1, 1001)),
+                    log.read().decode('utf8'))
+            finally:
+                log.close()
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_run_command_print_failure_keeps_tail(self):
+        with Capture(silent=True):
+            try:
+                run_command_print("sh -c 'seq 1 1000; exit 2'", tail_lines=2)
+                self.fail("RunCommandException not raised")
+            except RunCommandException:
+                err = sys.exc_info()[1]
+        self.assertEquals(2, err.status)
+        self.assertEquals("999\n1000", err.output)
+
+    def test_rpmbuild_output(self):
+        rpmbuild_output = RpmbuildOutput()
+        for line in ["Executing(%prep): /bin/sh -e /var/tmp/rpm-tmp.abc",
+                "Wrote: /tmp/tito/foo-1.0-1.src.rpm",
+                "Wrote: /tmp/tito/noarch/foo-1.0-1.noarch.rpm"]:
+            rpmbuild_output(line)
+        self.assertEquals(["/tmp/tito/foo-1.0-1.src.rpm",
+            "/tmp/tito/noarch/foo-1.0-1.noarch.rpm"], rpmbuild_output.wrote(""))
+        self.assertFalse(rpmbuild_output.failed_build_dependencies)
+        rpmbuild_output("error: Failed build dependencies:")
+        self.assertTrue(rpmbuild_output.failed_build_dependencies)
+
+    def test_run_argv(self):
+        result = run_argv(["sh", "-c", "echo out; echo err >&2; exit 3"])
+        self.assertEquals(3, result.status)
+        self.assertEquals("out\n", result.stdout)
+        self.assertEquals("err\n", result.stderr)
+        self.assertEquals("out\nerr", result.output)
+        self.assertTrue(result.elapsed >= 0)
+
+    def test_run_argv_without_shell(self):
+        result = run_argv(["echo", "it's a | b; $HOME"])
+        self.assertEquals("it's a | b; $HOME\n", result.stdout)
+
+    def test_run_argv_missing_command(self):
+        self.assertEquals(127, run_argv(["/nonexistent/tito-command"]).status)
+
+    def test_command_result_fields(self):
+        result = run_argv(["printf", "\\n  abc123 refs/tags/foo\\nsecond\\n"])
+        self.assertEquals(["  abc123 refs/tags/foo", "second"], result.lines())
+        self.assertEquals("  abc123 refs/tags/foo", result.first_line())
+        self.assertEquals("abc123", result.first_field())
+        self.assertEquals("", run_argv(["true"]).first_field())
+
+    def test_run_command_argv(self):
+        self.assertEquals("a b", run_command(["echo", "a b"]))
+        with Capture(silent=True):
+            self.assertRaises(RunCommandException, run_command, ["false"])
+
     def test_rpmbuild_claims_to_be_successful(self):
         succeeded_result = "success"
         output = "Wrote: %s" % succeeded_result
@@ -222,6 +318,39 @@ def test_colors(self, mock_user_conf):
         self.assertTrue(re.match('.+Hello world.+\n', stream.getvalue()))
 
 
+class CreateTgzTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.orig_cwd = os.getcwd()
+        self.repo_dir = os.path.join(self.work_dir, "repo")
+        os.mkdir(self.repo_dir)
+        f = open(os.path.join(self.repo_dir, "README"), "w")
+        f.write("tito\n")
+        f.close()
+        run_command("cd %s && git init -q && git add README && "
+            "git -c user.name=tito -c user.email=tito@example.com commit -q -m initial"
+            % self.repo_dir)
+        self.commit = run_command("cd %s && git rev-parse HEAD" % self.repo_dir)
+        self.dest = os.path.join(self.work_dir, "tito-1.0.tar.gz")
+
+    def tearDown(self):
+        os.chdir(self.orig_cwd)
+        shutil.rmtree(self.work_dir)
+
+    def test_compressor_error_is_reported(self):
+        # Not a NameError from cleaning up what was never created
+        self.assertRaises(TitoException, create_tgz, self.repo_dir, "tito-1.0",
+            self.commit, "/", self.dest, compression="rar")
+
+    def test_cache_write_fails(self):
+        cache = Mock()
+        cache.get.return_value = False
+        cache.put.side_effect = OSError(28, "No space left on device")
+        self.assertEqual("", create_tgz(self.repo_dir, "tito-1.0", self.commit, "/",
+            self.dest, cache=cache))
+        self.assertTrue(os.path.getsize(self.dest) > 0)
+
+
 class CheetahRenderTest(unittest.TestCase):
     @patch("os.unlink")
     @patch("glob.glob")
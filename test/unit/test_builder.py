@@ -0,0 +1,191 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock
+
+from tito import specfile
+from tito.builder.main import Builder, BuilderBase
+from tito.compat import RawConfigParser, StringIO
+
+
+class FakeBuilder(BuilderBase):
+    """
+    Writes a tarball named after its version, and an srpm with_srpm,
+    counting the builds.
+    """
+
+    def __init__(self, build_dir, version="1.0", with_srpm=False):
+        BuilderBase.__init__(self, name="foo", build_dir=build_dir, user_config={}, args={})
+        self.build_tag = "foo-%s-1" % version
+        self.version = version
+        self.with_srpm = with_srpm
+        self.srpm_location = None
+        self.builds = 0
+
+    def artifact_cache_inputs(self, options):
+        return {'version': self.version, 'tgz': options.tgz}
+
+    def tgz(self):
+        self.builds += 1
+        names = ["foo-%s.tar.gz" % self.version]
+        if self.with_srpm:
+            names.append("foo-%s-1.src.rpm" % self.version)
+        for name in names:
+            path = os.path.join(self.rpmbuild_basedir, name)
+            f = open(path, "w")
+            f.write("build %s" % self.builds)
+            f.close()
+            self.artifacts.append(path)
+
+
+class Options(object):
+    def __init__(self, **kwargs):
+        self.tgz = True
+        self.srpm = False
+        self.rpm = False
+        self.no_cleanup = False
+        self.force_rebuild = False
+        self.__dict__.update(kwargs)
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.orig_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.orig_stdout
+        shutil.rmtree(self.build_dir)
+
+    def test_reuses_artifacts(self):
+        builder = FakeBuilder(self.build_dir)
+        artifacts = builder.run(Options())
+        self.assertEqual([os.path.join(self.build_dir, "foo-1.0.tar.gz")], artifacts)
+
+        builder = FakeBuilder(self.build_dir)
+        self.assertEqual(artifacts, builder.run(Options()))
+        self.assertEqual(0, builder.builds)
+        self.assertTrue("  %s\n" % artifacts[0] in sys.stdout.getvalue())
+        self.assertFalse(os.path.exists(builder.rpmbuild_dir))
+
+        builder = FakeBuilder(self.build_dir, version="1.1")
+        builder.run(Options())
+        self.assertEqual(1, builder.builds)
+
+    def test_force_rebuild(self):
+        FakeBuilder(self.build_dir).run(Options())
+        builder = FakeBuilder(self.build_dir)
+        builder.run(Options(force_rebuild=True))
+        self.assertEqual(1, builder.builds)
+
+        # What we just built is reused next time:
+        builder = FakeBuilder(self.build_dir)
+        builder.run(Options())
+        self.assertEqual(0, builder.builds)
+
+    def test_srpm_location(self):
+        FakeBuilder(self.build_dir, with_srpm=True).run(Options())
+        builder = FakeBuilder(self.build_dir, with_srpm=True)
+        builder.run(Options())
+        self.assertEqual(0, builder.builds)
+        self.assertEqual(os.path.join(self.build_dir, "foo-1.0-1.src.rpm"),
+            builder.srpm_location)
+
+    def test_changed_artifact(self):
+        FakeBuilder(self.build_dir).run(Options())
+        os.unlink(os.path.join(self.build_dir, "foo-1.0.tar.gz"))
+        builder = FakeBuilder(self.build_dir)
+        builder.run(Options())
+        self.assertEqual(1, builder.builds)
+
+    def test_not_cacheable(self):
+        for i in range(2):
+            builder = FakeBuilder(self.build_dir)
+            builder.artifact_cache_inputs = lambda options: None
+            builder.run(Options())
+            self.assertEqual(1, builder.builds)
+
+    def test_disabled(self):
+        builder = FakeBuilder(self.build_dir)
+        builder.user_config = {'ARTIFACT_CACHE_SIZE': '0'}
+        self.assertEqual(None, builder._get_artifact_cache())
+
+
+class CompressionThreadsTest(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp()
+        self.builder = FakeBuilder(self.build_dir)
+        self.builder.config = RawConfigParser()
+        self.builder.config.add_section("buildconfig")
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def test_gzip_unless_the_project_says_otherwise(self):
+        self.builder.user_config = {'COMPRESSION_THREADS': '4'}
+        self.assertEqual(0, self.builder._get_compression_threads('gz'))
+        self.assertEqual(4, self.builder._get_compression_threads('xz'))
+
+    def test_parallel_gzip(self):
+        self.builder.config.set("buildconfig", "compression_threads", "2")
+        self.assertEqual(2, self.builder._get_compression_threads('gz'))
+        # ~/.titorc changes the number of threads, never the format:
+        self.builder.user_config = {'COMPRESSION_THREADS': '0'}
+        self.assertEqual(1, self.builder._get_compression_threads('gz'))
+        self.assertEqual(0, self.builder._get_compression_threads('bz2'))
+
+
+class SpecFileReferencesTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.builder = Builder.__new__(Builder)
+        self.builder.scl = ''
+        self.builder.spec_file = os.path.join(self.work_dir, "foo.spec")
+        self.orig_rpm = sys.modules.get('rpm')
+        self.orig_path = os.environ['PATH']
+        specfile._specs.clear()
+        specfile._macros.clear()
+
+    def tearDown(self):
+        if self.orig_rpm is None:
+            sys.modules.pop('rpm', None)
+        else:
+            sys.modules['rpm'] = self.orig_rpm
+        os.environ['PATH'] = self.orig_path
+        specfile._specs.clear()
+        specfile._macros.clear()
+        shutil.rmtree(self.work_dir)
+
+    def write_spec(self, *lines):
+        f = open(self.builder.spec_file, "w")
+        f.write("\n".join(("Name: foo", "Version: 1.0") + lines) + "\n")
+        f.close()
+
+    def test_bindings(self):
+        rpm = Mock()
+        spec = Mock()
+        spec.sourceHeader = {rpm.RPMTAG_NAME: b'foo', rpm.RPMTAG_VERSION: b'1.0',
+            rpm.RPMTAG_RELEASE: b'1', rpm.RPMTAG_REQUIRENAME: []}
+        spec.packages = []
+        spec.sources = [(b'https://example.com/foo-1.0.tar.gz', 0, 1),
+            (b'foo.conf', 1, 1), (b'foo-fix.patch', 0, 2)]
+        rpm.spec.return_value = spec
+        sys.modules['rpm'] = rpm
+        self.write_spec("Source1: %{name}.conf")
+        self.assertEqual(["foo-1.0.tar.gz", "foo.conf", "foo-fix.patch"],
+            self.builder._spec_file_references())
+
+    def test_without_rpm(self):
+        # Neither the bindings nor the rpm command
+        sys.modules['rpm'] = None
+        os.environ['PATH'] = os.path.join(self.work_dir, "empty")
+        self.write_spec("Source1: foo.conf", "Patch0: fix.patch")
+        self.assertEqual(["foo.conf", "fix.patch"], self.builder._spec_file_references())
+
+        # Names with macros can't be expanded, export everything
+        self.write_spec("Source1: %{name}.conf")
+        self.assertEqual(None, self.builder._spec_file_references())
@@ -0,0 +1,209 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tito import cache as cache_module
+from tito.cache import ArtifactCache, CommitCountCache, MockRootCache, \
+    RemoteTagCache, TarballCache
+
+
+class TarballCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, "cache")
+        self.cache = TarballCache(self.cache_dir, 250)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        return path
+
+    def read(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_key(self):
+        key = self.cache.key("tree", "tito-1.0", 1429725106, "commit", "gz-gzip")
+        self.assertEqual(key, self.cache.key("tree", "tito-1.0", 1429725106, "commit", "gz-gzip"))
+        self.assertNotEqual(key, self.cache.key("tree", "tito-1.0", 1429725106, "commit", "xz"))
+        self.assertNotEqual(self.cache.key("ab", "c"), self.cache.key("a", "bc"))
+
+    def test_miss(self):
+        dest = os.path.join(self.work_dir, "dest.tar.gz")
+        self.assertFalse(self.cache.get("nope", dest))
+        self.assertFalse(os.path.exists(dest))
+
+    def test_put_and_get(self):
+        self.cache.put("key", self.write("src.tar.gz", b"tarball"))
+        dest = os.path.join(self.work_dir, "dest.tar.gz")
+        self.assertTrue(self.cache.get("key", dest))
+        self.assertEqual(b"tarball", self.read(dest))
+        self.assertEqual(["key"], os.listdir(self.cache_dir))
+
+    def test_evicts_least_recently_used(self):
+        for key in ["a", "b"]:
+            self.cache.put(key, self.write(key, b"x" * 100))
+        # Make "a" the oldest entry, then use it so "b" is evicted instead
+        past = time.time() - 100
+        os.utime(os.path.join(self.cache_dir, "a"), (past, past))
+        os.utime(os.path.join(self.cache_dir, "b"), (past + 1, past + 1))
+        self.assertTrue(self.cache.get("a", os.path.join(self.work_dir, "dest")))
+
+        self.cache.put("c", self.write("c", b"x" * 100))
+        self.assertEqual(["a", "c"], sorted(os.listdir(self.cache_dir)))
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, ".cache", "artifacts")
+        self.cache = ArtifactCache(self.cache_dir, 250)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+        return path
+
+    def test_key(self):
+        inputs = {'commit': "abc", 'dist': ".el8", 'args': [("mock", ["epel-8"])]}
+        self.assertEqual(self.cache.key(inputs), self.cache.key(dict(inputs)))
+        self.assertNotEqual(self.cache.key(inputs), self.cache.key(dict(inputs, dist=".el9")))
+
+    def test_put_and_get(self):
+        self.assertEqual(None, self.cache.get("key"))
+        artifacts = [self.write("foo-1.0-1.src.rpm", b"srpm"),
+            self.write("foo-1.0-1.noarch.rpm", b"rpm")]
+        self.cache.put("key", {'commit': "abc"}, artifacts)
+        self.assertEqual(artifacts, self.cache.get("key"))
+
+    def test_changed_artifact(self):
+        path = self.write("foo-1.0-1.noarch.rpm", b"rpm")
+        self.cache.put("key", {}, [path])
+        self.write("foo-1.0-1.noarch.rpm", b"rebuilt")
+        self.assertEqual(None, self.cache.get("key"))
+        os.unlink(path)
+        self.assertEqual(None, self.cache.get("key"))
+
+    def test_evicts_least_recently_used(self):
+        for key in ["a", "b"]:
+            self.cache.put(key, {}, [self.write(key + ".rpm", b"x" * 100)])
+        # Make "a" the oldest entry, then use it so "b" is evicted instead
+        past = time.time() - 100
+        os.utime(os.path.join(self.cache_dir, "a.json"), (past, past))
+        os.utime(os.path.join(self.cache_dir, "b.json"), (past + 1, past + 1))
+        self.assertTrue(self.cache.get("a"))
+
+        self.cache.put("c", {}, [self.write("c.rpm", b"x" * 100)])
+        self.assertEqual(["a.json", "c.json"], sorted(os.listdir(self.cache_dir)))
+        # The artifacts are the user's, only the manifest goes:
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "b.rpm")))
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "a.rpm")))
+
+
+class RemoteTagCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = RemoteTagCache(os.path.join(self.cache_dir, "remote-tags"), 300)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_miss(self):
+        self.assertEqual(None, self.cache.load("git://example.com/repo.git"))
+
+    def test_save_and_load(self):
+        self.cache.save("git://example.com/repo.git", {"foo-1.0-1": "abc"})
+        self.assertEqual({"foo-1.0-1": "abc"}, self.cache.load("git://example.com/repo.git"))
+        self.assertEqual(None, self.cache.load("git://example.com/other.git"))
+
+    def test_expired(self):
+        self.cache.save("git://example.com/repo.git", {"foo-1.0-1": "abc"})
+        expired = RemoteTagCache(self.cache.cache_dir, 300)
+        real_time = time.time
+        time.time = lambda: real_time() + 301
+        try:
+            self.assertEqual(None, expired.load("git://example.com/repo.git"))
+        finally:
+            time.time = real_time
+
+
+class CommitCountCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, "tito", "commit-counts.json")
+        self.cache = CommitCountCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_put_and_get(self):
+        self.assertEqual(None, self.cache.get("roots", "abc"))
+        self.cache.put("tag foo-1.0-1 abc", "def", 3)
+        self.cache.put("tag foo-1.0-1 abc", "123", 5)
+        self.cache.put("tag foo-1.0-1 abc", "def", 4)
+        stored = CommitCountCache(self.path)
+        self.assertEqual(4, stored.get("tag foo-1.0-1 abc", "def"))
+        self.assertEqual(None, stored.get("roots", "def"))
+        self.assertEqual([("def", 4), ("123", 5)], stored.recent("tag foo-1.0-1 abc", 5))
+
+    def test_drops_oldest(self):
+        orig_entries = cache_module.COMMIT_COUNT_CACHE_ENTRIES
+        cache_module.COMMIT_COUNT_CACHE_ENTRIES = 2
+        try:
+            for commit in ("a", "b", "c"):
+                self.cache.put("roots", commit, [commit])
+        finally:
+            cache_module.COMMIT_COUNT_CACHE_ENTRIES = orig_entries
+        self.assertEqual(None, self.cache.get("roots", "a"))
+        self.assertEqual(["c"], self.cache.get("roots", "c"))
+
+    def test_unreadable(self):
+        os.makedirs(os.path.dirname(self.path))
+        f = open(self.path, 'w')
+        f.write("{not json")
+        f.close()
+        self.assertEqual(None, self.cache.get("roots", "a"))
+        self.cache.put("roots", "a", ["a"])
+        self.assertEqual(["a"], CommitCountCache(self.path).get("roots", "a"))
+
+
+class MockRootCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.cache_dir, ".cache", "mock-roots.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_put(self):
+        cache = MockRootCache(self.path)
+        self.assertEqual(None, cache.get("epel-9-x86_64-tito-foo"))
+        cache.put("epel-9-x86_64-tito-foo", "abc", 42.0)
+        state = MockRootCache(self.path).get("epel-9-x86_64-tito-foo")
+        self.assertEqual("abc", state["key"])
+        self.assertEqual(42.0, state["seconds"])
+        self.assertTrue(time.time() - state["time"] < 60)
+
+    def test_shared(self):
+        # Another tito process keeps the roots it warmed up
+        first = MockRootCache(self.path)
+        second = MockRootCache(self.path)
+        first.get("a")
+        second.put("b", "key-b", 1)
+        first.put("a", "key-a", 2)
+        self.assertEqual("key-b", MockRootCache(self.path).get("b")["key"])
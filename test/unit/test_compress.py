@@ -0,0 +1,90 @@
+import bz2
+import gzip
+import os
+import unittest
+
+from io import BytesIO
+
+from tito.compress import ParallelGzipFile, ParallelBzip2File, \
+    compressor_id, format_from_filename, parse_compression_format, \
+    parse_compression_threads, tool_version
+from tito.exception import TitoException
+
+
+class ParallelGzipFileTest(unittest.TestCase):
+    def setUp(self):
+        # Compressible but not trivially so, spanning a good few blocks
+        self.data = b"".join(os.urandom(64) + b"tito" * 1000 for i in range(100))
+
+    def compress(self, threads, write_size=1000, block_size=16 * 1024):
+        out = BytesIO()
+        with ParallelGzipFile(out, threads, block_size=block_size) as gzip_fh:
+            for i in range(0, len(self.data), write_size):
+                gzip_fh.write(self.data[i:i + write_size])
+        return out.getvalue()
+
+    def test_round_trip(self):
+        result = self.compress(4)
+        self.assertEqual(self.data, gzip.GzipFile(fileobj=BytesIO(result)).read())
+
+    def test_deterministic(self):
+        expected = self.compress(1)
+        self.assertEqual(expected, self.compress(8))
+        self.assertEqual(expected, self.compress(3, write_size=4099))
+
+    def test_gzip_n_header(self):
+        result = self.compress(2)
+        self.assertEqual(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03", result[:10])
+
+    def test_empty(self):
+        out = BytesIO()
+        ParallelGzipFile(out, 2).close()
+        self.assertEqual(b"", gzip.GzipFile(fileobj=BytesIO(out.getvalue())).read())
+
+    def test_write_after_close(self):
+        gzip_fh = ParallelGzipFile(BytesIO(), 2)
+        gzip_fh.close()
+        self.assertRaises(ValueError, gzip_fh.write, b"tito")
+
+    def test_bz2_round_trip(self):
+        out = BytesIO()
+        with ParallelBzip2File(out, 3, block_size=16 * 1024) as bz2_fh:
+            bz2_fh.write(self.data)
+        result = out.getvalue()
+        # One complete stream per block
+        self.assertTrue(result.count(b"BZh9") >= len(self.data) // (16 * 1024))
+        decompressed = b""
+        while result:
+            decompressor = bz2.BZ2Decompressor()
+            decompressed += decompressor.decompress(result)
+            result = decompressor.unused_data
+        self.assertEqual(self.data, decompressed)
+
+    def test_format_from_filename(self):
+        self.assertEqual("gz", format_from_filename("tito-1.0.tar.gz"))
+        self.assertEqual("gz", format_from_filename("tito-1.0.tgz"))
+        self.assertEqual("xz", format_from_filename("tito-1.0.tar.xz"))
+        self.assertEqual("zst", format_from_filename("tito-1.0.tar.zst"))
+        self.assertEqual("bz2", format_from_filename("tito-1.0.tar.bz2"))
+        self.assertEqual(None, format_from_filename("tito-1.0.zip"))
+        self.assertEqual(None, format_from_filename("tito-1.0.src.rpm"))
+
+    def test_parse_compression_format(self):
+        self.assertEqual("xz", parse_compression_format("xz"))
+        self.assertEqual("zst", parse_compression_format(".tar.zst"))
+        self.assertRaises(TitoException, parse_compression_format, "rar")
+
+    def test_parse_compression_threads(self):
+        self.assertEqual(4, parse_compression_threads("4"))
+        self.assertEqual(0, parse_compression_threads('"0"'))
+        self.assertTrue(parse_compression_threads("auto") >= 1)
+        self.assertRaises(TitoException, parse_compression_threads, "-1")
+        self.assertRaises(TitoException, parse_compression_threads, "many")
+
+    def test_compressor_id(self):
+        # The version of external tools is part of it:
+        self.assertTrue(compressor_id("gz", 0).startswith("gz-gzip-"))
+        self.assertTrue(tool_version("gzip") in compressor_id("gz", 0))
+        self.assertEqual(compressor_id("gz", 2), compressor_id("gz", 8))
+        self.assertNotEqual(compressor_id("gz", 0), compressor_id("gz", 2))
+        self.assertEqual("", tool_version("no-such-compressor"))
@@ -0,0 +1,281 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from tito.common import (export_git_file, get_build_commit,
+    get_commit_count, get_commit_timestamp, get_local_tag_sha1, get_relative_project_dir,
+    get_spec_lines_from_git, head_points_to_tag, list_git_dir, run_command,
+    tag_exists_locally)
+from tito.cache import RemoteTagCache
+from tito.context import forget_contexts, get_context, reset_contexts
+from tito.gitrepo import GitRepository, RemoteTags, get_repository
+
+
+def git(*args):
+    return subprocess.check_output(('git',) + args).decode('utf8').strip()
+
+
+class GitRepositoryTest(unittest.TestCase):
+    def setUp(self):
+        self.orig_cwd = os.getcwd()
+        self.repo_dir = tempfile.mkdtemp()
+        os.chdir(self.repo_dir)
+        git('init', '-q')
+        git('config', 'user.name', 'Tito Test')
+        git('config', 'user.email', 'tito@example.com')
+        os.makedirs(os.path.join('.tito', 'packages'))
+        os.makedirs(os.path.join('pkg', 'sub'))
+        self.write(os.path.join('.tito', 'packages', 'pkg'), "1.0-1 pkg/\n")
+        self.write(os.path.join('pkg', 'pkg.spec'), "Name: pkg\nSource0: pkg-1.0.tar.gz\n")
+        self.write(os.path.join('pkg', 'sub', 'file'), "content\n")
+        git('add', '.')
+        git('commit', '-q', '-m', 'Initial commit')
+        git('tag', '-a', '-m', 'Tagging', 'pkg-1.0-1')
+        self.commit = git('rev-parse', 'HEAD')
+
+    def tearDown(self):
+        reset_contexts()
+        os.chdir(self.orig_cwd)
+        shutil.rmtree(self.repo_dir)
+
+    def write(self, path, content):
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+
+    def test_get_repository(self):
+        repository = get_repository()
+        self.assertEqual(os.path.realpath(self.repo_dir), os.path.realpath(repository.path))
+        self.assertTrue(repository is get_repository(os.path.join(self.repo_dir, 'pkg')))
+
+    def test_not_a_repository(self):
+        empty_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(None, get_repository(empty_dir))
+        finally:
+            shutil.rmtree(empty_dir)
+
+    def test_read_objects(self):
+        repository = GitRepository(self.repo_dir)
+        try:
+            self.assertEqual(self.commit, repository.rev_parse("pkg-1.0-1^{commit}"))
+            self.assertEqual(git('rev-parse', 'HEAD:pkg'), repository.rev_parse("HEAD:pkg"))
+            self.assertEqual(b"content\n", repository.read_file("HEAD", "pkg/sub/file"))
+            self.assertEqual(["pkg.spec", "sub"], repository.list_tree("HEAD:pkg"))
+            self.assertEqual(int(git('log', '-1', '--format=%ct')),
+                repository.commit_timestamp("pkg-1.0-1"))
+            self.assertEqual("Tito Test", repository.config("user.name"))
+        finally:
+            repository.close()
+
+    def test_missing_objects(self):
+        repository = GitRepository(self.repo_dir)
+        try:
+            self.assertEqual(None, repository.rev_parse("nosuchtag"))
+            self.assertEqual(None, repository.read_file("HEAD", "pkg/missing"))
+            self.assertEqual(None, repository.read_file("HEAD", "pkg"))
+            self.assertEqual(None, repository.list_tree("HEAD:pkg/pkg.spec"))
+            self.assertEqual(None, repository.commit_timestamp("nosuchtag"))
+            self.assertEqual(None, repository.config("no.such-key"))
+            # Still usable after a miss
+            self.assertEqual(b"content\n", repository.read_file("HEAD", "pkg/sub/file"))
+        finally:
+            repository.close()
+
+    def test_helpers_share_processes(self):
+        dest = os.path.join(self.repo_dir, "exported.spec")
+        tag_sha1 = git('rev-parse', 'refs/tags/pkg-1.0-1')
+        spawned = []
+        popen = subprocess.Popen
+
+        def counting_popen(*args, **kwargs):
+            spawned.append(args[0])
+            return popen(*args, **kwargs)
+
+        subprocess.Popen = counting_popen
+        try:
+            for i in range(20):
+                self.assertEqual(self.commit, get_build_commit("pkg-1.0-1"))
+                self.assertTrue(head_points_to_tag("pkg-1.0-1"))
+                get_commit_timestamp("pkg-1.0-1")
+                self.assertEqual("pkg/", get_relative_project_dir("pkg", "pkg-1.0-1"))
+                self.assertEqual(["pkg.spec", "sub"], list_git_dir("pkg-1.0-1", "pkg/"))
+                self.assertEqual("Source0: pkg-1.0.tar.gz",
+                    get_spec_lines_from_git("pkg-1.0-1", "pkg/")[1])
+                export_git_file("pkg-1.0-1", "pkg/", "pkg.spec", dest)
+                self.assertTrue(tag_exists_locally("pkg-1.0-1"))
+                self.assertFalse(tag_exists_locally("pkg-1.0"))
+                self.assertEqual(tag_sha1, get_local_tag_sha1("pkg-1.0-1"))
+        finally:
+            subprocess.Popen = popen
+
+        # Finding the repository, one process each for --batch and
+        # --batch-check and reading the tags, instead of running git 200
+        # times.
+        self.assertEqual(4, len(spawned), spawned)
+        self.assertEqual(run_command("git show HEAD:pkg/pkg.spec"),
+            open(dest).read().strip())
+
+    def test_context_is_shared(self):
+        context = get_context()
+        self.assertTrue(context is get_context(os.path.join(self.repo_dir, 'pkg')))
+        self.assertEqual(".tito", context.config_dir)
+        self.assertEqual(os.path.join(context.git_root, ".tito"), context.rel_eng_dir)
+        self.assertEqual(self.commit, context.head)
+        self.assertEqual("Tito Test", context.git_user)
+        self.assertEqual("tito@example.com", context.git_email)
+        self.assertEqual(None, context.remote_url)
+
+    def test_context_invalidate(self):
+        context = get_context()
+        self.assertEqual(self.commit, context.head)
+        git('commit', '-q', '--allow-empty', '-m', 'Another commit')
+        git('config', 'remote.origin.url', 'git://example.com/pkg.git')
+        # Remembered until invalidated
+        self.assertEqual(self.commit, context.head)
+        context.invalidate()
+        self.assertEqual(git('rev-parse', 'HEAD'), context.head)
+        self.assertEqual('git://example.com/pkg.git', context.remote_url)
+
+    def test_forget_contexts(self):
+        context = get_context()
+        forget_contexts(os.path.dirname(self.repo_dir))
+        self.assertFalse(context is get_context())
+
+    def test_ref_index(self):
+        git('tag', 'pkg-0.9-1', 'HEAD')
+        refs = get_context().refs
+        self.assertTrue(refs.has_tag("pkg-1.0-1"))
+        self.assertFalse(refs.has_tag("pkg-1.0"))
+        self.assertEqual(git('rev-parse', 'refs/tags/pkg-1.0-1'), refs.tag_sha1("pkg-1.0-1"))
+        self.assertNotEqual(self.commit, refs.tag_sha1("pkg-1.0-1"))
+        self.assertEqual(self.commit, refs.tag_commit("pkg-1.0-1"))
+        # Lightweight tag
+        self.assertEqual(self.commit, refs.tag_sha1("pkg-0.9-1"))
+        self.assertEqual(self.commit, refs.tag_commit("pkg-0.9-1"))
+        self.assertEqual(None, refs.tag_commit("nosuchtag"))
+
+    def test_ref_index_updates(self):
+        context = get_context()
+        refs = context.refs
+        git('tag', '-a', '-m', 'Tagging', 'pkg-1.1-1')
+        self.assertFalse(refs.has_tag("pkg-1.1-1"))
+        refs.add_tag("pkg-1.1-1")
+        self.assertEqual(self.commit, refs.tag_commit("pkg-1.1-1"))
+        git('tag', '-d', 'pkg-1.1-1')
+        refs.remove_tag("pkg-1.1-1")
+        self.assertFalse(refs.has_tag("pkg-1.1-1"))
+
+        context.invalidate(refs=False)
+        self.assertTrue(refs is context.refs)
+        context.invalidate()
+        self.assertFalse(refs is context.refs)
+
+    def count_ls_remote(self, func):
+        listed = []
+        popen = subprocess.Popen
+
+        def counting_popen(*args, **kwargs):
+            if 'ls-remote' in args[0]:
+                listed.append(args[0])
+            return popen(*args, **kwargs)
+
+        subprocess.Popen = counting_popen
+        try:
+            func()
+        finally:
+            subprocess.Popen = popen
+        return len(listed)
+
+    def test_remote_tags(self):
+        tag_sha1 = git('rev-parse', 'refs/tags/pkg-1.0-1')
+        remote_tags = RemoteTags(self.repo_dir)
+
+        def lookups():
+            for i in range(10):
+                self.assertEqual(tag_sha1, remote_tags.tag_sha1("pkg-1.0-1"))
+                self.assertEqual("", remote_tags.tag_sha1("pkg-1.0"))
+        self.assertEqual(1, self.count_ls_remote(lookups))
+
+    def test_remote_tags_cache(self):
+        tag_sha1 = git('rev-parse', 'refs/tags/pkg-1.0-1')
+        cache = RemoteTagCache(os.path.join(self.repo_dir, "cache"), 300)
+        self.assertEqual(1, self.count_ls_remote(
+            lambda: RemoteTags(self.repo_dir, cache).tag_sha1("pkg-1.0-1")))
+
+        # Answered from the cache by the next invocation
+        self.assertEqual(0, self.count_ls_remote(lambda: self.assertEqual(tag_sha1,
+            RemoteTags(self.repo_dir, cache).tag_sha1("pkg-1.0-1", tag_sha1))))
+
+        # Unless asked to refresh
+        self.assertEqual(1, self.count_ls_remote(
+            lambda: RemoteTags(self.repo_dir, cache, refresh=True).tag_sha1("pkg-1.0-1")))
+
+        # A tag pushed since is looked up once
+        git('tag', '-a', '-m', 'Tagging', 'pkg-1.1-1')
+        remote_tags = RemoteTags(self.repo_dir, cache)
+
+        def lookups():
+            self.assertNotEqual("", remote_tags.tag_sha1("pkg-1.1-1"))
+            self.assertEqual("", remote_tags.tag_sha1("pkg-1.2-1"))
+        self.assertEqual(1, self.count_ls_remote(lookups))
+
+    def test_remote_tags_unreachable(self):
+        remote_tags = RemoteTags(os.path.join(self.repo_dir, "nonexistent"))
+        self.assertEqual("", remote_tags.tag_sha1("pkg-1.0-1"))
+        self.assertTrue(remote_tags.error)
+
+    def count_git(self, command, func):
+        """ Call func, return the number of "git <command>" it ran. """
+        ran = []
+        popen = subprocess.Popen
+
+        def counting_popen(*args, **kwargs):
+            if args[0][:2] == ['git', command]:
+                ran.append(args[0])
+            return popen(*args, **kwargs)
+
+        subprocess.Popen = counting_popen
+        try:
+            func()
+        finally:
+            subprocess.Popen = popen
+        return len(ran)
+
+    def add_commits(self, count):
+        for i in range(count):
+            git('commit', '-q', '--allow-empty', '-m', 'Commit %d' % i)
+        get_context().invalidate(refs=False)
+
+    def test_commit_count(self):
+        self.add_commits(3)
+        self.assertEqual(1, self.count_git('describe', lambda: self.assertEqual(3,
+            get_commit_count("pkg-1.0-1", git('rev-parse', 'HEAD')))))
+
+        # Counted from the last count on
+        self.add_commits(2)
+        reset_contexts()
+        self.assertEqual(0, self.count_git('describe', lambda: self.assertEqual(5,
+            get_commit_count("pkg-1.0-1", git('rev-parse', 'HEAD')))))
+        self.assertEqual(0, self.count_git('rev-list', lambda: self.assertEqual(5,
+            get_commit_count("pkg-1.0-1", 'HEAD'))))
+        self.assertEqual(0, get_commit_count("pkg-1.0-1", "pkg-1.0-1"))
+
+    def test_commit_count_without_tag(self):
+        self.add_commits(4)
+        expected = int(git('rev-list', '--count', 'HEAD')) - 1
+        self.assertEqual(expected, get_commit_count("pkg-2.0-1", 'HEAD'))
+        reset_contexts()
+        self.assertEqual(0, self.count_git('rev-list', lambda: self.assertEqual(expected,
+            get_commit_count("pkg-2.0-1", 'HEAD'))))
+
+        # Tagged after HEAD, describe can't find it
+        head = git('rev-parse', 'HEAD')
+        git('checkout', '-q', '-b', 'other', 'HEAD~2')
+        git('tag', '-a', '-m', 'Tagging', 'pkg-2.0-1', head)
+        reset_contexts()
+        self.assertEqual(expected - 2, get_commit_count("pkg-2.0-1", 'HEAD'))
+        self.assertTrue(os.path.exists(os.path.join(self.repo_dir, ".git", "tito",
+            "commit-counts.json")))
@@ -0,0 +1,140 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tito.builder.main import Builder
+from tito.compat import RawConfigParser
+from tito.release import KojiReleaser
+
+
+class FakeBuilder(object):
+    """ Builds srpms named after their scl and disttag, counting them. """
+
+    def __init__(self):
+        self.config = RawConfigParser()
+        self.user_config = {}
+        self.scl = ''
+        self.prepared = 0
+        self.srpms = []
+        self.lock = threading.Lock()
+        self.srpm_location = None
+
+    def prepare_srpm(self):
+        self.prepared += 1
+
+    def srpm_copy(self):
+        builder = FakeBuilder()
+        builder.srpms = self.srpms
+        builder.lock = self.lock
+        return builder
+
+    def srpm(self, dist=None):
+        self.srpm_location = "foo-1.0-1%s%s.src.rpm" % (self.scl or "", dist)
+        with self.lock:
+            self.srpms.append(self.srpm_location)
+
+
+class CopiedBuilder(Builder):
+    """ Copied by the real srpm_copy(), builds srpms into its artifacts. """
+
+    def __init__(self, rpmbuild_dir):
+        self.config = RawConfigParser()
+        self.user_config = {}
+        self.scl = ''
+        self.rpmbuild_dir = rpmbuild_dir
+        self.srpm_location = None
+        self.artifacts = []
+        self.sources = ["foo-1.0.tar.gz"]
+
+    def prepare_srpm(self):
+        pass
+
+    def srpm(self, dist=None):
+        self.srpm_location = "foo-1.0-1%s.src.rpm" % dist
+        self.sources.append("%s.patch" % dist)
+        self.artifacts.append(self.srpm_location)
+
+
+class KojiReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.builder = FakeBuilder()
+        self.releaser = KojiReleaser.__new__(KojiReleaser)
+        self.releaser.builder = self.builder
+        self.releaser.project_name = "foo"
+        self.releaser.executable = "koji"
+        self.releaser.profile = None
+        self.releaser.conf_file = None
+        self.releaser.only_tags = []
+        self.releaser.skip_srpm = False
+        self.releaser.scratch = False
+        self.submitted = []
+        self.releaser._submit_build = lambda executable, opts, tag, srpm: \
+            self.submitted.append((tag, srpm))
+
+    def release(self, tags):
+        for (tag, disttag, scl) in tags:
+            self.builder.config.add_section(tag)
+            self.builder.config.set(tag, "disttag", disttag)
+            if scl:
+                self.builder.config.set(tag, "scl", scl)
+        self.releaser.autobuild_tags = lambda: [tag for (tag, unused, unused2) in tags]
+        self.releaser._koji_release()
+
+    def test_srpm_per_disttag_and_scl(self):
+        self.release([
+            ("el7-candidate", ".el7", None),
+            ("el7-extras", ".el7", None),
+            ("el8-candidate", ".el8", None),
+            ("el7-scl", ".el7", "rh-foo"),
+        ])
+        self.assertEqual(1, self.builder.prepared)
+        self.assertEqual(["foo-1.0-1.el7.src.rpm", "foo-1.0-1.el8.src.rpm",
+            "foo-1.0-1rh-foo.el7.src.rpm"], sorted(self.builder.srpms))
+        # Submitted in the order of the tags
+        self.assertEqual([
+            ("el7-candidate", "foo-1.0-1.el7.src.rpm"),
+            ("el7-extras", "foo-1.0-1.el7.src.rpm"),
+            ("el8-candidate", "foo-1.0-1.el8.src.rpm"),
+            ("el7-scl", "foo-1.0-1rh-foo.el7.src.rpm"),
+        ], self.submitted)
+
+    def test_only_tags(self):
+        self.releaser.only_tags = ["el8-candidate"]
+        self.release([
+            ("el7-candidate", ".el7", None),
+            ("el8-candidate", ".el8", None),
+        ])
+        self.assertEqual(["foo-1.0-1.el8.src.rpm"], self.builder.srpms)
+        self.assertEqual([("el8-candidate", "foo-1.0-1.el8.src.rpm")], self.submitted)
+
+    def test_skip_srpm(self):
+        self.releaser.skip_srpm = True
+        self.release([("el7-candidate", ".el7", None)])
+        self.assertEqual(0, self.builder.prepared)
+        self.assertEqual([], self.builder.srpms)
+        self.assertEqual([("el7-candidate", None)], self.submitted)
+
+    def test_srpm_fails(self):
+        def fail(dist=None):
+            raise SystemExit(1)
+        self.builder.srpm_copy = lambda: self.builder
+        self.builder.srpm = fail
+        self.assertRaises(SystemExit, self.release, [("el7-candidate", ".el7", None)])
+        self.assertEqual([], self.submitted)
+
+    def test_srpm_copies_keep_their_artifacts(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.builder = CopiedBuilder(work_dir)
+            self.releaser.builder = self.builder
+            self.release([
+                ("el7-candidate", ".el7", None),
+                ("el8-candidate", ".el8", None),
+            ])
+        finally:
+            shutil.rmtree(work_dir)
+        self.assertEqual([("el7-candidate", "foo-1.0-1.el7.src.rpm"),
+            ("el8-candidate", "foo-1.0-1.el8.src.rpm")], self.submitted)
+        self.assertEqual([], self.builder.artifacts)
+        self.assertEqual(["foo-1.0.tar.gz"], self.builder.sources)
@@ -0,0 +1,220 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tito.builder import MockBuilder
+from tito.cache import DEFAULT_MOCK_ROOT_TTL, MockRootCache
+from tito.compat import StringIO
+from tito.exception import RunCommandException, TitoException
+
+MOCK_SCRIPT = """#!/bin/sh
+echo "$@" >> %(log)s
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -r) chroot="$2"; shift ;;
+        --resultdir) resultdir="$2"; shift ;;
+        --rebuild) rebuild=1 ;;
+        --rollback-to) [ -z "$MOCK_NO_SNAPSHOTS" ] || exit 1 ;;
+    esac
+    shift
+done
+case "$chroot" in
+    *broken*) echo "error: build failed"; exit 1 ;;
+esac
+[ -n "$rebuild" ] || exit 0
+mkdir -p "$resultdir"
+touch "$resultdir/foo-1.0-1.src.rpm" "$resultdir/foo-1.0-1.$chroot.noarch.rpm" "$resultdir/build.log"
+"""
+
+
+MOCK_ACTIONS = ["--init", "--installdeps", "--rebuild", "--snapshot", "--rollback-to",
+    "--remove-snapshot"]
+
+RPM_SCRIPT = """#!/bin/sh
+echo "$REQUIRES"
+"""
+
+
+class MockBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.work_dir, "mock.log")
+        bin_dir = os.path.join(self.work_dir, "bin")
+        os.mkdir(bin_dir)
+        script = os.path.join(bin_dir, "mock")
+        f = open(script, "w")
+        f.write(MOCK_SCRIPT % {'log': self.log})
+        f.close()
+        os.chmod(script, 0o755)
+        script = os.path.join(bin_dir, "rpm")
+        f = open(script, "w")
+        f.write(RPM_SCRIPT)
+        f.close()
+        os.chmod(script, 0o755)
+        os.environ['REQUIRES'] = "gcc"
+        self.orig_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + self.orig_path
+        self.orig_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.orig_stdout
+        os.environ['PATH'] = self.orig_path
+        os.environ.pop('REQUIRES', None)
+        os.environ.pop('MOCK_NO_SNAPSHOTS', None)
+        shutil.rmtree(self.work_dir)
+
+    def builder(self, mock_tags, mock_jobs=None, warm=None):
+        builder = MockBuilder.__new__(MockBuilder)
+        builder.project_name = "foo"
+        builder.mock_tags = mock_tags
+        builder.mock_tag = mock_tags[0]
+        builder.mock_jobs = mock_jobs or len(mock_tags)
+        builder.mock_cmd_args = " --no-clean"
+        builder.mock_config_dir = os.path.join(self.work_dir, "mock")
+        builder.warm = warm
+        builder.mock_roots = MockRootCache(os.path.join(self.work_dir, ".cache",
+            "mock-roots.json"))
+        builder.mock_root_ttl = DEFAULT_MOCK_ROOT_TTL
+        builder.rpmbuild_basedir = self.work_dir
+        builder.rpmbuild_dir = os.path.join(self.work_dir, "rpmbuild-foo")
+        builder.srpm_location = os.path.join(self.work_dir, "foo-1.0-1.src.rpm")
+        builder.artifacts = []
+        return builder
+
+    def calls(self):
+        return sorted(open(self.log).read().splitlines())
+
+    def test_one_chroot(self):
+        builder = self.builder(["fedora-30-x86_64"])
+        builder._build_in_mock()
+        self.assertEqual([os.path.join(self.work_dir, "foo-1.0-1.fedora-30-x86_64.noarch.rpm")],
+            builder.artifacts)
+        # A single rebuild does it all
+        self.assertEqual(["--no-clean -r fedora-30-x86_64 --resultdir %s --rebuild %s" % (
+            os.path.join(builder.rpmbuild_dir, "mockoutput"), builder.srpm_location)],
+            self.calls())
+
+    def test_chroots(self):
+        builder = self.builder(["epel-8-x86_64", "epel-9-aarch64", "fedora-30-x86_64"],
+            mock_jobs=2)
+        builder._build_in_mock()
+        # Each in a directory of its own
+        self.assertEqual([
+            os.path.join(self.work_dir, "epel-8-x86_64", "foo-1.0-1.epel-8-x86_64.noarch.rpm"),
+            os.path.join(self.work_dir, "epel-9-aarch64", "foo-1.0-1.epel-9-aarch64.noarch.rpm"),
+            os.path.join(self.work_dir, "fedora-30-x86_64", "foo-1.0-1.fedora-30-x86_64.noarch.rpm"),
+        ], builder.artifacts)
+        calls = self.calls()
+        self.assertEqual(3, len(calls))
+        self.assertEqual("--no-clean -r epel-8-x86_64 --uniqueext=tito-foo --resultdir %s "
+            "--rebuild %s" % (os.path.join(builder.rpmbuild_dir, "mockoutput", "epel-8-x86_64"),
+                builder.srpm_location), calls[0])
+        self.assertTrue("epel-9-aarch64" in sys.stdout.getvalue())
+
+    def test_failed_chroot(self):
+        builder = self.builder(["epel-8-x86_64", "broken-x86_64"])
+        self.assertRaises(SystemExit, builder._build_in_mock)
+        self.assertEqual([os.path.join(self.work_dir, "epel-8-x86_64",
+            "foo-1.0-1.epel-8-x86_64.noarch.rpm")], builder.artifacts)
+        self.assertTrue("failed, see %s" % os.path.join(builder.rpmbuild_dir,
+            "mockoutput", "broken-x86_64", "build.log") in sys.stdout.getvalue())
+
+        builder = self.builder(["broken-x86_64"])
+        self.assertRaises(RunCommandException, builder._build_in_mock)
+
+    def test_mock_jobs(self):
+        builder = self.builder(["epel-8-x86_64", "epel-9-x86_64"])
+        builder.user_config = {}
+        self.assertEqual(2, builder._get_mock_jobs({}))
+        self.assertEqual(1, builder._get_mock_jobs({'mock_jobs': ['1']}))
+        builder.user_config = {'MOCK_JOBS': '3'}
+        self.assertEqual(3, builder._get_mock_jobs({}))
+        self.assertRaises(TitoException, builder._get_mock_jobs, {'mock_jobs': ['0']})
+        self.assertRaises(TitoException, builder._get_mock_jobs, {'mock_jobs': ['all']})
+
+    def actions(self):
+        """ The mock actions run since the last call. """
+        calls = open(self.log).read().splitlines()
+        os.unlink(self.log)
+        return [[arg for arg in call.split() if arg in MOCK_ACTIONS][0] for call in calls]
+
+    def build(self, builder):
+        sys.stdout = StringIO()
+        builder.artifacts = []
+        builder._build_in_mock()
+        return sys.stdout.getvalue()
+
+    def test_warm_root(self):
+        builder = self.builder(["epel-9-x86_64"], warm="root")
+        output = self.build(builder)
+        self.assertEqual(["--init", "--installdeps", "--rebuild"], self.actions())
+        self.assertTrue("epel-9-x86_64: initialized root in" in output)
+        self.assertTrue("(no warm root yet)" in output)
+        self.assertEqual(1, len(builder.artifacts))
+
+        output = self.build(builder)
+        self.assertTrue("-r epel-9-x86_64 --uniqueext=tito-foo --resultdir %s --no-clean "
+            "--no-cleanup-after --rebuild" % os.path.join(builder.rpmbuild_dir, "mockoutput")
+            in open(self.log).read())
+        self.assertEqual(["--rebuild"], self.actions())
+        self.assertTrue("epel-9-x86_64: reused warm root, saving the" in output)
+
+        # New BuildRequires
+        os.environ['REQUIRES'] = "gcc\nmake"
+        output = self.build(builder)
+        self.assertEqual(["--init", "--installdeps", "--rebuild"], self.actions())
+        self.assertTrue("(mock config or BuildRequires changed)" in output)
+
+        # The mock config changed
+        os.mkdir(builder.mock_config_dir)
+        f = open(os.path.join(builder.mock_config_dir, "epel-9-x86_64.cfg"), "w")
+        f.write("config_opts['root'] = 'epel-9-x86_64'\n")
+        f.close()
+        self.build(builder)
+        self.assertEqual(["--init", "--installdeps", "--rebuild"], self.actions())
+        self.build(builder)
+        self.assertEqual(["--rebuild"], self.actions())
+
+        # Too old
+        builder.mock_root_ttl = -1
+        output = self.build(builder)
+        self.assertEqual(["--init", "--installdeps", "--rebuild"], self.actions())
+        self.assertTrue("(root older than -1 seconds)" in output)
+
+    def test_snapshot(self):
+        builder = self.builder(["epel-9-x86_64", "fedora-30-x86_64"], warm="snapshot")
+        output = self.build(builder)
+        self.assertEqual(["--init", "--init", "--installdeps", "--installdeps",
+            "--rebuild", "--rebuild", "--snapshot", "--snapshot"], sorted(self.actions()))
+        self.assertTrue(", snapshot tito-" in output)
+
+        output = self.build(builder)
+        self.assertEqual(["--rebuild", "--rebuild", "--rollback-to", "--rollback-to"],
+            sorted(self.actions()))
+        self.assertTrue("fedora-30-x86_64: rolled back to snapshot tito-" in output)
+
+        # New BuildRequires, the old snapshot goes
+        old_snapshot = builder.mock_roots.get("epel-9-x86_64-tito-foo")["key"][:12]
+        os.environ['REQUIRES'] = "gcc\nmake"
+        self.build(builder)
+        self.assertTrue("--remove-snapshot tito-%s" % old_snapshot in open(self.log).read())
+        self.assertEqual(["--init", "--init", "--installdeps", "--installdeps",
+            "--rebuild", "--rebuild", "--remove-snapshot", "--remove-snapshot", "--snapshot",
+            "--snapshot"], sorted(self.actions()))
+
+        # The snapshot is gone
+        os.environ['MOCK_NO_SNAPSHOTS'] = "1"
+        output = self.build(builder)
+        self.assertEqual(["--init", "--init", "--installdeps", "--installdeps",
+            "--rebuild", "--rebuild", "--remove-snapshot", "--remove-snapshot",
+            "--rollback-to", "--rollback-to", "--snapshot", "--snapshot"],
+            sorted(self.actions()))
+        self.assertTrue("(no snapshot tito-" in output)
+
+    def test_warm_root_fails(self):
+        builder = self.builder(["broken-x86_64"], warm="root")
+        self.assertRaises(RunCommandException, builder._build_in_mock)
+        self.assertEqual(["--init"], self.actions())
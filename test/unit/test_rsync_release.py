@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tito.compat import RawConfigParser
+from tito.release import RsyncReleaser, YumRepoReleaser
+
+
+class FakeBuilder(object):
+    """ Records what it was asked to do. """
+
+    def __init__(self):
+        self.calls = []
+        self.artifacts = []
+
+    def tgz(self):
+        self.calls.append("tgz")
+
+    def srpm(self, dist=None):
+        self.calls.append("srpm%s" % dist)
+
+    def rpm(self):
+        self.calls.append("rpm")
+
+    def cleanup(self):
+        self.calls.append("cleanup")
+
+
+class RsyncReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.orig_cwd = os.getcwd()
+        self.build_dir = tempfile.mkdtemp()
+        self.config = RawConfigParser()
+        self.add_target("yum-fc30", "rsync", YumRepoReleaser, srpm_disttag=".fc30")
+        self.add_target("yum-fc30-sources", "rsync", RsyncReleaser,
+            srpm_disttag=".fc30", filetypes="srpm")
+        self.add_target("yum-el8", "rsync", YumRepoReleaser, srpm_disttag=".el8")
+
+    def tearDown(self):
+        os.chdir(self.orig_cwd)
+        shutil.rmtree(self.build_dir)
+
+    def add_target(self, target, rsync, releaser_class, **options):
+        self.config.add_section(target)
+        self.config.set(target, "releaser", "%s.%s" % (releaser_class.__module__,
+            releaser_class.__name__))
+        self.config.set(target, "builder", "tito.builder.MockBuilder")
+        self.config.set(target, "builder.mock", "fedora-30-x86_64")
+        self.config.set(target, "rsync", rsync)
+        for (option, value) in options.items():
+            self.config.set(target, option, value)
+
+    def releaser(self, target):
+        releaser = RsyncReleaser.__new__(RsyncReleaser)
+        releaser.builder = FakeBuilder()
+        releaser.releaser_config = self.config
+        releaser.target = target
+        releaser.build_dir = self.build_dir
+        releaser.prefix = "temp_dir="
+        releaser.no_cleanup = False
+        releaser.built = False
+        releaser.cleanup_builder = True
+        releaser._rsync_from_remote = lambda rsync_args, rsync_location, temp_dir: None
+        releaser.rsync_to_remote = lambda rsync_args, temp_dir, rsync_location: None
+        return releaser
+
+    def test_build_key(self):
+        key = YumRepoReleaser.build_key(self.config, "yum-fc30")
+        self.assertEqual(key, RsyncReleaser.build_key(self.config, "yum-fc30-sources"))
+        self.assertNotEqual(key, YumRepoReleaser.build_key(self.config, "yum-el8"))
+        self.config.set("yum-fc30-sources", "builder.mock", "fedora-31-x86_64")
+        self.assertNotEqual(key, RsyncReleaser.build_key(self.config, "yum-fc30-sources"))
+
+    def test_shared_builder(self):
+        first = self.releaser("yum-fc30")
+        first.cleanup_builder = False
+        first.release()
+        self.assertEqual(["tgz", "srpm.fc30", "rpm"], first.builder.calls)
+
+        second = self.releaser("yum-fc30-sources")
+        own_builder = second.builder
+        second.use_builder(first.builder)
+        second.release()
+        self.assertEqual(["cleanup"], own_builder.calls)
+        # Cleaned up by the last target using it
+        self.assertEqual(["tgz", "srpm.fc30", "rpm", "cleanup"], first.builder.calls)
+
+    def test_own_builder(self):
+        releaser = self.releaser("yum-el8")
+        releaser.release()
+        self.assertEqual(["tgz", "srpm.el8", "rpm", "cleanup"], releaser.builder.calls)
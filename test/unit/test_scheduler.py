@@ -0,0 +1,173 @@
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from tito.common import run_command
+from tito.exception import TitoException
+from tito.scheduler import BuildGraph, BuildScheduler, Package, \
+    changed_packages, read_packages
+
+
+def package(name, build_requires=(), provides=None, relative_dir=None):
+    result = Package(name, "1.0-1", relative_dir or name)
+    result.build_requires = list(build_requires)
+    result.provides = provides or [name]
+    return result
+
+
+def packages(*args):
+    return dict((p.name, p) for p in args)
+
+
+class BuildGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.packages = packages(
+            package("libfoo", ["gcc"], ["libfoo", "libfoo-devel", "pkgconfig(foo)"]),
+            package("foo", ["pkgconfig(foo)", "python3-bar"]),
+            package("bar", ["python3"], ["bar", "python3-bar"]),
+            package("baz", ["foo", "baz"]),
+        )
+        self.graph = BuildGraph(self.packages)
+
+    def test_requires(self):
+        self.assertEqual(set(), self.graph.requires["libfoo"])
+        self.assertEqual(set(["libfoo", "bar"]), self.graph.requires["foo"])
+        # Not itself
+        self.assertEqual(set(["foo"]), self.graph.requires["baz"])
+
+    def test_dependents(self):
+        self.assertEqual(set(["libfoo", "foo", "baz"]), self.graph.dependents(["libfoo"]))
+        self.assertEqual(set(["baz"]), self.graph.dependents(["baz"]))
+
+    def test_order(self):
+        self.assertEqual(["bar", "libfoo", "foo", "baz"], self.graph.order())
+
+    def test_select(self):
+        graph = self.graph.select(["foo", "baz"])
+        # libfoo and bar are there already
+        self.assertEqual(set(), graph.requires["foo"])
+        self.assertEqual(["foo", "baz"], graph.order())
+
+    def test_cycle(self):
+        self.packages["libfoo"].build_requires.append("baz")
+        self.assertRaises(TitoException, BuildGraph(self.packages).order)
+
+    def test_unknown_build_requires(self):
+        self.packages["foo"].build_requires = None
+        self.assertEqual(set(), BuildGraph(self.packages).requires["foo"])
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.graph = BuildGraph(packages(
+            package("libfoo"),
+            package("foo", ["libfoo"]),
+            package("bar", ["libfoo"]),
+            package("baz", ["foo", "bar"]),
+            package("other"),
+        ))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def build(self, name):
+        """ Built in a worker process, fails unless what it requires was built. """
+        print("building %s" % name)
+        if name == "bar" and getattr(self, "fail_bar", False):
+            raise TitoException("bar is broken")
+        for required in self.graph.requires[name]:
+            if not os.path.exists(os.path.join(self.work_dir, required + ".rpm")):
+                raise TitoException("%s not built yet" % required)
+        rpm = os.path.join(self.work_dir, name + ".rpm")
+        open(rpm, "w").close()
+        return [rpm]
+
+    def test_build(self):
+        done = []
+        scheduler = BuildScheduler(self.graph, self.build, jobs=3,
+            log_dir=os.path.join(self.work_dir, "logs"))
+        self.assertTrue(scheduler.run(done.append))
+        self.assertEqual({}, scheduler.failed)
+        self.assertEqual(sorted(self.graph.names), sorted(done))
+        self.assertTrue(done.index("libfoo") < done.index("foo"))
+        self.assertTrue(done.index("libfoo") < done.index("bar"))
+        self.assertEqual("baz", done[-1])
+        self.assertEqual([os.path.join(self.work_dir, "foo.rpm")], scheduler.built["foo"])
+        self.assertEqual("building foo\n", open(scheduler.log_file("foo")).read())
+
+    def test_failure(self):
+        self.fail_bar = True
+        scheduler = BuildScheduler(self.graph, self.build, jobs=2)
+        self.assertFalse(scheduler.run())
+        self.assertEqual(["bar"], list(scheduler.failed))
+        self.assertEqual("TitoException: bar is broken", scheduler.failed["bar"])
+        self.assertEqual(["baz"], scheduler.skipped)
+        self.assertEqual(set(["libfoo", "foo", "other"]), set(scheduler.built))
+
+    def test_exit(self):
+        def build(name):
+            raise SystemExit(1)
+        scheduler = BuildScheduler(self.graph.select(["other"]), build)
+        self.assertFalse(scheduler.run())
+        self.assertEqual({"other": "exited with 1"}, scheduler.failed)
+
+    def test_worker_killed(self):
+        def build(name):
+            os.kill(os.getpid(), signal.SIGKILL)
+        scheduler = BuildScheduler(self.graph.select(["libfoo", "foo"]), build)
+        self.assertFalse(scheduler.run())
+        self.assertEqual(["libfoo"], list(scheduler.failed))
+        self.assertTrue(scheduler.failed["libfoo"].endswith(" died"))
+        self.assertEqual(["foo"], scheduler.skipped)
+
+    def test_unpicklable_result(self):
+        def build(name):
+            return [lambda: None]
+        scheduler = BuildScheduler(self.graph.select(["other"]), build)
+        self.assertFalse(scheduler.run())
+        self.assertEqual(["other"], list(scheduler.failed))
+
+
+class PackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.repo_dir, ".tito", "packages"))
+        for (name, relative_dir) in [("foo", "foo/"), ("bar", "lib/bar/")]:
+            os.makedirs(os.path.join(self.repo_dir, relative_dir))
+            self.write(os.path.join(relative_dir, "README"), name)
+            self.write(os.path.join(".tito", "packages", name),
+                "1.0-1 %s\n" % relative_dir)
+        self.write(os.path.join(".tito", "packages", ".readme"), "docs")
+        self.git("init -q")
+        self.git("add .")
+        self.git("commit -q -m initial")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir)
+
+    def write(self, path, content):
+        f = open(os.path.join(self.repo_dir, path), "w")
+        f.write(content)
+        f.close()
+
+    def git(self, args):
+        run_command("cd %s && git -c user.name=tito -c user.email=tito@example.com %s" %
+            (self.repo_dir, args))
+
+    def test_read_packages(self):
+        result = read_packages(os.path.join(self.repo_dir, ".tito"))
+        self.assertEqual(["bar", "foo"], sorted(result))
+        self.assertEqual("lib/bar", result["bar"].relative_dir)
+        self.assertEqual("1.0-1", result["bar"].version)
+
+    def test_changed_packages(self):
+        result = read_packages(os.path.join(self.repo_dir, ".tito"))
+        self.assertEqual(set(), changed_packages(result, self.repo_dir, "HEAD"))
+        self.write(os.path.join("lib", "bar", "README"), "changed")
+        self.assertEqual(set(["bar"]), changed_packages(result, self.repo_dir, "HEAD"))
+        self.git("commit -q -a -m bar")
+        self.assertEqual(set(["bar"]), changed_packages(result, self.repo_dir, "HEAD~1"))
+        self.assertEqual(set(), changed_packages(result, self.repo_dir, "HEAD"))
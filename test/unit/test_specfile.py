@@ -0,0 +1,192 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import Mock
+
+from tito import specfile
+from tito.cache import MacroCache
+from tito.specfile import eval_macro, macro_files_fingerprint, query_spec, \
+    set_macro_cache, spec_cache_key
+
+RPM_SCRIPT = """#!/bin/sh
+echo "$@" >> %(log)s
+if [ "$1" = "--eval" ]; then
+    echo "/opt/rh"
+    exit 0
+fi
+echo ""
+printf 'foo\\t1.0\\t1.fc30\\n'
+printf 'foo-devel\\t1.0\\t1.fc30\\n'
+"""
+
+
+class SpecFileTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.spec = self.write("foo.spec", "Name: foo\nVersion: 1.0\n")
+        self.orig_rpm = sys.modules.get('rpm')
+        specfile._specs.clear()
+        specfile._macros.clear()
+
+    def tearDown(self):
+        if self.orig_rpm is None:
+            sys.modules.pop('rpm', None)
+        else:
+            sys.modules['rpm'] = self.orig_rpm
+        specfile._specs.clear()
+        specfile._macros.clear()
+        set_macro_cache(None)
+        shutil.rmtree(self.work_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.work_dir, name)
+        f = open(path, 'w')
+        f.write(content)
+        f.close()
+        return path
+
+    def test_cache_key(self):
+        copy = self.write("copy.spec", "Name: foo\nVersion: 1.0\n")
+        self.assertEqual(spec_cache_key(self.spec, ()), spec_cache_key(copy, ()))
+        self.assertNotEqual(spec_cache_key(self.spec, ()),
+            spec_cache_key(self.spec, [("scl", None)]))
+        self.assertNotEqual(spec_cache_key(self.spec, [("scl", None)]),
+            spec_cache_key(self.spec, [("scl", "foo")]))
+        self.write("foo.spec", "Name: foo\nVersion: 1.1\n")
+        self.assertNotEqual(spec_cache_key(self.spec, ()), spec_cache_key(copy, ()))
+
+    def fake_rpm(self):
+        rpm = Mock()
+        rpm.RPMTAG_NAME = 'name'
+        rpm.RPMTAG_VERSION = 'version'
+        rpm.RPMTAG_RELEASE = 'release'
+        rpm.RPMTAG_REQUIRENAME = 'requirename'
+        rpm.RPMTAG_PROVIDENAME = 'providename'
+        spec = Mock()
+        spec.sourceHeader = {'name': b'foo', 'version': b'1.0', 'release': b'1',
+            'requirename': [b'gcc', b'make']}
+        spec.packages = [Mock(header={'name': b'foo', 'providename': [b'foo', b'libfoo.so.1']}),
+            Mock(header={'name': b'foo-devel', 'providename': [b'foo-devel', b'pkgconfig(foo)']})]
+        spec.sources = [(b'foo-1.0.tar.gz', 0, 1), (b'fix.patch', 0, 2)]
+        rpm.spec.return_value = spec
+        rpm.expandMacro.return_value = "/opt/rh"
+        sys.modules['rpm'] = rpm
+        return rpm
+
+    def test_bindings(self):
+        rpm = self.fake_rpm()
+        info = query_spec(self.spec, [("_sourcedir", "/tmp"), ("scl", None)])
+        self.assertEqual(("foo", "1.0", "1"), (info.name, info.version, info.release))
+        self.assertEqual(["foo-1.0.tar.gz"], info.sources)
+        self.assertEqual(["fix.patch"], info.patches)
+        self.assertEqual(["gcc", "make"], info.build_requires)
+        self.assertEqual(["foo", "libfoo.so.1", "foo-devel", "pkgconfig(foo)"], info.provides)
+        rpm.addMacro.assert_called_once_with("_sourcedir", "/tmp")
+        rpm.delMacro.assert_called_once_with("scl")
+        rpm.reloadConfig.assert_called_once_with()
+
+        # Parsed once per content and macros
+        query_spec(self.spec, [("_sourcedir", "/tmp"), ("scl", None)])
+        self.assertEqual(1, rpm.spec.call_count)
+        query_spec(self.spec, [("_sourcedir", "/tmp")])
+        self.assertEqual(2, rpm.spec.call_count)
+        self.write("foo.spec", "Name: foo\nVersion: 1.1\n")
+        query_spec(self.spec, [("_sourcedir", "/tmp")])
+        self.assertEqual(3, rpm.spec.call_count)
+
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+        rpm.expandMacro.assert_called_once_with("%scl")
+
+    def test_bindings_parse_error(self):
+        rpm = self.fake_rpm()
+        rpm.spec.side_effect = ValueError("can't parse specfile")
+        self.assertEqual(None, query_spec(self.spec))
+
+    def test_rpm_command(self):
+        # No bindings, "import rpm" fails
+        sys.modules['rpm'] = None
+        log = os.path.join(self.work_dir, "rpm.log")
+        bin_dir = os.path.join(self.work_dir, "bin")
+        os.mkdir(bin_dir)
+        script = self.write(os.path.join("bin", "rpm"), RPM_SCRIPT % {'log': log})
+        os.chmod(script, 0o755)
+        orig_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + orig_path
+        try:
+            for i in range(3):
+                info = query_spec(self.spec, [("dist", "%undefined"), ("scl", None)])
+                self.assertEqual(("foo", "1.0", "1.fc30"), (info.name, info.version, info.release))
+                self.assertEqual(None, info.sources)
+                self.assertEqual(["foo", "foo-devel"], info.provides)
+                self.assertEqual("/opt/rh", eval_macro("%scl"))
+        finally:
+            os.environ['PATH'] = orig_path
+        # The query format ends with a newline, so a query logs two lines
+        calls = open(log).read().splitlines()
+        self.assertEqual(3, len(calls))
+        self.assertTrue(calls[1].startswith(" --define dist %undefined --eval %undefine scl --specfile"))
+        self.assertEqual("--eval %scl", calls[2])
+
+    def test_no_rpm(self):
+        sys.modules['rpm'] = None
+        orig_path = os.environ['PATH']
+        os.environ['PATH'] = os.path.join(self.work_dir, "empty")
+        try:
+            self.assertEqual(None, query_spec(self.spec))
+            self.assertEqual("%scl", eval_macro("%scl"))
+        finally:
+            os.environ['PATH'] = orig_path
+
+    def test_eval_macro_defines(self):
+        rpm = self.fake_rpm()
+        eval_macro("%{?dist}", [("dist", ".el7")])
+        eval_macro("%{?dist}", [("dist", ".el7")])
+        eval_macro("%{?dist}", [("dist", ".el8")])
+        eval_macro("%{?dist}")
+        self.assertEqual(3, rpm.expandMacro.call_count)
+        self.assertEqual(2, rpm.addMacro.call_count)
+        self.assertEqual(2, rpm.reloadConfig.call_count)
+
+    def test_macro_cache(self):
+        rpm = self.fake_rpm()
+        path = os.path.join(self.work_dir, "cache", "rpm-macros.json")
+        set_macro_cache(MacroCache(path, "fingerprint"))
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+
+        # Another run
+        specfile._macros.clear()
+        set_macro_cache(MacroCache(path, "fingerprint"))
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+        self.assertEqual(1, rpm.expandMacro.call_count)
+
+        # The macro files changed since
+        specfile._macros.clear()
+        set_macro_cache(MacroCache(path, "other fingerprint"))
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+        self.assertEqual(2, rpm.expandMacro.call_count)
+
+    def test_macro_cache_unwritable(self):
+        self.fake_rpm()
+        # Its directory is a file:
+        path = os.path.join(self.write("cache", ""), "rpm-macros.json")
+        set_macro_cache(MacroCache(path, "fingerprint"))
+        self.assertEqual("/opt/rh", eval_macro("%scl"))
+
+    def test_macro_files_fingerprint(self):
+        macros = self.write("macros.scl", "%scl foo\n")
+        orig_files = specfile.MACRO_FILES
+        specfile.MACRO_FILES = [os.path.join(self.work_dir, "macros.*")]
+        try:
+            fingerprint = macro_files_fingerprint()
+            self.assertEqual(fingerprint, macro_files_fingerprint())
+            os.utime(macros, (0, 0))
+            self.assertNotEqual(fingerprint, macro_files_fingerprint())
+            fingerprint = macro_files_fingerprint()
+            self.write("macros.dist", "%dist .el7\n")
+            self.assertNotEqual(fingerprint, macro_files_fingerprint())
+        finally:
+            specfile.MACRO_FILES = orig_files
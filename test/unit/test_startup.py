@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import tito
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(tito.__file__)))
+
+CHECK_IMPORTS = """
+import sys
+import tito.cli
+lazy = ("blessings", "bugzilla", "rpm", "pkg_resources", "distutils",
+    "xmlrpc", "xmlrpclib", "multiprocessing", "tito.builder", "tito.tagger",
+    "tito.release", "tito.scheduler", "tito.cache", "tito.compress", "tito.tar")
+print(" ".join(sorted(name for name in sys.modules
+    if [l for l in lazy if name == l or name.startswith(l + ".")])))
+"""
+
+
+class StartupTest(unittest.TestCase):
+    """
+    Every tito command imports tito.cli first, keep it free of modules only
+    some commands need.
+    """
+
+    def test_cli_imports_lazily(self):
+        env = dict(os.environ, PYTHONPATH=SRC_DIR)
+        proc = subprocess.Popen([sys.executable, "-c", CHECK_IMPORTS], env=env,
+            stdout=subprocess.PIPE)
+        output = proc.communicate()[0].decode('utf8').strip()
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual("", output)
+
+    def test_get_class_by_name(self):
+        from tito.common import get_class_by_name
+        from tito.compat import StringIO
+        self.assertTrue(get_class_by_name("tito.compat.StringIO") is StringIO)
+        self.assertTrue(get_class_by_name("tito.compat.StringIO") is StringIO)
+        self.assertRaises(AttributeError, get_class_by_name, "tito.compat.NoSuchClass")
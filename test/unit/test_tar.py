@@ -1,10 +1,12 @@
 import hashlib
 import os
+import tarfile
+import tempfile
 import unittest
 
 from tito.compat import StringIO, encode_bytes
-from tito.tar import TarFixer
-from mock import Mock
+from tito.tar import TarFixer, TeeFile, HEADER_FIELDS, HEADER_STRUCT
+from mock import Mock, patch
 
 EXPECTED_TIMESTAMP = 1429725106
 EXPECTED_REF = "3518d720bff20db887b7a5e5dddd411d14dca1f9"
@@ -67,6 +69,63 @@ def test_fix(self):
         self.tarfixer.fix()
         self.assertEqual(self.reference_hash, self.hash_buffer(encode_bytes(self.out.getvalue(), "utf8")))
 
+    def _fix_to_file(self, tarfixer):
+        out = tempfile.TemporaryFile(mode='w+b')
+        try:
+            tarfixer.fh = open(self.test_file, 'rb')
+            tarfixer.out = out
+            tarfixer.fix()
+            out.seek(0)
+            return self.hash_buffer(out.read())
+        finally:
+            out.close()
+
+    def test_fix_to_file(self):
+        self.assertEqual(self.reference_hash, self._fix_to_file(self.tarfixer))
+
+    def test_fix_in_small_chunks(self):
+        self.tarfixer.chunk_size = 512
+        with patch.object(TarFixer, '_copy_file_range', return_value=False):
+            self.assertEqual(self.reference_hash, self._fix_to_file(self.tarfixer))
+        self.assertEqual(512, len(self.tarfixer.copy_buffer))
+
+    def test_fix_in_small_chunks_to_text(self):
+        self.tarfixer.chunk_size = 1536
+        self.tarfixer.fh = open(self.test_file, 'rb')
+        self.tarfixer.fix()
+        self.assertEqual(self.reference_hash, self.hash_buffer(encode_bytes(self.out.getvalue(), "utf8")))
+
+    def test_member_callback(self):
+        members = []
+        self.tarfixer.member_callback = members.append
+        self.tarfixer.fh = open(self.test_file, 'rb')
+        self.tarfixer.fix()
+        reference = tarfile.open(self.reference_file)
+        expected = [m.name for m in reference.getmembers()]
+        reference.close()
+        self.assertEqual(expected, [m.rstrip("/") for m in members])
+
+    def test_fix_to_tee(self):
+        first = tempfile.TemporaryFile(mode='w+b')
+        second = tempfile.TemporaryFile(mode='w+b')
+        try:
+            self.tarfixer.fh = open(self.test_file, 'rb')
+            self.tarfixer.out = TeeFile(first, second)
+            self.tarfixer.fix()
+            for out in (first, second):
+                out.seek(0)
+                self.assertEqual(self.reference_hash, self.hash_buffer(out.read()))
+        finally:
+            first.close()
+            second.close()
+
+    def test_full_readinto_buffer_underflow(self):
+        self.tarfixer.fh = open(self.test_file, 'rb')
+        self.tarfixer.fh.seek(0, os.SEEK_END)
+        view = memoryview(bytearray(10))
+        self.assertRaises(IOError, self.tarfixer.full_readinto, view)
+        self.tarfixer.fh.close()
+
     def test_fix_fails_unless_file_in_binary_mode(self):
         self.fh = open(self.test_file, 'r')
         self.tarfixer.fh = self.fh
@@ -111,6 +170,51 @@ def test_calculate_checksum(self):
         expected_result = 10 + ord(" ") * 8
         self.assertEqual("%07o\x00" % expected_result, result)
 
+    def _fix_header(self, fields, maven_built=False):
+        header = dict((name, b"") for name, _ in self.tarfixer.tar_struct)
+        header.update(fields)
+        chunk = HEADER_STRUCT.pack(*[header[name] for name, _ in self.tarfixer.tar_struct])
+        self.tarfixer.maven_built = maven_built
+        self.tarfixer.need_header = False
+        self.tarfixer.process_file_data = Mock()
+        self.tarfixer.process_chunk(chunk)
+        return encode_bytes(self.out.getvalue(), "utf8")
+
+    def test_process_chunk_maven_header(self):
+        result = self._fix_header({
+            'name': b"foo.jar",
+            'mode': b"100644 ",
+            'size': b"     17    ",
+            'version': b"  ",
+            'uname': b"somebody",
+            'gname': b"somebody",
+            'devmajor': b"     0 ",
+            'devminor': b"     0 ",
+        }, maven_built=True)
+        self.assertEqual(512, len(result))
+        self.assertEqual(b"0000644\x00", result[HEADER_FIELDS['mode']])
+        self.assertEqual(b"0000000\x00", result[HEADER_FIELDS['uid']])
+        self.assertEqual(b"00000000017\x00", result[HEADER_FIELDS['size']])
+        self.assertEqual(("%011o\x00" % EXPECTED_TIMESTAMP).encode("ascii"), result[HEADER_FIELDS['mtime']])
+        self.assertEqual(b"00", result[HEADER_FIELDS['version']])
+        self.assertEqual(b"root" + b"\x00" * 28, result[HEADER_FIELDS['uname']])
+        self.tarfixer.process_file_data.assert_called_once_with(0o17)
+
+    def test_process_chunk_checksum(self):
+        result = bytearray(self._fix_header({
+            'name': u"p\u00e4ckage".encode("utf8"),
+            'mode': b"0000644\x00",
+            'uid': b"0000000\x00",
+            'gid': b"0000000\x00",
+            'size': b"00000000000\x00",
+            'devmajor': b"0000000\x00",
+            'devminor': b"0000000\x00",
+        }))
+        checksum = HEADER_FIELDS['checksum']
+        stored = int(bytes(result[checksum]).rstrip(b"\x00"), 8)
+        result[checksum] = b" " * 8
+        self.assertEqual(sum(result), stored)
+
     def test_encode_header(self):
         mode = 123
         chunk = {
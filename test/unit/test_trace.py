@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tito.common import run_argv, run_command, run_command_print
+from tito.compat import StringIO, getstatusoutput
+from tito.exception import RunCommandException
+from tito import trace
+from tito.trace import is_tracing, start_tracing, stop_tracing, trace_phase
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, "trace.json")
+        self.orig_stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        stop_tracing()
+        sys.stderr = self.orig_stderr
+        shutil.rmtree(self.work_dir)
+
+    def read_trace(self):
+        stop_tracing()
+        f = open(self.path)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def events(self, category):
+        return [event for event in self.read_trace()["traceEvents"]
+            if event["cat"] == category]
+
+    def test_not_tracing(self):
+        self.assertFalse(is_tracing())
+        with trace_phase("tgz"):
+            run_command("true")
+        stop_tracing()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_phases(self):
+        start_tracing(self.path, profile=False)
+        with trace_phase("release", target="yum"):
+            with trace_phase("srpm"):
+                pass
+        (srpm, release) = self.events("phase")
+        self.assertEqual("srpm", srpm["name"])
+        self.assertEqual("X", release["ph"])
+        self.assertEqual({"target": "yum"}, release["args"])
+        self.assertTrue(release["ts"] <= srpm["ts"])
+        self.assertTrue(release["dur"] >= srpm["dur"])
+        self.assertFalse(is_tracing())
+
+    def test_commands(self):
+        start_tracing(self.path, profile=False)
+        run_command("echo hello")
+        run_command(["true"])
+        self.assertEqual(1, getstatusoutput("exit 1")[0])
+        self.assertEqual(127, run_argv(["tito-no-such-command"], cwd=self.work_dir).status)
+        self.assertRaises(RunCommandException, run_command_print, "false")
+
+        commands = self.events("command")
+        self.assertEqual(["echo", "true", "exit", "tito-no-such-command", "false"],
+            [event["name"] for event in commands])
+        self.assertEqual("echo hello", commands[0]["args"]["command"])
+        self.assertEqual(0, commands[0]["args"]["status"])
+        self.assertEqual(["true"], commands[1]["args"]["argv"])
+        self.assertEqual(1, commands[2]["args"]["status"])
+        self.assertEqual(self.work_dir, commands[3]["args"]["cwd"])
+        self.assertEqual(127, commands[3]["args"]["status"])
+        self.assertEqual(1, commands[4]["args"]["status"])
+        if trace.resource is not None:
+            self.assertTrue("user_cpu" in commands[0]["args"])
+            self.assertTrue("max_child_rss_kb" in commands[0]["args"])
+
+    def test_summary(self):
+        start_tracing(self.path, profile=False)
+        for i in range(3):
+            with trace_phase("tgz"):
+                run_command("true")
+        summary = self.read_trace()["otherData"]["summary"]
+        self.assertEqual(["tgz", "true"], [row["name"] for row in summary])
+        self.assertEqual(3, summary[0]["count"])
+        self.assertTrue("Trace written to %s" % self.path in sys.stderr.getvalue())
+
+    def test_profile(self):
+        start_tracing(self.path, profile=True)
+        with trace_phase("rpm"):
+            with trace_phase("inner"):
+                pass
+        (inner, rpm) = self.events("phase")
+        # Only the outermost phase is profiled
+        self.assertFalse("profile" in inner["args"])
+        self.assertEqual(self.path + ".1-rpm.prof", rpm["args"]["profile"])
+        self.assertTrue(os.path.exists(rpm["args"]["profile"]))